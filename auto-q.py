@@ -16,11 +16,40 @@ import argparse  # a package to parse commandline arguments.
 import sys
 from re import sub
 import gzip
+import io
+import mmap
+import zlib
+import hashlib
+import random
+import math
+import json
+import csv
+import fcntl
+import resource
+import signal
+import struct
+import sqlite3
+import threading
+import time
+import traceback
+import Queue as queue
+import atexit
+from logging.handlers import RotatingFileHandler
 
 
 from subprocess import call  # to run command line scripts
 from subprocess import Popen, PIPE, check_output
+from distutils.spawn import find_executable
 from multiprocessing.dummy import Pool as Pool
+from multiprocessing import Pool as ProcessPool
+from multiprocessing import Queue as ProcessQueue
+from multiprocessing import cpu_count
+from string import maketrans
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __version__ = '0.2.7.2'
 __author__ = "Attayeb Mohsen"
@@ -45,6 +74,569 @@ ID = ID[0:14]
 PR = dict({"id": ID})  # PARAMETERS dict
 
 
+GZIP_BLOCK = 1 << 20  # bytes read from a gzip file at a time
+GZIP_QUEUE = 8  # decompressed blocks waiting to be parsed
+
+
+class GzipReader(io.RawIOBase):
+    """
+    Read a gzip file decompressed in a background thread, so the
+    decompression and the parsing of the reads run at the same time
+    (zlib releases the GIL). When pigz is on the PATH the decompression
+    runs in a pigz -dc process instead. Multi-member files (cat a.gz b.gz)
+    are read to the end.
+    """
+
+    def __init__(self, filename):
+        io.RawIOBase.__init__(self)
+        self.blocks = queue.Queue(GZIP_QUEUE)
+        self.stop = threading.Event()
+        self.filename = filename
+        self.buffer = b""
+        self.position = 0
+        self.eof = False
+        self.process = None
+        if find_executable("pigz"):
+            # python ignores SIGPIPE, pigz stops quietly when the reader is closed early
+            self.process = Popen(["pigz", "-dc", filename], stdout=PIPE, close_fds=True,
+                                 preexec_fn=lambda: signal.signal(signal.SIGPIPE, signal.SIG_DFL))
+            source = self.process.stdout
+        else:
+            source = open(filename, "rb")
+        self.thread = threading.Thread(target=self.decompress, args=(source,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def decompress(self, source):
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            for block in iter(lambda: source.read(GZIP_BLOCK), b""):
+                if self.stop.is_set():
+                    break
+                if self.process is None:
+                    data = d.decompress(block)
+                    while d.unused_data:
+                        # the next member of a multi-member file
+                        rest = d.unused_data
+                        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        data += d.decompress(rest)
+                    block = data
+                self.blocks.put(block)
+            source.close()
+            if self.process is not None and self.process.wait() != 0 and not self.stop.is_set():
+                raise IOError("pigz failed reading %s" % self.filename)
+            self.blocks.put(None)
+        except Exception as e:
+            self.blocks.put(e)
+        finally:
+            source.close()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.position == len(self.buffer) and not self.eof:
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if block is None:
+                self.eof = True
+            else:
+                self.buffer = memoryview(block)
+                self.position = 0
+        n = min(len(b), len(self.buffer) - self.position)
+        b[:n] = self.buffer[self.position:self.position + n]
+        self.position += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            # a reader closed before the end: let the thread finish
+            self.stop.set()
+            while self.thread.is_alive():
+                try:
+                    self.blocks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            if self.process is not None:
+                self.process.wait()
+        io.RawIOBase.close(self)
+
+
+class PigzWriter(io.RawIOBase):
+    """
+    Write a gzip file compressed by a pigz process with --tool_threads
+    threads.
+    """
+
+    def __init__(self, filename, level):
+        io.RawIOBase.__init__(self)
+        self.out = open(filename, "wb")
+        self.process = Popen(["pigz", "-%d" % level, "-p", str(PR['tool_threads']), "-c"],
+                             stdin=PIPE, stdout=self.out, close_fds=True)
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.process.stdin.write(b)
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            self.process.stdin.close()
+            self.process.wait()
+            self.out.close()
+            if self.process.returncode != 0:
+                raise IOError("pigz failed writing %s" % self.out.name)
+        io.RawIOBase.close(self)
+
+
+class RangeReader(io.RawIOBase):
+    """
+    Read the records of one chunk of a sample in place from the memory
+    mapped blocks of read_fastq_blocks(), see run_step().
+    """
+
+    def __init__(self, filename, offsets):
+        io.RawIOBase.__init__(self)
+        self.blocks = read_fastq_blocks(filename, offsets)
+        self.data = None
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.data is None or self.position == len(self.data):
+            # the view of a block is dropped before the block is unmapped
+            self.data = None
+            block = next(self.blocks, None)
+            if block is None:
+                return 0
+            self.data = block[0]
+            self.position = 0
+            del block
+        n = min(len(b), len(self.data) - self.position)
+        memoryview(b)[:n] = self.data[self.position:self.position + n]
+        self.position += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.data = None
+            self.blocks.close()
+        io.RawIOBase.close(self)
+
+
+RANGES = {}  # chunk input name: (file, start, end, key, records, block offsets), see run_step()
+
+
+def open_fastq(filename, mode="r", level=None):
+    """
+    Open a fastq file, gzip compressed files (.gz) are handled transparently,
+    see GzipReader and PigzWriter. The input of a chunk (see RANGES) is read
+    from its sample file.
+
+    :param filename: fastq file name.
+    :type filename: str
+    :param mode: "r" for reading or "w" for writing.
+    :type mode: str
+    :param level: gzip compression level of a .gz file opened for writing,
+    --compress_level when None.
+    :return: file object
+    """
+    if filename in RANGES and mode.startswith("r"):
+        return io.BufferedReader(RangeReader(RANGES[filename][0], RANGES[filename][5]), FQI_BLOCK)
+    if filename.endswith(".gz"):
+        if mode.startswith("r"):
+            if find_executable("pigz") or cpu_count() > 1:
+                return io.BufferedReader(GzipReader(filename), GZIP_BLOCK)
+            # with one CPU a decompression thread only competes with the parsing
+            return io.BufferedReader(gzip.open(filename, "rb"))
+        if level is None:
+            level = PR['compress_level']
+        if find_executable("pigz"):
+            return io.BufferedWriter(PigzWriter(filename, level), GZIP_BLOCK)
+        return io.BufferedWriter(gzip.open(filename, "wb", level))
+    return open(filename, mode)
+
+
+def intermediate(filename):
+    """
+    Name of an intermediate fastq file (trimmed, merged): compressed when
+    --compress_level is above 0.
+
+    :param filename: file name, with or without .gz.
+    :rtype: str
+    """
+    filename = sub("\\.gz$", "", filename)
+    if PR['compress_level'] > 0:
+        return filename + ".gz"
+    return filename
+
+
+def read_fastq(infq):
+    """
+    Iterate over the records of a fastq file one at a time.
+
+    :param infq: open fastq file or any iterator of lines.
+    :return: generator of (header, sequence, plus, quality) tuples,
+    lines are kept with their line ending.
+    """
+    lines = iter(infq)
+    for header in lines:
+        yield header, next(lines), next(lines), next(lines)
+
+
+FQI_BLOCK = 8 << 20  # bytes scanned at a time by build_fastq_index()
+
+
+def index_file(filename):
+    """
+    Name of the .fqi index of a fastq file: others/index/ followed by the
+    fingerprint of the file, a changed file gets a new index.
+    """
+    return PR['others'] + "index/" + file_fingerprint(filename) + ".fqi"
+
+
+def build_fastq_index(filename):
+    """
+    Offsets of the records of an uncompressed fastq file, scanned in
+    blocks of FQI_BLOCK bytes with numpy.
+
+    :param filename: fastq file name.
+    :return: array of the offset of every record followed by the size of
+    the file, so record i is [index[i], index[i + 1]) and there are
+    len(index) - 1 records. The offsets are uint32 for files under 4 GB.
+    """
+    size = os.path.getsize(filename)
+    dtype = numpy.uint32 if size < 1 << 32 else numpy.uint64
+    starts = [numpy.zeros(1 if size else 0, dtype)]
+    lines = 0
+    f = open(filename, "rb")
+    for offset in range(0, size, FQI_BLOCK):
+        block = numpy.frombuffer(f.read(FQI_BLOCK), numpy.uint8)
+        newlines = numpy.flatnonzero(block == 10)
+        # every 4th line ending closes a record
+        ends = newlines[(3 - lines) % 4::4] + (offset + 1)
+        starts.append(ends[ends < size].astype(dtype))
+        lines += len(newlines)
+    f.close()
+    starts.append(numpy.array([size], dtype))
+    return numpy.concatenate(starts)
+
+
+FQI_RECORDS = 10000  # records per block of read_fastq_blocks()
+
+
+def block_offsets(index, first=0, last=None):
+    """
+    Byte offsets of the blocks of FQI_RECORDS records of read_fastq_blocks(),
+    the start of every block followed by the end of the last one.
+
+    :param index: record offsets, see fastq_index().
+    :param first: first record.
+    :param last: record after the last one, the end of the file when None.
+    :rtype: list
+    """
+    if last is None:
+        last = len(index) - 1
+    return [int(index[r]) for r in range(first, last, FQI_RECORDS)] + [int(index[last])]
+
+
+def read_fastq_blocks(filename, offsets):
+    """
+    Zero-copy reader of an uncompressed fastq file: blocks of records as
+    numpy views of a memory map of the file, nothing is copied and no
+    python object is made per line, so a pass over the records is a few
+    numpy operations per block. Each block is mapped on its own so the
+    mapped pages do not add up over a large file, the data of a block is
+    valid until the next block is read. The chunks of a sample are read
+    this way, see RangeReader and fastq_blocks().
+
+    :param filename: fastq file name.
+    :param offsets: block offsets, see block_offsets().
+    :return: generator of (data, lines): data is the uint8 view of the
+    records of the block, lines a (records, 4) array with the end offsets
+    in data of the four lines of each record, line endings included.
+    """
+    f = open(filename, "rb")
+    try:
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            base = start - start % mmap.ALLOCATIONGRANULARITY
+            mm = mmap.mmap(f.fileno(), end - base, access=mmap.ACCESS_READ, offset=base)
+            data = numpy.frombuffer(mm, numpy.uint8, end - start, start - base)
+            ends = numpy.flatnonzero(data == 10) + 1
+            if len(ends) % 4:
+                # the last line of the file has no line ending
+                ends = numpy.append(ends, len(data))
+            yield data, ends.reshape(-1, 4)
+            del data
+            mm.close()
+    finally:
+        f.close()
+
+
+def scan_fastq_blocks(filename):
+    """
+    Blocks of records of an uncompressed fastq file in one sequential pass
+    without an index, the same (data, lines) blocks as read_fastq_blocks():
+    each read of FQI_BLOCK bytes is cut after its last complete record and
+    the rest is moved to the start of the buffer for the next read. The
+    data of a block is valid until the next block is read. For the files
+    read once, an index would read them twice.
+
+    :param filename: fastq file name.
+    :return: generator of (data, lines), see read_fastq_blocks().
+    """
+    f = io.open(filename, "rb", buffering=0)
+    buf = bytearray(FQI_BLOCK)
+    carry = 0
+    while True:
+        if carry == len(buf):
+            # a record longer than the buffer, a new buffer leaves the last block as it was
+            buf = buf + bytearray(len(buf))
+        count = f.readinto(memoryview(buf)[carry:])
+        size = carry + count
+        if not size:
+            break
+        data = numpy.frombuffer(buf, numpy.uint8, size)
+        ends = numpy.flatnonzero(data == 10) + 1
+        if count:
+            n = len(ends) - len(ends) % 4
+        else:
+            # the last line of the file has no line ending
+            if len(ends) % 4:
+                ends = numpy.append(ends, size)
+            n = len(ends)
+        end = int(ends[n - 1]) if n else 0
+        if n:
+            yield data[:end], ends[:n].reshape(-1, 4)
+        del data
+        buf[:size - end] = buf[end:size]
+        carry = size - end
+        if not count:
+            break
+    f.close()
+
+
+def fastq_blocks(filename):
+    """
+    Blocks of records of an uncompressed fastq file: the input of a chunk
+    (see RANGES) with read_fastq_blocks(), other files with
+    scan_fastq_blocks().
+
+    :return: generator of (data, lines), see read_fastq_blocks().
+    """
+    if filename in RANGES:
+        return read_fastq_blocks(RANGES[filename][0], RANGES[filename][5])
+    return scan_fastq_blocks(filename)
+
+
+def line_starts(lines):
+    """
+    Start offsets of the four lines of each record of a read_fastq_blocks()
+    or scan_fastq_blocks() block, same shape as lines.
+    """
+    starts = numpy.empty_like(lines)
+    starts[0, 0] = 0
+    starts[1:, 0] = lines[:-1, 3]
+    starts[:, 1:] = lines[:, :3]
+    return starts
+
+
+def cut_prefixes(size, starts, cuts, length):
+    """
+    Mask of the bytes of a block kept after removing cuts[i] bytes from
+    offset starts[i], cuts are at most length.
+    """
+    keep = numpy.ones(size, bool)
+    r = numpy.arange(length)
+    keep[(starts[:, None] + r)[r < cuts[:, None]]] = False
+    return keep
+
+
+def fastq_index(filename, save=True):
+    """
+    Record offsets of an uncompressed fastq file (see build_fastq_index()),
+    read from its .fqi file or built and saved there, so every later pass
+    can count, seek or split the records without reading the file again.
+    The .fqi file is a numpy .npy array.
+
+    :param filename: fastq file name.
+    :param save: save a new index, False for temporary files. The index of
+    a file of the output folder (see is_output()) is never saved, these
+    files are read a few times and removed.
+    :return: array, None for gzip files and without numpy.
+    """
+    if numpy is None or filename.endswith(".gz"):
+        return None
+    name = index_file(filename)
+    if os.path.isfile(name):
+        index = numpy.load(name)
+        if len(index) and index[-1] == os.path.getsize(filename):
+            return index
+    index = build_fastq_index(filename)
+    if not save or is_output(filename):
+        return index
+    if not os.path.isdir(os.path.dirname(name)):
+        try:
+            os.makedirs(os.path.dirname(name))
+        except OSError:
+            pass
+    temp = "%s.%d.%d.tmp" % (name, os.getpid(), threading.current_thread().ident)
+    with open(temp, "wb") as f:
+        numpy.save(f, index)
+    os.rename(temp, name)
+    return index
+
+
+def write_fastq(outfq, records):
+    """
+    Write fastq records to an open file.
+
+    :param outfq: open output file.
+    :param records: iterable of (header, sequence, plus, quality) tuples.
+    :return: number of written records.
+    :rtype: int
+    """
+    n = 0
+    for record in records:
+        outfq.writelines(record)
+        n += 1
+    return n
+
+
+def read_fasta(infa):
+    """
+    Iterate over the records of a fasta file, sequences may span lines.
+
+    :param infa: open fasta file.
+    :return: generator of (label, sequence) tuples, label without ">".
+    """
+    label = None
+    sequence = []
+    for line in infa:
+        if line.startswith(b">"):
+            if label is not None:
+                yield label, b"".join(sequence)
+            label = line[1:].rstrip().decode("ascii")
+            sequence = []
+        else:
+            sequence.append(line.rstrip())
+    if label is not None:
+        yield label, b"".join(sequence)
+
+
+def write_fasta(outfa, records):
+    """
+    Write fasta records to an open file, one line per sequence.
+
+    :param outfa: open output file.
+    :param records: iterable of (label, sequence) tuples, label without ">".
+    :return: number of written records.
+    :rtype: int
+    """
+    n = 0
+    for label, sequence in records:
+        outfa.write(b">" + label.encode("ascii") + b"\n" + sequence + b"\n")
+        n += 1
+    return n
+
+
+def zip_pairs(records1, records2, in1, in2):
+    """
+    Pair the records of R1 and R2 files.
+
+    :param records1: R1 records generator.
+    :param records2: R2 records generator.
+    :param in1: R1 file name, for the error message.
+    :param in2: R2 file name, for the error message.
+    :return: generator of (read1 record, read2 record) tuples.
+    :raises ValueError: when one file has more reads than the other.
+    """
+    for r1 in records1:
+        r2 = next(records2, None)
+        if r2 is None:
+            raise ValueError("%s has more reads than %s" % (in1, in2))
+        yield r1, r2
+    if next(records2, None) is not None:
+        raise ValueError("%s has more reads than %s" % (in2, in1))
+
+
+def subsample_size():
+    """
+    Number of reads (pairs) kept of each sample by --subsample:
+    --subsample_factor times the sampling depth (-e).
+
+    :rtype: int
+    """
+    return int(math.ceil(PR['subsample_factor'] * PR['depth']))
+
+
+def reservoir_sample(records, size, sample):
+    """
+    Uniform random sample of the records of a stream in one pass
+    (reservoir sampling), only size records are held in memory. The random
+    generator is seeded with --seed and the sample name so a sample keeps
+    the same reads in every run.
+
+    :param records: iterable of records.
+    :param size: number of records kept.
+    :type size: int
+    :param sample: sample name.
+    :return: list of the kept records in their original order.
+    """
+    rng = random.Random(int(hashlib.sha1(("%d:%s" % (PR['seed'], sample)).encode("utf-8")).hexdigest()[:16], 16))
+    reservoir = []
+    for i, record in enumerate(records):
+        if i < size:
+            reservoir.append((i, record))
+        else:
+            j = int(rng.random() * (i + 1))
+            if j < size:
+                reservoir[j] = (i, record)
+    reservoir.sort(key=lambda x: x[0])
+    return [record for _, record in reservoir]
+
+
+def subsample_pairs(in1, in2, out1, out2):
+    """
+    Write reservoir_sample() of the read pairs of a sample, --subsample
+    input.
+
+    :return: None
+    """
+    infq1 = open_fastq(in1, "r")
+    infq2 = open_fastq(in2, "r")
+    pairs = reservoir_sample(zip_pairs(read_fastq(infq1), read_fastq(infq2), in1, in2), subsample_size(), sample_name(in1))
+    infq1.close()
+    infq2.close()
+    outfq1 = open(out1, "wb")
+    outfq2 = open(out2, "wb")
+    for r1, r2 in pairs:
+        outfq1.writelines(r1)
+        outfq2.writelines(r2)
+    outfq1.close()
+    outfq2.close()
+
+
+def subsample_fasta(filename, sample):
+    """
+    Replace a fasta file by reservoir_sample() of its reads, --subsample qc.
+
+    :return: None
+    """
+    infa = open(filename, "rb")
+    records = reservoir_sample(read_fasta(infa), subsample_size(), sample)
+    infa.close()
+    outfa = open(filename + ".tmp", "wb")
+    write_fasta(outfa, records)
+    outfa.close()
+    os.rename(filename + ".tmp", filename)
+
+
 def remove_short_reads(infqfile, outfqfile, length):
     """
 
@@ -59,17 +651,19 @@ def remove_short_reads(infqfile, outfqfile, length):
     @Action: filter fastq files removing short reads
 
     """
-    infq = open(infqfile, "r")
-    outfq = open(outfqfile, "w")
-    lines = infq.readlines()
-    for a, b, c, d in zip(lines[0::4], lines[1::4], lines[2::4], lines[3::4]):
-        if len(b) > length:
-            outfq.write(a)
-            outfq.write(b)
-            outfq.write(c)
-            outfq.write(d)
-
-    infq.close()
+    outfq = open_fastq(outfqfile, "w")
+    if numpy is None or infqfile.endswith(".gz"):
+        infq = open_fastq(infqfile, "r")
+        write_fastq(outfq, (r for r in read_fastq(infq) if len(r[1]) > length))
+        infq.close()
+    else:
+        for data, lines in fastq_blocks(infqfile):
+            starts = line_starts(lines)
+            keep = numpy.concatenate(([0], lines[:, 1] - starts[:, 1] > length, [0])).astype(numpy.int8)
+            bounds = numpy.append(starts[:, 0], len(data))
+            # the kept records are written in runs of consecutive records
+            for first, last in numpy.flatnonzero(numpy.diff(keep)).reshape(-1, 2):
+                outfq.write(buffer(data, bounds[first], bounds[last] - bounds[first]))
     outfq.close()
 
 
@@ -88,6 +682,217 @@ def asfolder(folder):
         return (folder)
 
 
+# external commands running in this process, killed by cancel_commands()
+RUNNING = set()
+RUNNING_LOCK = threading.Lock()
+CANCELLED = threading.Event()
+
+LOG_BACKUPS = 5  # rotated log files kept, log.txt.1 ... log.txt.5
+PROGRESS_INTERVAL = 60  # seconds between two progress reports
+
+PROFILE = threading.local()  # the step running in this thread, see start_step()
+RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", 1)  # linux value, python 2 does not define it
+PROFILE_FIELDS = ["kind", "stage", "sample", "name", "wall", "user", "sys", "maxrss_kb",
+                  "bytes_in", "bytes_out", "reads_in", "reads_out"]
+
+
+def sample_name(filename):
+    """
+    Sample name of a fastq or fasta file, "A" for A_L001_R1_001.fastq.gz.
+
+    :param filename: file name.
+    :rtype: str
+    """
+    return sub("(_L001_R[12]_001)?\\.(fastq|fasta)(\\.gz)?$", "", os.path.basename(filename))
+
+
+def count_reads(filename):
+    """
+    Number of reads of a fastq or fasta file.
+
+    :param filename: file name, may be gzip compressed.
+    :return: number of reads, None for other and missing files.
+    """
+    name = sub("\\.gz$", "", filename)
+    if filename in RANGES:
+        return RANGES[filename][4]
+    if not os.path.isfile(filename):
+        return None
+    if name.endswith((".fastq", ".fq")) and numpy is not None and not filename.endswith(".gz"):
+        return len(fastq_index(filename, save=False)) - 1
+    f = open_fastq(filename, "r")
+    if name.endswith((".fastq", ".fq")):
+        n = sum(block.count(b"\n") for block in iter(lambda: f.read(1 << 20), b"")) // 4
+    elif name.endswith((".fasta", ".fna", ".fa")):
+        n = sum(1 for line in f if line.startswith(b">"))
+    else:
+        n = None
+    f.close()
+    return n
+
+
+def sum_files(filenames, measure):
+    """
+    Sum of measure(filename) over the files, None when it is None for all
+    of them.
+    """
+    values = [measure(f) for f in filenames]
+    values = [v for v in values if v is not None]
+    return sum(values) if values else None
+
+
+def file_size(filename):
+    if filename in RANGES:
+        return RANGES[filename][2] - RANGES[filename][1]
+    if os.path.isfile(filename):
+        return os.path.getsize(filename)
+    return None
+
+
+def thread_times():
+    """
+    (user, system) CPU seconds used by the calling thread.
+    """
+    usage = resource.getrusage(RUSAGE_THREAD)
+    return usage.ru_utime, usage.ru_stime
+
+
+def record_profile(record):
+    """
+    Append one record to others/profile.jsonl, one line per record so the
+    processes of the pools can write to the same file, see write_profile().
+
+    :param record: dict with the PROFILE_FIELDS.
+    :return: None
+    """
+    fd = os.open(PR['others'] + "profile.jsonl", os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    os.write(fd, (json.dumps(record, sort_keys=True) + "\n").encode("utf-8"))
+    os.close(fd)
+
+
+def tally(records, counts, key):
+    """
+    Pass the records on, counting them in counts[key].
+    """
+    counts[key] = 0
+    for record in records:
+        counts[key] += 1
+        yield record
+
+
+def report_reads(reads_in=None, reads_out=None):
+    """
+    Give the profile of the step running in this thread the number of reads
+    of its inputs and outputs, counted by the step while it reads and
+    writes them, see finish_step().
+
+    :return: None
+    """
+    step = getattr(PROFILE, "step", None)
+    if step is None:
+        return
+    if reads_in is not None:
+        step["reads_in"] = reads_in
+    if reads_out is not None:
+        step["reads_out"] = reads_out
+
+
+def start_step(stage, inputs, sample=None):
+    """
+    Start the profile of one step of one sample, the commands run by
+    execute() in the same thread are added to it, see finish_step().
+    The size of the inputs is read now, before the step can remove them,
+    and their number of reads with --count_reads. The inputs must be there,
+    see check_inputs().
+
+    :param stage: name of the step.
+    :param inputs: input file names.
+    :param sample: sample name [default: from the first input].
+    :return: the profile of the step.
+    :rtype: dict
+    """
+    check_inputs(inputs)
+    if sample is None:
+        sample = sample_name(inputs[0])
+    step = {"kind": "step", "stage": stage, "sample": sample, "name": stage,
+            "bytes_in": sum_files(inputs, file_size), "reads_in": None, "reads_out": None,
+            "user": 0.0, "sys": 0.0, "maxrss_kb": None, "_start": time.time(), "_cpu": thread_times()}
+    if PR['count_reads']:
+        step["reads_in"] = sum_files(inputs, count_reads)
+    PROFILE.step = step
+    return step
+
+
+def finish_step(step, outputs):
+    """
+    Record the profile of a step: wall time, CPU time of the thread and of
+    the commands it ran, peak RSS of the commands, size of the inputs and
+    outputs. The peak RSS of the python steps is not recorded, the steps
+    running in the same process can not be told apart.
+
+    The number of reads are the ones given by report_reads(), the steps
+    running in python count them as they go. The files are read again to
+    count them with --count_reads only.
+
+    :param step: see start_step().
+    :param outputs: output file names.
+    :return: None
+    """
+    user, system = thread_times()
+    step["wall"] = time.time() - step.pop("_start")
+    start_user, start_system = step.pop("_cpu")
+    step.pop("_failed", None)
+    step["user"] += user - start_user
+    step["sys"] += system - start_system
+    step["bytes_out"] = sum_files(outputs, file_size)
+    if step["reads_out"] is None and PR['count_reads']:
+        step["reads_out"] = sum_files(outputs, count_reads)
+    PROFILE.step = None
+    record_profile(step)
+
+
+def command_label(command):
+    """
+    Short name of a command for the log and the progress report: the tool
+    and the first file it reads, "fastq-join A_L001_R1_001.fastq".
+
+    :param command: command line.
+    :type command: str
+    :rtype: str
+    """
+    words = command.split()
+    for word in words[1:]:
+        name = word.split("=")[-1]
+        if os.sep in name:
+            return "%s %s" % (os.path.basename(words[0]), os.path.basename(name.rstrip(os.sep)))
+    return os.path.basename(words[0])
+
+
+def log_output(pipe, level, label, budget):
+    """
+    Log the lines of the output of a command as they come, used by
+    execute(). The lines over the size budget of the command are counted
+    but not logged.
+
+    :param pipe: stdout or stderr of the command.
+    :param level: logging level of the lines.
+    :param label: see command_label().
+    :param budget: [bytes left] list shared by stdout and stderr.
+    :return: None
+    """
+    dropped = 0
+    for line in iter(pipe.readline, b""):
+        budget[0] -= len(line)
+        if budget[0] < 0:
+            dropped += 1
+            continue
+        line = line.rstrip().decode("utf-8", "replace")
+        logging.log(level, ("%s: %s" % (label, line)).encode("utf-8"), extra={"command": label})
+    pipe.close()
+    if dropped:
+        logwarning("%s: %d lines of output over --command_log_size were not logged" % (label, dropped))
+
+
 def execute(command, shell=True):
     """
     Execute command using os package and return output to log file
@@ -99,14 +904,92 @@ def execute(command, shell=True):
     :return: Run the command in the background and save the
     output to the logging file.
 
+    The output is logged line by line while the command runs, stdout as
+    info and stderr as warnings, up to --command_log_size per command.
+    A non-zero exit code raises RuntimeError in the per-sample steps, so
+    run_pool() and run_dag() stop the step at the first failed sample. In
+    the steps run on all samples it is logged as a warning, with
+    --fail_fast it raises too. No command starts after cancel_commands().
     """
+    if CANCELLED.is_set():
+        raise RuntimeError("cancelled: %s" % command)
     loginfo(command)
-    p = Popen(command.split(), stderr=PIPE, stdout=PIPE)
-    output, error = p.communicate()
-    if output != b"":
-        loginfo(output.encode('utf-8'))
-    if error != b"":
-        logwarning(error.encode('utf-8'))
+    label = command_label(command)
+    # in its own process group, cancel_commands() kills the processes the command starts too;
+    # without the files other threads opened, a fifo of run_batch() would not see its end
+    p = Popen(command.split(), stderr=PIPE, stdout=PIPE, close_fds=True, preexec_fn=os.setsid)
+    with RUNNING_LOCK:
+        RUNNING.add(p)
+    start = time.time()
+    try:
+        budget = [PR['command_log_size'] * 1024]
+        errors = threading.Thread(target=log_output, args=(p.stderr, logging.WARNING, label, budget))
+        errors.start()
+        log_output(p.stdout, logging.INFO, label, budget)
+        errors.join()
+        _, status, usage = os.wait4(p.pid, 0)
+        if os.WIFSIGNALED(status):
+            p.returncode = -os.WTERMSIG(status)
+        else:
+            p.returncode = os.WEXITSTATUS(status)
+    finally:
+        with RUNNING_LOCK:
+            RUNNING.discard(p)
+    step = getattr(PROFILE, "step", None)
+    # the usage includes the processes started by the command, bytes are block I/O
+    record_profile({"kind": "command", "stage": step and step["stage"], "sample": step and step["sample"],
+                    "name": label, "wall": time.time() - start, "user": usage.ru_utime, "sys": usage.ru_stime,
+                    "maxrss_kb": usage.ru_maxrss, "bytes_in": usage.ru_inblock * 512,
+                    "bytes_out": usage.ru_oublock * 512, "reads_in": None, "reads_out": None})
+    if step is not None:
+        step["user"] += usage.ru_utime
+        step["sys"] += usage.ru_stime
+        step["maxrss_kb"] = max(step["maxrss_kb"] or 0, usage.ru_maxrss)
+    if step is not None and p.returncode != 0:
+        step["_failed"] = True
+    message = "%s: exited with code %d" % (label, p.returncode)
+    logging.log(logging.INFO if p.returncode == 0 else logging.WARNING, message.encode('utf-8'),
+                extra={"command": label, "finished": True})
+    if p.returncode != 0 and (PR['fail_fast'] or step is not None and step["sample"] != "all"):
+        raise RuntimeError(message)
+
+
+def cancel_commands():
+    """
+    Kill the external commands started by execute() in this process, with
+    the processes they started (the java of bbduk.sh, ...), and refuse new
+    ones, used when a sample fails to stop the other samples of the step.
+    The workers of a process pool do the same when the pool is terminated,
+    see init_worker().
+
+    :return: None
+    """
+    CANCELLED.set()
+    with RUNNING_LOCK:
+        for p in RUNNING:
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+def stop_worker(signum, frame):
+    """
+    SIGTERM handler of the workers of a process pool: kill their commands
+    and exit.
+    """
+    cancel_commands()
+    os._exit(1)
+
+
+def init_worker():
+    """
+    Initializer of the workers of a process pool, terminate() sends them
+    SIGTERM, which would leave the commands they started running.
+
+    :return: None
+    """
+    signal.signal(signal.SIGTERM, stop_worker)
 
 
 def loginfo(message):
@@ -124,6 +1007,89 @@ def logwarning(message):
     logging.warning(message.encode('utf-8'))
 
 
+class QueueHandler(logging.Handler):
+    """
+    Put the log records on a queue read by a LogListener, the samples do
+    not wait for the log file and the processes of the pools share the
+    same rotating log file.
+    """
+
+    def __init__(self, records):
+        logging.Handler.__init__(self)
+        self.records = records
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            record.exc_info = None
+            self.records.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+class LogListener(threading.Thread):
+    """
+    Write the records of a QueueHandler with handler. The last line of
+    each running command is kept and printed every PROGRESS_INTERVAL
+    seconds as the progress of its sample.
+    """
+
+    def __init__(self, records, handler):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.records = records
+        self.handler = handler
+        self.progress = {}
+
+    def run(self):
+        reported = time.time()
+        while True:
+            try:
+                record = self.records.get(timeout=1)
+            except queue.Empty:
+                record = False
+            if record is None:
+                break
+            if record:
+                self.handler.handle(record)
+                label = getattr(record, "command", None)
+                if getattr(record, "finished", False):
+                    self.progress.pop(label, None)
+                elif label is not None:
+                    self.progress[label] = record.getMessage()
+            if self.progress and time.time() - reported >= PROGRESS_INTERVAL:
+                reported = time.time()
+                print("\nRunning:")
+                for label in sorted(self.progress):
+                    print("  %s" % self.progress[label][:120])
+
+    def stop(self):
+        self.records.put(None)
+        self.join()
+        self.handler.close()
+
+
+def start_logging(filename):
+    """
+    Log to filename through a queue, see QueueHandler and LogListener.
+    The file is rotated when it reaches --log_size MB.
+
+    :param filename: log file name.
+    :return: None
+    """
+    records = ProcessQueue()
+    handler = RotatingFileHandler(filename, maxBytes=int(PR['log_size'] * 1024 * 1024),
+                                  backupCount=LOG_BACKUPS)
+    handler.setFormatter(logging.Formatter('%(levelname)s \n %(message)s'))
+    listener = LogListener(records, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(records))
+    root.setLevel(logging.DEBUG)
+
+
 def get_configuration():
     global PR
     cp = configparser.ConfigParser()
@@ -187,8 +1153,72 @@ def check_before_start():
         if not condition:
             raise IOError("Can not find greengenes database files, "
                           "please check the configuration file: %s to set up the correct folder" % PR['ConfigFile'])
-    if os.path.isdir(PR['out_folder']):
+    if PR['trimmer'] == "numpy" and numpy is None:
+        raise ImportError("numpy is required for --trimmer numpy")
+    if PR['joining_method'] == "native" and numpy is None:
+        raise ImportError("numpy is required for -j native")
+    if PR['streaming'] and (PR['trimmer'] == "bbduk" or PR['adapter_ref'] is not None or
+                            PR['joining_method'] != "native" or PR['qc_method'] != "native"):
+        raise ValueError("--streaming needs --trimmer fused or numpy, -j native and --qc_method native, "
+                         "and can not be used with --adapter")
+    if os.path.isdir(PR['out_folder']) and not PR['resume']:
         raise IOError("Output folder exists, Please use a non existent folder name")
+    if PR['add_to'] is not None:
+        if PR['beginwith'] is not None or PR['stop_at'] is not None:
+            raise ValueError("--add_to can not be used with -b or -s")
+        otus = asfolder(asfolder(PR['add_to']) + PR['Fotus'])
+        for name in ["new_refseqs.fna", "otu_table_mc2_w_tax.biom"]:
+            if not os.path.isfile(otus + name):
+                raise IOError("%s is not an output folder of a full analysis, %s does not exist"
+                              % (PR['add_to'], otus + name))
+
+
+def available_memory():
+    """
+    Memory available for the run in MB, MemAvailable of /proc/meminfo or
+    the physical memory when it can not be read.
+
+    :rtype: int
+    """
+    try:
+        for line in open("/proc/meminfo"):
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) // 1024
+    except IOError:
+        pass
+    return os.sysconf(str("SC_PAGE_SIZE")) * os.sysconf(str("SC_PHYS_PAGES")) // (1024 * 1024)
+
+
+def allocate_resources():
+    """
+    Share -n cores and the memory between the workers of the per-sample
+    steps and the tools they start, so that the threads and the java heaps
+    of all running tools fit the machine.
+
+    bbduk.sh and bbmerge.sh start a multi-threaded JVM, their steps run
+    jvm_workers samples at a time, each tool gets tool_threads threads and
+    tool_memory MB of heap (at least 1000 MB, the heap auto-q always used).
+    The other tools and the python steps use one core per sample.
+    pick_open_reference_otus.py gets the -n jobs.
+
+    :return: None
+    """
+    global PR
+    cores = PR['number_of_cores']
+    if PR['memory'] is None:
+        memory = int(available_memory() * 0.8)
+    else:
+        memory = int(PR['memory'] * 1024)
+    PR['jvm_workers'] = max(1, min(cores, memory // 1000))
+    PR['tool_threads'] = max(1, cores // PR['jvm_workers'])
+    PR['tool_memory'] = max(1000, min(memory // PR['jvm_workers'], 31000))
+    report = ("Resources: %d cores, %d MB of memory\n"
+              "    python and single threaded tools: %d samples at a time\n"
+              "    bbduk.sh/bbmerge.sh: %d samples at a time, %d threads and %d MB heap each\n"
+              "    pick_open_reference_otus.py: %d jobs"
+              % (cores, memory, cores, PR['jvm_workers'], PR['tool_threads'], PR['tool_memory'], cores))
+    print(report)
+    loginfo(report)
 
 
 def write_parameter_file(parameter_file):
@@ -263,240 +1293,2431 @@ def primertrim(infqfile, outfqfile, length):
     :param length:
     :return:
     """
-    if infqfile.endswith(".gz"):
-        infq = gzip.open(infqfile, "r")
-    else:
-        infq = open(infqfile, "r")
-    if outfqfile.endswith(".gz"):
-        outfq = gzip.open(outfqfile, "w")
-    else:
-        outfq = open(outfqfile, "w")
-    lines = infq.readlines()
-    for a, b, c, d in zip(lines[0::4], lines[1::4], lines[2::4], lines[3::4]):
-        outfq.write(a)
-        outfq.write(b[length:])
-        outfq.write(c)
-        outfq.write(d[length:])
+    outfq = open_fastq(outfqfile, "w")
+    if numpy is None or infqfile.endswith(".gz"):
+        infq = open_fastq(infqfile, "r")
+        write_fastq(outfq, ((a, b[length:], c, d[length:])
+                            for a, b, c, d in read_fastq(infq)))
+        infq.close()
+    else:
+        for data, lines in fastq_blocks(infqfile):
+            starts = line_starts(lines)
+            # the first length bytes of the sequence and quality lines, as b[length:]
+            cuts = numpy.minimum(lines - starts, length)
+            keep = cut_prefixes(len(data), starts[:, [1, 3]].ravel(), cuts[:, [1, 3]].ravel(), length)
+            outfq.write(data[keep].tobytes())
+    outfq.close()
+
+
+ERROR_PROBABILITY = [10 ** (-q / 10.0) for q in range(94)]
+
+
+def quality_trim_point(quality, trimq, offset=33):
+    """
+    Right end quality trimming using the error probability of the bases,
+    the rule bbduk uses with -qtrim=r -trimq=N: the kept part is the
+    prefix with the highest sum of (error rate at trimq - error rate of base).
+
+    :param quality: quality string of the read without the line ending.
+    :type quality: str
+    :param trimq: phred quality threshold.
+    :type trimq: int
+    :param offset: phred offset of the quality string.
+    :type offset: int
+    :return: number of bases to keep.
+    :rtype: int
+    """
+    limit = ERROR_PROBABILITY[trimq]
+    best = 0.0
+    score = 0.0
+    keep = 0
+    for i, q in enumerate(bytearray(quality)):
+        score += limit - ERROR_PROBABILITY[q - offset]
+        if score >= best:
+            best = score
+            keep = i + 1
+    return keep
+
+
+def trim_record(record, length, trimq):
+    """
+    Clip the primer and quality trim the right end of one fastq record.
+
+    :param record: (header, sequence, plus, quality) tuple.
+    :param length: primer length to remove from the start of the read.
+    :type length: int
+    :param trimq: phred quality threshold.
+    :type trimq: int
+    :return: trimmed record.
+    """
+    a, b, c, d = record
+    d = d.rstrip()[length:]
+    keep = quality_trim_point(d, trimq)
+    return a, b.rstrip()[length:length + keep] + b"\n", c, d[:keep] + b"\n"
+
+
+def fused_trim(pairs, ftrim, rtrim, trimq, minlength):
+    """
+    Primer clipping, right end quality trimming and length filtering of
+    read pairs in one pass.
+
+    :param pairs: iterable of (read1 record, read2 record) tuples.
+    :param ftrim: forward primer length.
+    :type ftrim: int
+    :param rtrim: reverse primer length.
+    :type rtrim: int
+    :param trimq: phred quality threshold.
+    :type trimq: int
+    :param minlength: pairs are removed if either read becomes shorter.
+    :type minlength: int
+    :return: generator of trimmed pairs.
+    """
+    for r1, r2 in pairs:
+        r1 = trim_record(r1, ftrim, trimq)
+        r2 = trim_record(r2, rtrim, trimq)
+        if len(r1[1]) > minlength and len(r2[1]) > minlength:
+            yield r1, r2
+
+
+def read_batches(records, size):
+    """
+    Group records into lists of a fixed size.
+
+    :param records: iterable of records.
+    :param size: number of records in each batch.
+    :type size: int
+    :return: generator of lists.
+    """
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def char_matrix(strings, pad):
+    """
+    Pack strings into a padded uint8 matrix, one row per string.
+
+    :param strings: list of strings without line endings.
+    :param pad: character used to fill the end of the short rows.
+    :type pad: bytes
+    :return: (uint8 matrix of shape strings x longest string, array of lengths)
+    """
+    lengths = numpy.array([len(x) for x in strings], dtype=numpy.int64)
+    width = max(lengths.max(), 1)
+    chars = numpy.frombuffer(b"".join(x.ljust(width, pad) for x in strings),
+                             dtype=numpy.uint8).reshape(len(strings), width)
+    return chars, lengths
+
+
+def quality_matrix(qualities, offset=33):
+    """
+    Decode quality strings into a padded matrix of phred scores.
+
+    :param qualities: list of quality strings without line endings.
+    :param offset: phred offset of the quality strings.
+    :type offset: int
+    :return: (uint8 matrix of shape reads x longest read, array of lengths)
+    """
+    chars, lengths = char_matrix(qualities, b"~")
+    return numpy.minimum(chars - numpy.uint8(offset), 93), lengths
+
+
+def quality_trim_points(quals, lengths, trimq):
+    """
+    Vectorized quality_trim_point() for a batch of reads.
+
+    :param quals: uint8 matrix of phred scores from quality_matrix().
+    :param lengths: lengths of the reads.
+    :param trimq: phred quality threshold.
+    :type trimq: int
+    :return: array with the number of bases to keep of every read.
+    """
+    table = numpy.array(ERROR_PROBABILITY)
+    score = numpy.cumsum(table[trimq] - table[quals], axis=1)
+    score[numpy.arange(quals.shape[1]) >= lengths[:, None]] = -numpy.inf
+    # the longest prefix with the highest score, as in quality_trim_point()
+    keep = quals.shape[1] - numpy.argmax(score[:, ::-1], axis=1)
+    keep[score[numpy.arange(len(keep)), keep - 1] < 0] = 0
+    return keep
+
+
+def numpy_trim(pairs, ftrim, rtrim, trimq, minlength, batch_size=5000):
+    """
+    Same as fused_trim() but the quality trimming is computed with numpy on
+    batches of read pairs.
+
+    :param pairs: iterable of (read1 record, read2 record) tuples.
+    :param ftrim: forward primer length.
+    :type ftrim: int
+    :param rtrim: reverse primer length.
+    :type rtrim: int
+    :param trimq: phred quality threshold.
+    :type trimq: int
+    :param minlength: pairs are removed if either read becomes shorter.
+    :type minlength: int
+    :param batch_size: number of read pairs decoded together.
+    :type batch_size: int
+    :return: generator of trimmed pairs.
+    """
+    for batch in read_batches(pairs, batch_size):
+        trimmed = []
+        for reads, length in ((r1 for r1, _ in batch), ftrim), ((r2 for _, r2 in batch), rtrim):
+            reads = [(a, b.rstrip()[length:], c, d.rstrip()[length:]) for a, b, c, d in reads]
+            keep = quality_trim_points(*quality_matrix([r[3] for r in reads]), trimq=trimq)
+            trimmed.append([(a, b[:k] + b"\n", c, d[:k] + b"\n")
+                            for (a, b, c, d), k in zip(reads, keep.tolist())])
+        for r1, r2 in zip(*trimmed):
+            if len(r1[1]) > minlength and len(r2[1]) > minlength:
+                yield r1, r2
+
+
+# minimum overlap of the mergers applying --ml (-m of fastq-join, mino of find_overlaps())
+MERGE_MIN_OVERLAP = {"fastq-join": 6, "native": 6}
+
+
+def premerge_length():
+    """
+    Shortest trimmed read pair (bases of R1 and R2) that can still be merged
+    into a read of --ml bases: a merged read is at most as long as the two
+    reads minus the minimum overlap of the merger.
+
+    :return: length, 0 when the merger does not apply --ml (bbmerge).
+    :rtype: int
+    """
+    if PR['joining_method'] not in MERGE_MIN_OVERLAP or not PR['minimum_length']:
+        return 0
+    return PR['minimum_length'] + MERGE_MIN_OVERLAP[PR['joining_method']]
+
+
+def premerge_filter(pairs, length, counts):
+    """
+    Remove the trimmed pairs shorter than length (see premerge_length()),
+    they would be removed by --ml after merging.
+
+    :param pairs: trimmed read pairs, see fused_trim().
+    :param length: minimum number of bases of the two reads.
+    :type length: int
+    :param counts: dict, the removed pairs are counted in counts["dropped"].
+    :return: generator of the kept pairs.
+    """
+    counts["dropped"] = 0
+    for r1, r2 in pairs:
+        # the sequence lines end with a line ending, except the last line of a file
+        if len(r1[1]) + len(r2[1]) - 2 < length and \
+                len(r1[1].rstrip()) + len(r2[1].rstrip()) < length:
+            counts["dropped"] += 1
+            continue
+        yield r1, r2
+
+
+def fusedtrim(in1, in2, out1, out2, trimq, ftrim=True):
+    """
+    In-process replacement of primertrim + bbduk.sh -qtrim=r, only the
+    final trimmed pair is written. The quality trimming is done with
+    numpy_trim() when --trimmer is numpy. The pairs too short to pass --ml
+    after merging are not written, see premerge_filter().
+
+    :param in1: input R1 fastq file name.
+    :param in2: input R2 fastq file name.
+    :param out1: output R1 fastq file name.
+    :param out2: output R2 fastq file name.
+    :param trimq: phred quality threshold.
+    :type trimq: int
+    :param ftrim: remove primers.
+    :type ftrim: bool
+    :return: None
+    """
+    if ftrim:
+        flength, rlength = PR['primertrim_forward'], PR['primertrim_reverse']
+    else:
+        flength, rlength = 0, 0
+    infq1 = open_fastq(in1, "r")
+    infq2 = open_fastq(in2, "r")
+    outfq1 = open_fastq(out1, "w")
+    outfq2 = open_fastq(out2, "w")
+    counts = {}
+    pairs = tally(zip_pairs(read_fastq(infq1), read_fastq(infq2), in1, in2), counts, "in")
+    if PR['subsample'] == "input":
+        pairs = reservoir_sample(pairs, subsample_size(), sample_name(in1))
+    if PR['trimmer'] == "numpy":
+        trim_pairs = numpy_trim
+    else:
+        trim_pairs = fused_trim
+    n = 0
+    for r1, r2 in premerge_filter(trim_pairs(pairs, flength, rlength, trimq, PR['min_read_length']),
+                                  premerge_length(), counts):
+        outfq1.writelines(r1)
+        outfq2.writelines(r2)
+        n += 1
+    for f in (infq1, infq2, outfq1, outfq2):
+        f.close()
+    report_reads(2 * counts["in"], 2 * n)
+    if counts["dropped"]:
+        loginfo("trimming: %d read pairs of %s too short for --ml after merging dropped before merging"
+                % (counts["dropped"], sample_name(in1)))
+
+
+GZIP_RATIO = 4.0
+
+
+def estimate_cost(filenames):
+    """
+    Estimated amount of work of a sample: the uncompressed size of its
+    files. The size of a gzip file is read from its trailer, when the
+    trailer can not be trusted (files over 4 GB, multi-member files) the
+    compressed size is multiplied by GZIP_RATIO.
+
+    :param filenames: list of the input files of the sample.
+    :return: estimated size in bytes.
+    :rtype: float
+    """
+    cost = 0.0
+    for filename in filenames:
+        size = os.path.getsize(filename)
+        if filename.endswith(".gz") and size >= 18:
+            f = open(filename, "rb")
+            f.seek(-4, os.SEEK_END)
+            isize = struct.unpack(str("<I"), f.read(4))[0]
+            f.close()
+            cost += isize if isize >= size else size * GZIP_RATIO
+        else:
+            cost += size
+    return cost
+
+
+def timed_call(args):
+    """
+    Call function(*item) and return how long it took, used by run_pool().
+
+    :param args: (function, item) tuple.
+    :return: seconds
+    :rtype: float
+    """
+    function, item = args
+    start = time.time()
+    function(*item)
+    return time.time() - start
+
+
+def use_processes(python_step):
+    """
+    Whether a per-sample step runs on processes or on threads, see
+    --executor. Threads are enough for the steps waiting on external tools,
+    the steps doing their work in python need processes to use more than
+    one core.
+
+    :param python_step: the step runs python code (primertrim, the native
+    engines, ...).
+    :type python_step: bool
+    :rtype: bool
+    """
+    return PR['executor'] == "processes" or (PR['executor'] == "auto" and python_step)
+
+
+def make_pool(workers, python_step):
+    """
+    Pool of processes or threads for a per-sample step, see use_processes().
+
+    :param workers: size of the pool.
+    :type workers: int
+    :param python_step: the step runs python code.
+    :type python_step: bool
+    """
+    if use_processes(python_step):
+        return ProcessPool(workers, init_worker)
+    return Pool(workers)
+
+
+def run_pool(p, function, items, costs, stage, workers=None):
+    """
+    Map function over items on a pool, the items with the highest cost
+    start first so a large sample does not hold the end of the step.
+    The makespan of the step is logged next to the ideal one, the larger of
+    the longest item and the total time divided by the number of workers.
+    The first failing item stops the step: the pool is terminated, the
+    running commands are killed and the error is raised.
+
+    :param p: thread or process pool, closed when the step is finished.
+    :param function: called with the arguments of each item.
+    :param items: list of argument tuples, one per sample.
+    :param costs: estimated cost of each item, see estimate_cost().
+    :param stage: name of the step for the log.
+    :type stage: str
+    :param workers: size of the pool [default: number of cores].
+    :return: None
+    """
+    if workers is None:
+        workers = PR['number_of_cores']
+    order = sorted(range(len(items)), key=lambda i: -costs[i])
+    CANCELLED.clear()
+    start = time.time()
+    durations = []
+    try:
+        for duration in p.imap_unordered(timed_call, [(function, items[i]) for i in order], chunksize=1):
+            durations.append(duration)
+    except Exception:
+        cancel_commands()
+        p.terminate()
+        logwarning("%s: stopped after a failed sample" % stage)
+        raise
+    p.close()
+    p.join()
+    makespan = time.time() - start
+    record_profile({"kind": "stage", "stage": stage, "name": stage, "wall": makespan})
+    if durations:
+        ideal = max(max(durations), sum(durations) / workers)
+        loginfo("%s: makespan %.1f s, ideal %.1f s, %d samples on %d workers"
+                % (stage, makespan, ideal, len(items), workers))
+
+
+# external tools of the per-sample steps that can be split in chunks, see chunk_step()
+CHUNK_TOOLS = {"trimsample": ["bbduk.sh"], "nativemerge": [], "mergesample": ["fastq-join"],
+               "mergesamplebb": ["bbmerge.sh"]}
+
+
+def chunk_name(filename, n, stage, kind):
+    """
+    Name of the n-th chunk of an input (kind "in") or output (kind "out")
+    file of a step: others/chunks/stage/kind/cNNN_ followed by its name.
+    """
+    return PR['others'] + "chunks/%s/%s/c%03d_%s" % (stage, kind, n, os.path.basename(filename))
+
+
+def chunk_ranges(filenames):
+    """
+    Split the records of the fastq files of a sample (R1 and R2) into
+    chunks of about --chunk_size MB, the same records of every file, using
+    their .fqi indexes (see fastq_index()), saved for the input files only.
+
+    :param filenames: uncompressed fastq files with the same reads.
+    :return: list of the (start, end, records, block offsets) byte ranges,
+    number of records and block_offsets() of every file for each chunk,
+    None when the sample is not split: small or gzip files, one
+    worker, no numpy, removed files or files with different numbers of
+    records.
+    """
+    if numpy is None or PR['chunk_size'] <= 0 or PR['number_of_cores'] < 2:
+        return None
+    if any(f.endswith(".gz") or not os.path.isfile(f) for f in filenames):
+        return None
+    parts = int(math.ceil(sum(os.path.getsize(f) for f in filenames) / (PR['chunk_size'] * (1 << 20))))
+    if parts < 2:
+        return None
+    indexes = [fastq_index(f) for f in filenames]
+    if len(set(len(index) for index in indexes)) != 1:
+        return None
+    records = len(indexes[0]) - 1
+    # the chunks end at evenly spaced bytes of the first file
+    cuts = numpy.searchsorted(indexes[0], numpy.linspace(0, int(indexes[0][-1]), parts + 1)[1:-1])
+    bounds = [0] + sorted(set(int(c) for c in cuts if 0 < c < records)) + [records]
+    return [[(int(index[a]), int(index[b]), b - a, block_offsets(index, a, b)) for index in indexes]
+            for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def copy_range(filename, start, end, out):
+    """
+    Copy the bytes [start, end) of a file to a new file.
+    """
+    f = open(filename, "rb")
+    f.seek(start)
+    o = open(out, "wb")
+    while start < end:
+        block = f.read(min(end - start, FQI_BLOCK))
+        if not block:
+            break
+        o.write(block)
+        start += len(block)
+    o.close()
+    f.close()
+
+
+def remove_chunk(filename):
+    """
+    Remove a chunk file and its manifest.
+    """
+    for name in (filename, manifest_file(filename)):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def chunk_step(function, stage, args, outputs):
+    """
+    Split one step of a large sample into chunks (see chunk_ranges()) that
+    run in parallel like samples, the outputs of the chunks are joined in
+    order by join_chunks(). Only the steps that handle every read (pair)
+    on its own are split: trimming and merging.
+
+    :param function: per-sample step, called with the two input files,
+    the output files and the other arguments.
+    :param stage: name of the step.
+    :param args: arguments of function.
+    :param outputs: number of output files in args.
+    :return: (jobs, join): the run_step() arguments of every job and the
+    join_chunks() arguments, join is None when the sample is not split.
+    There are no jobs when the split step is done in an earlier run.
+    """
+    inputs = list(args[:2])
+    outs = list(args[2:2 + outputs])
+    rest = list(args[2 + outputs:])
+    # the reads of a sample subsampled at input are drawn from all of its reads
+    if stage == "trimming" and PR['subsample'] == "input":
+        return [(function, args)], None
+    ranges = chunk_ranges(inputs)
+    if ranges is None:
+        return [(function, args)], None
+    key = step_key(stage, inputs, outs, {"function": function.__name__, "arguments": rest,
+                                         "chunks": [[r[:3] for r in chunk] for chunk in ranges]},
+                   CHUNK_TOOLS[function.__name__])
+    if completed(key, outs):
+        return [], None
+    for kind in ("in", "out") if not reads_in_python(function, args) else ("out",):
+        folder = os.path.dirname(chunk_name("", 0, stage, kind))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+    keys = [input_key(f) for f in inputs]
+    jobs = []
+    for n, r in enumerate(ranges):
+        chunk_args = tuple([chunk_name(f, n, stage, "in") for f in inputs] +
+                           [chunk_name(f, n, stage, "out") for f in outs] + rest)
+        jobs.append((function, chunk_args, (inputs, r, keys)))
+    parts = [[chunk_name(f, n, stage, "out") for n in range(len(ranges))] for f in outs]
+    loginfo("%s: %s split in %d chunks" % (stage, sample_name(inputs[0]), len(ranges)))
+    return jobs, (stage, inputs, outs, parts, key)
+
+
+def reads_in_python(function, args):
+    """
+    Whether a chunked step reads its inputs with open_fastq() or
+    fastq_blocks() rather than with an external tool, see CHUNK_TOOLS.
+    """
+    if function.__name__ == "trimsample":
+        # bbduk.sh reads the files of primertrim()
+        return PR['trimmer'] != "bbduk" and PR['adapter_ref'] is None or (args[5] if len(args) > 5 else True)
+    return not CHUNK_TOOLS[function.__name__]
+
+
+def run_step(function, args, chunk=None):
+    """
+    Run a per-sample step, on one chunk of its inputs when chunk is given:
+    (input files, byte ranges and records, input keys), see chunk_step().
+    The chunk inputs are registered in RANGES, so their key, size and
+    number of reads are known without reading them, and the python steps
+    read the byte ranges of the sample files in place. For the external
+    tools the records of the chunk are copied to the chunk input files
+    first.
+
+    :return: None
+    """
+    if chunk is None:
+        function(*args)
+        return
+    inputs, ranges, keys = chunk
+    parts = args[:len(inputs)]
+    in_place = reads_in_python(function, args)
+    for filename, (start, end, records, offsets), key, part in zip(inputs, ranges, keys, parts):
+        key = hashlib.sha1(("%s:%d:%d" % (key, start, end)).encode("utf-8")).hexdigest()
+        RANGES[part] = (filename, start, end, key, records, offsets)
+        if not in_place:
+            copy_range(filename, start, end, part)
+    try:
+        function(*args)
+    finally:
+        for part in parts:
+            RANGES.pop(part, None)
+            remove_chunk(part)
+
+
+def join_chunks(stage, inputs, outputs, parts, key):
+    """
+    Concatenate the outputs of the chunks of a sample in order (gzip
+    members can be concatenated) and remove them.
+
+    :return: None
+    """
+    # a chunk without a manifest failed, see write_manifests()
+    if not all(read_manifest(name) is not None for names in parts for name in names):
+        for names in parts:
+            for name in names:
+                remove_chunk(name)
+        logwarning("%s: a chunk of %s failed, not recorded as done" % (stage, sample_name(inputs[0])))
+        return
+    for out, names in zip(outputs, parts):
+        o = open(out, "wb")
+        for name in names:
+            f = open(name, "rb")
+            shutil.copyfileobj(f, o, FQI_BLOCK)
+            f.close()
+            remove_chunk(name)
+        o.close()
+    write_manifests(key, outputs)
+    if PR['remove_intermediate'] and stage == "merging":
+        for filename in inputs:
+            os.remove(filename)
+
+
+def run_chunked(p, function, items, costs, stage, outputs, workers=None, batch=None):
+    """
+    run_pool() with the large samples split into chunks, see chunk_step().
+    With --bb_batch above 1 the other samples are grouped in batches of
+    --bb_batch samples, each batch is one call of batch.
+
+    :param outputs: number of output files in the items.
+    :param batch: called with the items of a batch and the batch number,
+    see trimbatch().
+    :return: None
+    """
+    jobs = []
+    job_costs = []
+    joins = []
+    singles = []
+    for item, cost in zip(items, costs):
+        split, join = chunk_step(function, stage, item, outputs)
+        if join is None and batch is not None and PR['bb_batch'] > 1:
+            singles.extend((args, cost) for _, args in split)
+            continue
+        jobs.extend(split)
+        if join is None:
+            job_costs.extend([cost] * len(split))
+        else:
+            job_costs.extend([float(sum(r[1] - r[0] for r in job[2][1])) for job in split])
+            joins.append(join)
+    if singles:
+        # the largest samples are dealt over the batches in turn so the batches get a similar size
+        singles.sort(key=lambda single: -single[1])
+        count = int(math.ceil(len(singles) / float(PR['bb_batch'])))
+        for n in range(count):
+            group = singles[n::count]
+            jobs.append((batch, ([args for args, _ in group], n)))
+            job_costs.append(sum(cost for _, cost in group))
+    run_pool(p, run_step, jobs, job_costs, stage, workers)
+    for join in joins:
+        join_chunks(*join)
+
+
+def bb_ziplevel(out):
+    """
+    bbduk.sh/bbmerge.sh option setting the compression level of a .gz
+    output to --compress_level.
+    """
+    if out.endswith(".gz"):
+        return " -zl=%d" % PR['compress_level']
+    return ""
+
+
+def batch_name(stage, n, name):
+    """
+    Name of a file of the n-th batch of a step, see run_batch().
+    """
+    return PR['others'] + "batches/%s/b%03d_%s" % (stage, n, name)
+
+
+def tag_records(records, tag, length=0):
+    """
+    Prefix the read names with tag, the sample of the read in a batch, and
+    remove the first length bases (primer).
+    """
+    for a, b, c, d in records:
+        yield b"@" + tag + a[1:], b[length:], c, d[length:]
+
+
+def demultiplex(f, outputs, errors):
+    """
+    Write the reads of a batch output to the files of their samples
+    without the tags added by tag_records(). The pipe is read to its end
+    after an error so the tool writing it does not block.
+
+    :param f: batch output (fifo) open for reading.
+    :param outputs: open output files of the samples.
+    :param errors: list collecting the errors.
+    :return: None
+    """
+    try:
+        for a, b, c, d in read_fastq(f):
+            tag, name = a[1:].split(b"#", 1)
+            outputs[int(tag)].writelines((b"@" + name, b, c, d))
+    except Exception:
+        errors.append(traceback.format_exc())
+        for _ in iter(lambda: f.read(FQI_BLOCK), b""):
+            pass
+    f.close()
+
+
+def run_batch(stage, n, command, inputs, outputs, lengths=(0, 0)):
+    """
+    Run one bbduk.sh or bbmerge.sh for several samples: the reads of all
+    samples are written to one pair of files, the read names tagged with
+    the sample, the tool writes to fifos read while it runs and the reads
+    are written back to the output files of their samples.
+
+    :param stage: name of the step.
+    :param n: number of the batch.
+    :param command: command with %(in1)s, %(in2)s and %(out1)s
+    (%(out2)s) for the batch files.
+    :param inputs: (R1, R2) input files of each sample.
+    :param outputs: output files of each sample.
+    :param lengths: number of bases removed from the start of the R1 and R2
+    reads (primers).
+    :return: None
+    """
+    folder = os.path.dirname(batch_name(stage, n, ""))
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            pass
+    names = {}
+    for r, length in enumerate(lengths):
+        names["in%d" % (r + 1)] = batch_name(stage, n, "R%d.fastq" % (r + 1))
+        out = open(names["in%d" % (r + 1)], "wb")
+        for i, files in enumerate(inputs):
+            infq = open_fastq(files[r], "r")
+            write_fastq(out, tag_records(read_fastq(infq), b"%d#" % i, length))
+            infq.close()
+        out.close()
+    pipes = []
+    ends = []
+    for r in range(len(outputs[0])):
+        pipe = batch_name(stage, n, "out%d.fastq" % (r + 1))
+        if os.path.exists(pipe):
+            os.remove(pipe)
+        os.mkfifo(pipe)
+        names["out%d" % (r + 1)] = pipe
+        pipes.append(pipe)
+        # the fifo is held open for writing until the tool exits: the reader
+        # does not see the end before the tool opened it, nor wait forever
+        # when the tool failed without opening it
+        read = os.open(pipe, os.O_RDONLY | os.O_NONBLOCK)
+        ends.append(os.open(pipe, os.O_WRONLY))
+        fcntl.fcntl(read, fcntl.F_SETFL, fcntl.fcntl(read, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        # the tools of the other samples must not keep a write end: execute() and
+        # the pigz pipes start them with close_fds, which also covers the time
+        # before FD_CLOEXEC is set
+        for fd in (read, ends[-1]):
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        ends.append(os.fdopen(read, "rb"))
+    files = [[open_fastq(f, "w") for f in sample] for sample in outputs]
+    errors = []
+    readers = [threading.Thread(target=demultiplex, args=(ends[2 * r + 1], [sample[r] for sample in files], errors))
+               for r in range(len(pipes))]
+    for reader in readers:
+        reader.start()
+    try:
+        execute(command % names, shell=True)
+    finally:
+        for end in ends[::2]:
+            os.close(end)
+        for reader in readers:
+            reader.join()
+        for end in ends[1::2]:
+            end.close()
+        for sample in files:
+            for f in sample:
+                f.close()
+        for name in [names["in1"], names["in2"]] + pipes:
+            os.remove(name)
+    if errors:
+        raise RuntimeError("%s: batch %d: %s" % (stage, n, errors[0]))
+
+
+def trimsample(in1, in2, out1, out2, trimq, ftrim=True):
+    """
+    Trim one pair of fastq files.
+
+    :param in1: input R1 fastq file name.
+    :param in2: input R2 fastq file name.
+    :param out1: output R1 fastq file name.
+    :param out2: output R2 fastq file name.
+    :param trimq: phred quality threshold.
+    :type trimq: int
+    :param ftrim: remove primers.
+    :type ftrim: bool
+    :return: None
+    """
+    print("\n%s and %s" % (os.path.basename(in1), os.path.basename(in2)))
+    bbduk = PR['trimmer'] == "bbduk" or PR['adapter_ref'] is not None
+    key = step_key("trimming", [in1, in2], [out1, out2], {"trimq": trimq, "ftrim": ftrim},
+                   ["bbduk.sh"] if bbduk else [])
+    if completed(key, [out1, out2]):
+        return
+    step = start_step("trimming", [in1, in2])
+    # the primer trimmed files are read once by bbduk.sh, they are not compressed
+    out1_temp1 = os.path.join(os.path.dirname(out1), "temp1_" + sub("\\.gz$", "", os.path.basename(out1)))
+    out2_temp1 = os.path.join(os.path.dirname(out2), "temp1_" + sub("\\.gz$", "", os.path.basename(out2)))
+
+    if not bbduk:
+        fusedtrim(in1, in2, out1, out2, trimq, ftrim)
+        write_manifests(key, [out1, out2])
+        finish_step(step, [out1, out2])
+        return
+
+    if PR['subsample'] == "input":
+        sub1 = os.path.join(os.path.dirname(out1), "sub_" + sub("\\.gz$", "", os.path.basename(in1)))
+        sub2 = os.path.join(os.path.dirname(out2), "sub_" + sub("\\.gz$", "", os.path.basename(in2)))
+        subsample_pairs(in1, in2, sub1, sub2)
+        in1, in2 = sub1, sub2
+
+    # forctrimleft was added
+    if ftrim:
+        primertrim(in1, out1_temp1, PR['primertrim_forward'])
+        primertrim(in2, out2_temp1, PR['primertrim_reverse'])
+
+    else:
+        out1_temp1 = in1
+        out2_temp1 = in2
+
+    if PR['adapter_ref'] != None:
+
+        execute(
+            "bbduk.sh -Xmx%dm -threads=%d -in1=%s -in2=%s -out1=%s -out2=%s -outm=stdout.fa -ref=%s -qtrim=r -trimq=%d "
+            "-k=18 -ktrim=f%s" %
+            (PR['tool_memory'], PR['tool_threads'], out1_temp1, out2_temp1, out1, out2, PR['adapter_ref'], trimq,
+             bb_ziplevel(out1)),
+            shell=True)
+    else:
+        execute(
+            "bbduk.sh -Xmx%dm -threads=%d -in1=%s -in2=%s -out1=%s -out2=%s -qtrim=r -trimq=%d%s" %
+            (PR['tool_memory'], PR['tool_threads'], out1_temp1, out2_temp1, out1, out2, trimq, bb_ziplevel(out1)),
+            shell=True)
+
+    os.remove(out1_temp1)
+    os.remove(out2_temp1)
+    if PR['subsample'] == "input":
+        for filename in (in1, in2):
+            if os.path.exists(filename):
+                os.remove(filename)
+    write_manifests(key, [out1, out2])
+    finish_step(step, [out1, out2])
+
+
+def trimbatch(items, n):
+    """
+    Trim several samples with one bbduk.sh, see run_batch(). The primers
+    are removed while the batch files are written.
+
+    :param items: trimsample() arguments of each sample, with the same
+    trimq and ftrim.
+    :param n: number of the batch.
+    :return: None
+    """
+    todo = []
+    for in1, in2, out1, out2, trimq, ftrim in items:
+        key = step_key("trimming", [in1, in2], [out1, out2], {"trimq": trimq, "ftrim": ftrim}, ["bbduk.sh"])
+        if not completed(key, [out1, out2]):
+            todo.append((in1, in2, out1, out2, key))
+    if not todo:
+        return
+    trimq, ftrim = items[0][4:]
+    print("\nTrimming batch %d: %s" % (n, ", ".join(sample_name(x[0]) for x in todo)))
+    step = start_step("trimming", [f for x in todo for f in x[:2]], "batch%03d" % n)
+    if ftrim:
+        lengths = (PR['primertrim_forward'], PR['primertrim_reverse'])
+    else:
+        lengths = (0, 0)
+    inputs = [x[:2] for x in todo]
+    if PR['subsample'] == "input":
+        inputs = [(batch_name("trimming", n, "s%d_R1.fastq" % i), batch_name("trimming", n, "s%d_R2.fastq" % i))
+                  for i in range(len(todo))]
+        for x, (sub1, sub2) in zip(todo, inputs):
+            if not os.path.isdir(os.path.dirname(sub1)):
+                os.makedirs(os.path.dirname(sub1))
+            subsample_pairs(x[0], x[1], sub1, sub2)
+    command = "bbduk.sh -Xmx%dm -threads=%d -in1=%%(in1)s -in2=%%(in2)s -out1=%%(out1)s -out2=%%(out2)s" % (
+        PR['tool_memory'], PR['tool_threads'])
+    if PR['adapter_ref'] != None:
+        command += " -outm=stdout.fa -ref=%s -qtrim=r -trimq=%d -k=18 -ktrim=f" % (PR['adapter_ref'], trimq)
+    else:
+        command += " -qtrim=r -trimq=%d" % trimq
+    run_batch("trimming", n, command, inputs, [x[2:4] for x in todo], lengths)
+    if PR['subsample'] == "input":
+        for filename in [f for pair in inputs for f in pair]:
+            os.remove(filename)
+    for x in todo:
+        write_manifests(x[4], x[2:4])
+    finish_step(step, [f for x in todo for f in x[2:4]])
+
+
+def trimfolder(inFolder, outFolder, trimq, ftrim=True):
+    """
+
+    """
+
+    import os
+
+    inFolder = asfolder(inFolder)
+    outFolder = asfolder(outFolder)
+
+    files = os.listdir(inFolder)
+    files.sort()
+    ins1 = [x for x in files if "_R1_" in x]
+    ins2 = [x.replace("_R1_", "_R2_") for x in ins1]
+    make_folder(outFolder)
+    # call("mkdir -p %s" % out_folder, shell=True)
+    print("Trimming...")
+    if PR['trimmer'] != "bbduk" and PR['adapter_ref'] is not None:
+        logwarning("%s trimming does not remove adapters, bbduk.sh is used instead" % PR['trimmer'])
+
+    # get_ipython().system(u'mkdir -p {out_folder}')
+    batch = None
+    if PR['trimmer'] == "bbduk" or PR['adapter_ref'] is not None:
+        workers = PR['jvm_workers']
+        python_step = ftrim or PR['bb_batch'] > 1
+        batch = trimbatch
+    else:
+        workers = PR['number_of_cores']
+        python_step = True
+    p = make_pool(workers, python_step)
+    run_chunked(p, trimsample, [(inFolder + ins1[i], inFolder + ins2[i],
+                                 intermediate(outFolder + ins1[i]), intermediate(outFolder + ins2[i]), trimq, ftrim)
+                                for i in range(len(ins1))],
+                [estimate_cost([inFolder + ins1[i], inFolder + ins2[i]]) for i in range(len(ins1))],
+                "trimming", 2, workers, batch)
+
+
+def find_overlaps(seqs1, seqs2, pp, mino=6):
+    """
+    Find the overlap between the end of read 1 and the start of the reverse
+    complemented read 2 for a batch of pairs, with the rule of fastq-join:
+    at most pp percent mismatches in the overlap and the best overlap is the
+    one with the lowest (d^2 + 1) / overlap, longer overlaps win ties.
+
+    :param seqs1: list of read 1 sequences.
+    :param seqs2: list of reverse complemented read 2 sequences.
+    :param pp: maximum percentage of mismatches in the overlap.
+    :type pp: int
+    :param mino: minimum overlap length.
+    :type mino: int
+    :return: array of overlap lengths, 0 when the pair can not be merged.
+    """
+    # read 1 is right aligned so its last o bases are always the last o columns
+    l1 = numpy.array([len(x) for x in seqs1], dtype=numpy.int64)
+    width = max(l1.max(), 1)
+    s1 = numpy.frombuffer(b"".join(x.rjust(width, b"\0") for x in seqs1),
+                          dtype=numpy.uint8).reshape(len(seqs1), width)
+    s2, l2 = char_matrix(seqs2, b"\1")
+    maxo = numpy.minimum(l1, l2)
+    best_score = numpy.full(len(seqs1), numpy.iinfo(numpy.int64).max, dtype=numpy.int64)
+    best_o = numpy.zeros(len(seqs1), dtype=numpy.int64)
+    for o in range(maxo.max(), mino - 1, -1):
+        d = numpy.count_nonzero(s1[:, width - o:] != s2[:, :o], axis=1)
+        score = 1000 * (d * d + 1) // o
+        ok = (maxo >= o) & (d * 100 <= pp * o) & (score < best_score)
+        best_score[ok] = score[ok]
+        best_o[ok] = o
+    return best_o
+
+
+COMPLEMENT = maketrans(b"ACGTNacgtn", b"TGCANtgcan")
+
+
+def merge_pairs(pairs, pp, minlength, batch_size=5000):
+    """
+    Merge read pairs in batches, the pairs which can not be merged and the
+    merged reads shorter than minlength are dropped.
+
+    :param pairs: iterable of (read1 record, read2 record) tuples.
+    :param pp: maximum percentage of mismatches in the overlap.
+    :type pp: int
+    :param minlength: minimum length of the merged reads.
+    :type minlength: int
+    :param batch_size: number of pairs processed together.
+    :type batch_size: int
+    :return: generator of merged fastq records.
+    """
+    for batch in read_batches(pairs, batch_size):
+        seqs1 = [r1[1].rstrip() for r1, _ in batch]
+        seqs2 = [r2[1].rstrip().translate(COMPLEMENT)[::-1] for _, r2 in batch]
+        quals1 = [r1[3].rstrip() for r1, _ in batch]
+        quals2 = [r2[3].rstrip()[::-1] for _, r2 in batch]
+        overlaps = find_overlaps(seqs1, seqs2, pp)
+
+        # the overlapping parts, aligned to the start of the overlap
+        rows = numpy.nonzero(overlaps)[0]
+        if len(rows) == 0:
+            continue
+        o = overlaps[rows]
+        width = numpy.arange(o.max())
+        s1, l1 = char_matrix([seqs1[i] for i in rows], b"N")
+        q1, _ = char_matrix([quals1[i] for i in rows], b"!")
+        s2, _ = char_matrix([seqs2[i] for i in rows], b"N")
+        q2, _ = char_matrix([quals2[i] for i in rows], b"!")
+        cols1 = numpy.clip(l1[:, None] - o[:, None] + width, 0, s1.shape[1] - 1)
+        b1 = s1[numpy.arange(len(rows))[:, None], cols1]
+        p1 = q1[numpy.arange(len(rows))[:, None], cols1]
+        b2 = s2[:, :len(width)]
+        p2 = q2[:, :len(width)]
+        bases = numpy.where(p1 >= p2, b1, b2)
+        quals = numpy.where(b1 == b2, numpy.maximum(p1, p2),
+                            numpy.maximum(numpy.abs(p1.astype(numpy.int16) - p2), 2) + 33).astype(numpy.uint8)
+
+        for j, i in enumerate(rows.tolist()):
+            k = int(o[j])
+            seq = seqs1[i][:-k] + bases[j, :k].tobytes() + seqs2[i][k:]
+            if len(seq) < minlength:
+                continue
+            qual = quals1[i][:-k] + quals[j, :k].tobytes() + quals2[i][k:]
+            yield batch[i][0][0], seq + b"\n", b"+\n", qual + b"\n"
+
+
+def nativemerge(in1, in2, out, pp):
+    """
+    Merge one sample with merge_pairs(), used by mergefoldernative().
+
+    :param in1: input R1 fastq file name.
+    :param in2: input R2 fastq file name.
+    :param out: output fastq file name.
+    :param pp: maximum percent of differences in the overlap.
+    :return: None
+    """
+    print("Merging: %s and %s " % (os.path.basename(in1), os.path.basename(in2)))
+    key = step_key("merging", [in1, in2], [out], {"method": "native", "pp": pp})
+    if completed(key, [out]):
+        return
+    step = start_step("merging", [in1, in2])
+    infq1 = open_fastq(in1, "r")
+    infq2 = open_fastq(in2, "r")
+    outfq = open_fastq(out, "w")
+    counts = {}
+    pairs = tally(zip_pairs(read_fastq(infq1), read_fastq(infq2), in1, in2), counts, "in")
+    n = write_fastq(outfq, merge_pairs(pairs, pp, PR['minimum_length']))
+    for f in (infq1, infq2, outfq):
+        f.close()
+    report_reads(2 * counts["in"], n)
+    write_manifests(key, [out])
+    # the sample files of a chunk are removed by join_chunks()
+    if PR['remove_intermediate'] and in1 not in RANGES:
+        os.remove(in1)
+        os.remove(in2)
+    finish_step(step, [out])
+
+
+def mergefoldernative(inFolder, outFolder, pp):
+    """
+    Merge all samples with the built-in merger using a pool of processes,
+    --ml is applied while merging.
+
+    """
+    inFolder = asfolder(inFolder)
+    outFolder = asfolder(outFolder)
+
+    files = os.listdir(inFolder)
+    files.sort()
+
+    ins1 = [x for x in files if "_R1_" in x]
+    ins2 = [x.replace("_R1_", "_R2_") for x in ins1]
+    outs = [intermediate(x.replace("_L001_R1_001", "")) for x in ins1]
+    make_folder(outFolder)
+    print("\nMerging ...")
+
+    p = make_pool(PR['number_of_cores'], True)
+    run_chunked(p, nativemerge, [(inFolder + ins1[i], inFolder + ins2[i], outFolder + outs[i], pp)
+                                 for i in range(len(ins1))],
+                [estimate_cost([inFolder + ins1[i], inFolder + ins2[i]]) for i in range(len(ins1))],
+                "merging", 1)
+    if PR['remove_intermediate'] and os.path.isdir(inFolder):
+        os.removedirs(inFolder)
+    print("Merging finished.")
+
+
+def mergesamplebb(in1, in2, out, maxloose=True):
+    """
+    Merge one pair of fastq files with bbmerge.sh.
+
+    """
+    print("%s and %s" % (os.path.basename(in1), os.path.basename(in2)))
+    key = step_key("merging", [in1, in2], [out], {"method": "bbmerge", "maxloose": maxloose}, ["bbmerge.sh"])
+    if completed(key, [out]):
+        return
+    step = start_step("merging", [in1, in2])
+    if maxloose:
+        execute("bbmerge.sh -Xmx%dm -threads=%d -in1=%s -in2=%s -out=%s -maxloose=t -ignorebadquality%s"
+                % (PR['tool_memory'], PR['tool_threads'], in1, in2, out, bb_ziplevel(out)), shell=True)
+
+
+
+    else:
+        execute("bbmerge.sh -Xmx%dm -threads=%d -in1=%s -in2=%s -out=%s -ignorebadquality%s"
+                % (PR['tool_memory'], PR['tool_threads'], in1, in2, out, bb_ziplevel(out)), shell=True)
+
+    write_manifests(key, [out])
+    if PR['remove_intermediate']:
+        os.remove(in1)
+        os.remove(in2)
+    finish_step(step, [out])
+
+
+def mergebatchbb(items, n):
+    """
+    Merge several samples with one bbmerge.sh, see run_batch().
+
+    :param items: mergesamplebb() arguments of each sample, with the same
+    maxloose.
+    :param n: number of the batch.
+    :return: None
+    """
+    todo = []
+    for in1, in2, out, maxloose in items:
+        key = step_key("merging", [in1, in2], [out], {"method": "bbmerge", "maxloose": maxloose}, ["bbmerge.sh"])
+        if not completed(key, [out]):
+            todo.append((in1, in2, out, key))
+    if not todo:
+        return
+    print("Merging batch %d: %s" % (n, ", ".join(sample_name(x[0]) for x in todo)))
+    step = start_step("merging", [f for x in todo for f in x[:2]], "batch%03d" % n)
+    command = "bbmerge.sh -Xmx%dm -threads=%d -in1=%%(in1)s -in2=%%(in2)s -out=%%(out1)s%s -ignorebadquality" % (
+        PR['tool_memory'], PR['tool_threads'], " -maxloose=t" if items[0][3] else "")
+    run_batch("merging", n, command, [x[:2] for x in todo], [x[2:3] for x in todo])
+    for x in todo:
+        write_manifests(x[3], x[2:3])
+        if PR['remove_intermediate']:
+            os.remove(x[0])
+            os.remove(x[1])
+    finish_step(step, [x[2] for x in todo])
+
+
+def mergefolderbb(inFolder, outFolder, maxloose=True):
+    """
+
+    """
+    inFolder = asfolder(inFolder)
+    outFolder = asfolder(outFolder)
+
+    import os
+    files = os.listdir(inFolder)
+    files.sort()
+
+    ins1 = [x for x in files if "_R1_" in x]
+    ins2 = [x.replace("_R1_", "_R2_") for x in ins1]
+    outs = [intermediate(x.replace("_L001_R1_001", "")) for x in ins1]
+    make_folder(outFolder)
+    print("\nMerging ...")
+
+    # the batches split the reads of the samples in python, see run_batch()
+    p = make_pool(PR['jvm_workers'], PR['bb_batch'] > 1)
+    run_chunked(p, mergesamplebb, [(inFolder + ins1[i], inFolder + ins2[i], outFolder + outs[i], maxloose)
+                                   for i in range(len(ins1))],
+                [estimate_cost([inFolder + ins1[i], inFolder + ins2[i]]) for i in range(len(ins1))],
+                "merging", 1, PR['jvm_workers'], mergebatchbb)
+    if PR['remove_intermediate'] and os.path.isdir(inFolder):
+        os.removedirs(inFolder)
+    print("Merging finished.")
+
+
+def mergesample(in1, in2, out_final, pp):
+    """
+    Merge one pair of fastq files with fastq-join and remove the short reads.
+
+    """
+    print("Merging: %s and %s " % (os.path.basename(in1), os.path.basename(in2)))
+    key = step_key("merging", [in1, in2], [out_final], {"method": "fastq-join", "pp": pp}, ["fastq-join"])
+    if completed(key, [out_final]):
+        return
+    step = start_step("merging", [in1, in2])
+    out = os.path.join(os.path.dirname(out_final), "temp_" + sub("\\.gz$", "", os.path.basename(out_final)))
+    execute("fastq-join -p %d %s %s -o %s" % (pp, in1, in2, out), shell=True)
+    os.remove("%sun1" % out)
+    os.remove("%sun2" % out)
+    os.rename("%sjoin" % out, out)
+    remove_short_reads(out, out_final, PR['minimum_length'])
+    os.remove(out)
+    write_manifests(key, [out_final])
+    if PR['remove_intermediate']:
+        os.remove(in1)
+        os.remove(in2)
+    finish_step(step, [out_final])
+
+
+def mergefolder(inFolder, outFolder, pp):
+    """
+
+    """
+    global PR
+    inFolder = asfolder(inFolder)
+    outFolder = asfolder(outFolder)
+
+    files = os.listdir(inFolder)
+
+    files.sort()
+
+    ins1 = [x for x in files if "_R1_" in x]
+    ins2 = [x.replace("_R1_", "_R2_") for x in ins1]
+
+    outs = [intermediate(x.replace("_L001_R1_001", "")) for x in ins1]
+    make_folder(outFolder)
+
+    # remove_short_reads() runs in python after fastq-join
+    p = make_pool(PR['number_of_cores'], True)
+    run_chunked(p, mergesample, [(inFolder + ins1[i], inFolder + ins2[i], outFolder + outs[i], pp)
+                                 for i in range(len(ins1))],
+                [estimate_cost([inFolder + ins1[i], inFolder + ins2[i]]) for i in range(len(ins1))],
+                "merging", 1)
+    if PR['remove_intermediate'] and os.path.isdir(inFolder):
+        os.removedirs(inFolder)
+
+def quality_filter(records, sampleId, q, max_bad_run_length=3,
+                   min_per_read_length_fraction=0.75, sequence_max_n=0):
+    """
+    Quality filter of split_libraries_fastq.py for not-barcoded reads: a
+    read is truncated before the first run of more than max_bad_run_length
+    bases with phred quality <= q, then dropped if it is shorter than
+    min_per_read_length_fraction of its length or has too many N.
+
+    :param records: fastq records.
+    :param sampleId: sample id used in the fasta labels (SampleId_N).
+    :type sampleId: str
+    :param q: maximum unacceptable phred quality.
+    :type q: int
+    :return: generator of (label, sequence) tuples.
+    """
+    bad = maketrans(bytes(bytearray(range(256))),
+                    bytes(bytearray(49 if 33 <= c <= 33 + q else 48 for c in range(256))))
+    bad_run = b"1" * (max_bad_run_length + 1)
+    seq_id = 0
+    for a, b, c, d in records:
+        sequence = b.rstrip()
+        end = d.rstrip().translate(bad).find(bad_run)
+        if end == -1:
+            end = len(sequence)
+        if end < min_per_read_length_fraction * len(sequence):
+            continue
+        sequence = sequence[:end]
+        if sequence.count(b"N") > sequence_max_n:
+            continue
+        label = "%s_%d %s orig_bc=AAAAAAAAAAAA new_bc=AAAAAAAAAAAA bc_diffs=0" % (
+            sampleId, seq_id, a[1:].rstrip().decode("ascii"))
+        seq_id += 1
+        yield label, sequence
+
+
+def nativequalitycontrol(inFile, outFile, sampleId, q):
+    """
+    Quality control of one sample with quality_filter(), used by
+    qualitycontrol() with --qc_method native.
+
+    :param inFile: merged fastq file name.
+    :param outFile: output fasta file name.
+    :param sampleId: sample id used in the fasta labels.
+    :param q: maximum unacceptable phred quality.
+    :return: None
+    """
+    print("\nQuality control: %s" % os.path.basename(inFile))
+    key = step_key("quality control", [inFile], [outFile], {"method": "native", "sampleId": sampleId, "q": q})
+    if completed(key, [outFile]):
+        return
+    step = start_step("quality control", [inFile], sampleId)
+    infq = open_fastq(inFile, "r")
+    outfa = open(outFile, "w")
+    counts = {}
+    records = quality_filter(tally(read_fastq(infq), counts, "in"), sampleId, q)
+    if PR['subsample'] == "qc":
+        records = reservoir_sample(records, subsample_size(), sampleId)
+    n = write_fasta(outfa, records)
+    infq.close()
+    outfa.close()
+    report_reads(counts["in"], n)
+    write_manifests(key, [outFile])
+    if PR['remove_intermediate']:
+        os.remove(inFile)
+    finish_step(step, [outFile])
+
+
+def qualitycontrolsample(inFile, outFile, sampleId, q):
+    """
+    Quality control of one sample with split_libraries_fastq.py.
+
+    """
+    temp = os.path.join(os.path.dirname(outFile), "temp" + os.path.basename(inFile)) + "/"
+    print("\nQuality control: %s" % os.path.basename(inFile))
+    key = step_key("quality control", [inFile], [outFile], {"method": "split_libraries", "sampleId": sampleId,
+                                                           "q": q}, ["split_libraries_fastq.py"])
+    if completed(key, [outFile]):
+        return
+    step = start_step("quality control", [inFile], sampleId)
+    execute("""split_libraries_fastq.py -i %s -o %s --barcode_type not-barcoded --sample_ids %s -q %s""" % (
+        inFile, temp, sampleId, q), shell=True)
+
+    tempFile = temp + "seqs.fna"
+    call("mv %s %s" % (tempFile, outFile), shell=True)
+    call("rm -r %s" % temp, shell=True)
+    if PR['subsample'] == "qc" and os.path.exists(outFile):
+        subsample_fasta(outFile, sampleId)
+    write_manifests(key, [outFile])
+    if PR['remove_intermediate']:
+        os.remove(inFile)
+    finish_step(step, [outFile])
+
+
+def qualitycontrol(inFolder, outFolder, q):
+    """
+
+
+    """
+    inFolder = asfolder(inFolder)
+    outFolder = asfolder(outFolder)
+
+    import os
+    files = os.listdir(inFolder)
+    files.sort()
+    make_folder(outFolder)
+
+    # call("mkdir -p %s " % out_folder, shell=True)
+
+    if PR['qc_method'] == "native":
+        function = nativequalitycontrol
+    else:
+        function = qualitycontrolsample
+    p = make_pool(PR['number_of_cores'], PR['qc_method'] == "native")
+    run_pool(p, function, [(inFolder + i, outFolder + sample_name(i) + ".fasta",
+                            sample_name(i), q) for i in files],
+             [estimate_cost([inFolder + i]) for i in files], "quality control")
+    print("Quality control finished.")
+    if PR['remove_intermediate'] and os.path.isdir(inFolder):
+        os.removedirs(inFolder)
+
+def tee_fastq(records, outfq):
+    """
+    Write the records to a file while passing them on.
+
+    :param records: fastq records.
+    :param outfq: open output file.
+    :return: generator of the same records.
+    """
+    for record in records:
+        outfq.writelines(record)
+        yield record
+
+
+def streamsample(in1, in2, merged, qc, sampleId, trimq, pp, qcq):
+    """
+    Trim, merge and quality filter one sample in a single pass, the reads
+    flow between the stages as generators and only the fasta file is
+    written. When qc is None the sample stops after merging and the merged
+    fastq file is written instead.
+
+    :param merged: merged fastq file name or None.
+    :param qc: quality controlled fasta file name or None.
+    :return: None
+    """
+    print("Streaming: %s and %s" % (os.path.basename(in1), os.path.basename(in2)))
+    outputs = [x for x in (merged, qc) if x is not None]
+    key = step_key("streaming", [in1, in2], outputs, {"sampleId": sampleId, "trimq": trimq, "pp": pp, "qcq": qcq})
+    if completed(key, outputs):
+        return
+    step = start_step("streaming", [in1, in2], sampleId)
+    if PR['trimmer'] == "numpy":
+        trim_pairs = numpy_trim
+    else:
+        trim_pairs = fused_trim
+    infq1 = open_fastq(in1, "r")
+    infq2 = open_fastq(in2, "r")
+    counts = {}
+    pairs = tally(zip_pairs(read_fastq(infq1), read_fastq(infq2), in1, in2), counts, "in")
+    if PR['subsample'] == "input":
+        pairs = reservoir_sample(pairs, subsample_size(), sample_name(in1))
+    pairs = trim_pairs(pairs, PR['primertrim_forward'], PR['primertrim_reverse'], trimq,
+                       PR['min_read_length'])
+    reads = merge_pairs(premerge_filter(pairs, premerge_length(), counts), pp, PR['minimum_length'])
+    outfiles = [infq1, infq2]
+    if merged is not None:
+        outfq = open_fastq(merged, "w")
+        outfiles.append(outfq)
+        reads = tee_fastq(reads, outfq)
+    reads = tally(reads, counts, "merged")
+    if qc is not None:
+        outfa = open(qc, "w")
+        outfiles.append(outfa)
+        records = quality_filter(reads, sampleId, qcq)
+        if PR['subsample'] == "qc":
+            records = reservoir_sample(records, subsample_size(), sampleId)
+        n = write_fasta(outfa, records)
+    else:
+        for _ in reads:
+            pass
+        n = 0
+    for f in outfiles:
+        f.close()
+    # the reads of the merged file and of the fasta file
+    report_reads(2 * counts["in"], counts["merged"] * (merged is not None) + n)
+    if counts["dropped"]:
+        loginfo("streaming: %d read pairs of %s too short for --ml after merging dropped before merging"
+                % (counts["dropped"], sampleId))
+    write_manifests(key, outputs)
+    finish_step(step, outputs)
+
+
+def streamfolder(inFolder, merged, qc, trimq, pp, qcq):
+    """
+    Streaming replacement of trimfolder(), mergefoldernative() and
+    qualitycontrol(), see streamsample().
+
+    :param inFolder: folder of the raw fastq files.
+    :param merged: folder of the merged fastq files, None to skip them.
+    :param qc: folder of the quality controlled fasta files, None to stop
+    after merging.
+    :return: None
+    """
+    inFolder = asfolder(inFolder)
+    files = os.listdir(inFolder)
+    files.sort()
+    ins1 = [x for x in files if "_R1_" in x]
+    ins2 = [x.replace("_R1_", "_R2_") for x in ins1]
+    outs = [intermediate(x.replace("_L001_R1_001", "")) for x in ins1]
+    for folder in (merged, qc):
+        if folder is not None:
+            make_folder(folder)
+    print("Trimming, merging and quality control ...")
+
+    jobs = []
+    for in1, in2, out in zip(ins1, ins2, outs):
+        jobs.append((inFolder + in1, inFolder + in2,
+                     None if merged is None else asfolder(merged) + out,
+                     None if qc is None else asfolder(qc) + sample_name(out) + ".fasta",
+                     sample_name(out), trimq, pp, qcq))
+    p = make_pool(PR['number_of_cores'], True)
+    run_pool(p, streamsample, jobs, [estimate_cost(job[:2]) for job in jobs], "streaming")
+    print("Quality control finished.")
+
+
+def file_fingerprint(filename):
+    """
+    Cheap fingerprint of a reference file: its path, size and modification time.
+
+    :param filename: file name.
+    :type filename: str
+    :return: hex digest
+    :rtype: str
+    """
+    st = os.stat(filename)
+    return hashlib.sha1(("%s:%d:%d" % (os.path.abspath(filename), st.st_size,
+                                       int(st.st_mtime))).encode("utf-8")).hexdigest()
+
+
+def open_cache(name):
+    """
+    Open a key/value cache stored as a SQLite file in the cache folder.
+
+    :param name: cache file name.
+    :type name: str
+    :return: sqlite3 connection
+    """
+    if not os.path.isdir(PR['cache_folder']):
+        os.makedirs(PR['cache_folder'])
+    connection = sqlite3.connect(PR['cache_folder'] + name, timeout=600)
+    connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, used REAL)")
+    connection.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache (used)")
+    return connection
+
+
+def cache_get(connection, keys):
+    """
+    Look up keys in a cache, the found keys are marked as recently used.
+
+    :param connection: cache from open_cache().
+    :param keys: list of keys.
+    :return: dict of the found keys and their values.
+    """
+    found = {}
+    now = time.time()
+    for start in range(0, len(keys), 500):
+        chunk = keys[start:start + 500]
+        marks = ",".join("?" * len(chunk))
+        found.update(connection.execute("SELECT key, value FROM cache WHERE key IN (%s)" % marks, chunk))
+        connection.execute("UPDATE cache SET used = ? WHERE key IN (%s)" % marks, [now] + chunk)
+    connection.commit()
+    return found
+
+
+def cache_put(connection, items, max_entries):
+    """
+    Store values in a cache and evict the least recently used entries when
+    it grows over max_entries.
+
+    :param connection: cache from open_cache().
+    :param items: dict of keys and values.
+    :param max_entries: maximum number of entries of the cache.
+    :type max_entries: int
+    :return: None
+    """
+    now = time.time()
+    connection.executemany("INSERT OR REPLACE INTO cache (key, value, used) VALUES (?, ?, ?)",
+                           [(k, v, now) for k, v in items.items()])
+    size = connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+    if size > max_entries:
+        connection.execute("DELETE FROM cache WHERE key IN "
+                           "(SELECT key FROM cache ORDER BY used LIMIT ?)", (size - max_entries,))
+    connection.commit()
+
+
+# PR parameters that change the outputs of each step, see step_key()
+STEP_PARAMETERS = {
+    "trimming": ['trimmer', 'adapter_ref', 'primertrim_forward', 'primertrim_reverse', 'min_read_length',
+                 'minimum_length', 'joining_method', 'subsample', 'subsample_factor', 'seed', 'depth'],
+    "merging": ['minimum_length'],
+    "quality control": ['subsample', 'subsample_factor', 'seed', 'depth'],
+    "streaming": ['trimmer', 'primertrim_forward', 'primertrim_reverse', 'min_read_length', 'minimum_length',
+                  'subsample', 'subsample_factor', 'seed', 'depth'],
+    "chimera removal": ['chimera_cache', 'dereplicate', 'silva_chim_ref', 'gg_chim_ref'],
+    "otu picking": ['parameter_file_name', 'c_ref', 'c_otu_id', 'silva_reference_seqs', 'gg_reference_seqs',
+                    'exact_match', 'taxonomy_cache'],
+    "diversity analyses": ['fungus'],
+    "adding samples": ['silva_core_alignment', 'gg_core_alignment']}
+
+
+def parameter_key(filename):
+    """
+    Key of a file given as a parameter of a step: the content of the small
+    files auto-q writes in the output folder (the parameter file gets a new
+    name in every run), the fingerprint of the other files (references,
+    user files), see file_fingerprint().
+
+    :param filename: file name.
+    :return: hex digest
+    :rtype: str
+    """
+    if is_output(filename):
+        with open(filename, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    return file_fingerprint(filename)
+
+
+def file_stat(filename):
+    """
+    Size and modification time of a file, None for a folder.
+    """
+    if os.path.isdir(filename):
+        return None
+    st = os.stat(filename)
+    return [st.st_size, int(st.st_mtime)]
+
+
+def is_output(filename):
+    """
+    Whether a file is in the output folder, made by auto-q.
 
-    infq.close()
-    outfq.close()
+    :rtype: bool
+    """
+    return os.path.abspath(filename).startswith(os.path.abspath(PR['out_folder']) + os.sep)
 
 
-def trimfolder(inFolder, outFolder, trimq, ftrim=True):
+def manifest_file(filename):
+    """
+    Name of the manifest of an output file: others/manifests/ followed by
+    its path in the output folder.
     """
+    path = os.path.relpath(os.path.abspath(filename), os.path.abspath(PR['out_folder']))
+    return PR['others'] + "manifests/" + path + ".json"
 
+
+def read_manifest(filename):
     """
+    Manifest of an output file written by write_manifests().
 
-    import os
+    :param filename: output file name.
+    :return: dict, None when there is no manifest or when the file was
+    changed after the manifest was written. The manifest of a removed
+    intermediate file is kept and returned.
+    """
+    name = manifest_file(filename)
+    if not os.path.isfile(name):
+        return None
+    with open(name) as f:
+        manifest = json.load(f)
+    if os.path.exists(filename) and manifest["stat"] != file_stat(filename):
+        return None
+    return manifest
 
-    inFolder = asfolder(inFolder)
-    outFolder = asfolder(outFolder)
 
-    files = os.listdir(inFolder)
-    files.sort()
-    ins1 = [x for x in files if "_R1_" in x]
-    ins2 = [x.replace("_R1_", "_R2_") for x in ins1]
-    os.mkdir(outFolder)
-    # call("mkdir -p %s" % out_folder, shell=True)
-    print("Trimming...")
+def write_manifests(key, outputs):
+    """
+    Record that the outputs of a step were made with key, see step_key().
+    Nothing is recorded when a command of the step failed (see execute()),
+    the step is run again when the run is resumed.
 
-    # get_ipython().system(u'mkdir -p {out_folder}')
-    def process(i):
-        in1 = inFolder + ins1[i]
-        in2 = inFolder + ins2[i]
-        print("\n%s and %s" % (ins1[i], ins2[i]))
-        out1 = outFolder + ins1[i]
-        out2 = outFolder + ins2[i]
-        out1_temp1 = outFolder + "temp1_" + ins1[i]
-        out2_temp1 = outFolder + "temp1_" + ins2[i]
-
-        # forctrimleft was added
-        if ftrim:
-            primertrim(in1, out1_temp1, PR['primertrim_forward'])
-            primertrim(in2, out2_temp1, PR['primertrim_reverse'])
+    :return: None
+    """
+    step = getattr(PROFILE, "step", None)
+    if step is not None and step.get("_failed"):
+        logwarning("%s: a command failed, %s not recorded as done" % (step["stage"], ", ".join(outputs)))
+        return
+    for filename in outputs:
+        name = manifest_file(filename)
+        if not os.path.isdir(os.path.dirname(name)):
+            try:
+                os.makedirs(os.path.dirname(name))
+            except OSError:
+                pass
+        with open(name + ".tmp", "w") as f:
+            json.dump({"key": key, "stat": file_stat(filename), "file": filename}, f)
+        os.rename(name + ".tmp", name)
+
+
+def input_key(filename):
+    """
+    Key of an input file: the key of the step that made it when it has a
+    manifest, its path, size and modification time otherwise (raw reads,
+    user files), see file_fingerprint(); they are not read.
+    """
+    if filename in RANGES:
+        return RANGES[filename][3]
+    manifest = read_manifest(filename)
+    if manifest is not None:
+        return manifest["key"]
+    return file_fingerprint(filename)
 
-        else:
-            out1_temp1 = in1
-            out2_temp1 = in2
 
-        if PR['adapter_ref'] != None:
+def step_key(stage, inputs, outputs, arguments, tools=()):
+    """
+    Key of the outputs of one step of one sample: hash of the step, its
+    parameters (STEP_PARAMETERS and the arguments of the step function),
+    the versions of its tools, the keys of its inputs (see input_key()) and
+    the names of its outputs. Files given as parameters count by
+    parameter_key(). The version of a tool is the fingerprint of its executable,
+    the QIIME scripts have no version option.
+
+    :param stage: name of the step.
+    :param inputs: input file names.
+    :param outputs: output file names.
+    :param arguments: dict of the other arguments of the step.
+    :param tools: external tools run by the step.
+    :return: hex digest
+    :rtype: str
+    """
+    parameters = dict(arguments)
+    parameters.update((name, PR[name]) for name in STEP_PARAMETERS[stage])
+    for name, value in parameters.items():
+        if isinstance(value, basestring) and os.path.isfile(value):
+            parameters[name] = parameter_key(value)
+    versions = {}
+    for tool in tools:
+        executable = find_executable(tool)
+        versions[tool] = None if executable is None else file_fingerprint(executable)
+    description = [stage, __version__, parameters, versions, [input_key(f) for f in inputs],
+                   [os.path.basename(f) for f in outputs]]
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def completed(key, outputs):
+    """
+    Whether the outputs of a step are there from an earlier run of the same
+    step on the same inputs, only when the run is resumed. Intermediate
+    files removed by --remove_intermediate_files count as there when their
+    manifest has the same key, the keys of the next steps are made from
+    it; a next step that has to run again on them stops, see
+    check_inputs().
+
+    :param key: see step_key().
+    :param outputs: output file names.
+    :rtype: bool
+    """
+    if not PR['resume']:
+        return False
+    for filename in outputs:
+        manifest = read_manifest(filename)
+        if manifest is None or manifest["key"] != key:
+            return False
+        if not os.path.exists(filename) and not PR['remove_intermediate']:
+            return False
+    loginfo("done in an earlier run: %s" % ", ".join(outputs))
+    return True
+
+
+def check_inputs(inputs):
+    """
+    Stop when a step has to run but one of its inputs is an intermediate
+    file removed by --remove_intermediate_files in an earlier run, the
+    steps making it were done with other parameters than the step needs.
 
-            execute(
-                "bbduk.sh -Xmx1000m -in1=%s -in2=%s -out1=%s -out2=%s -outm=stdout.fa -ref=%s -qtrim=r -trimq=%d -k=18 -ktrim=f" %
-                (out1_temp1, out2_temp1, out1, out2, PR['adapter_ref'], trimq), shell=True)
-        else:
-            execute(
-                "bbduk.sh -Xmx1000m -in1=%s -in2=%s -out1=%s -out2=%s -qtrim=r -trimq=%d" %
-                (out1_temp1, out2_temp1, out1, out2, trimq), shell=True)
+    :param inputs: input file names.
+    :return: None
+    """
+    if not PR['resume']:
+        return
+    for filename in inputs:
+        if not os.path.exists(filename) and os.path.isfile(manifest_file(filename)):
+            raise IOError("%s was removed by --remove_intermediate_files and is needed again: intermediate "
+                          "files were removed, re-run from scratch" % filename)
 
-        os.remove(out1_temp1)
-        os.remove(out2_temp1)
-    p = Pool(PR['number_of_cores'])
-    p.map(process, range(len(ins1)))
 
+def removed_intermediates(folders):
+    """
+    Whether an intermediate folder was removed in an earlier run
+    (--remove_intermediate_files), its files are not there to list.
 
-def mergefolderbb(inFolder, outFolder, maxloose=True):
+    :rtype: bool
     """
+    return PR['resume'] and PR['remove_intermediate'] and not all(os.path.isdir(f) for f in folders)
+
 
+def make_folder(folder):
     """
-    inFolder = asfolder(inFolder)
-    outFolder = asfolder(outFolder)
+    Create a folder, an existing folder is kept when the run is resumed.
+    """
+    if not (PR['resume'] and os.path.isdir(folder)):
+        os.mkdir(folder)
 
-    import os
-    files = os.listdir(inFolder)
-    files.sort()
 
-    ins1 = [x for x in files if "_R1_" in x]
-    ins2 = [x.replace("_R1_", "_R2_") for x in ins1]
-    outs = [x.replace("_L001_R1_001", "") for x in ins1]
-    os.mkdir(outFolder)
-    print("\nMerging ...")
+def chimera_check(inFile, temp, reference, denovo=True):
+    """
+    Run identify_chimeric_seqs.py -m usearch61 and write temp/non_chimeras.txt.
+
+    With --chimera_cache the verdicts are looked up in a cache keyed by the
+    sequence hash and the reference fingerprint, only the sequences not in
+    the cache are checked by usearch. Cached verdicts must not depend on the
+    other sequences of the sample, so only the reference based check is run
+    (--suppress_usearch61_denovo) in this mode.
+
+    :param inFile: input fasta file.
+    :param temp: output folder of identify_chimeric_seqs.py.
+    :param reference: chimera reference fasta file.
+    :param denovo: run the de novo check too, it needs the reads of one
+    sample as they are, see removechimeraderep().
+    :return: None
+    """
+    if not PR['chimera_cache']:
+        if denovo:
+            execute("identify_chimeric_seqs.py -i %s -m usearch61 -o %s -r %s"
+                    % (inFile, temp, reference), shell=True)
+        else:
+            execute("identify_chimeric_seqs.py -i %s -m usearch61 -o %s -r %s --suppress_usearch61_denovo"
+                    % (inFile, temp, reference), shell=True)
+        return
+
+    fingerprint = file_fingerprint(reference)
+    ids = []
+    sequences = {}
+    infa = open(inFile, "r")
+    for label, sequence in read_fasta(infa):
+        key = fingerprint + hashlib.sha1(sequence).hexdigest()
+        ids.append((label.split()[0], key))
+        sequences[key] = sequence
+    infa.close()
+
+    cache = open_cache("chimera.sqlite")
+    verdicts = cache_get(cache, list(sequences))
+    misses = [k for k in sequences if k not in verdicts]
+    loginfo("chimera cache %s: %d of %d unique sequences found (%.1f%%)"
+            % (os.path.basename(inFile), len(verdicts), len(sequences),
+               100.0 * len(verdicts) / max(len(sequences), 1)))
+
+    if not os.path.isdir(temp):
+        os.makedirs(temp)
+    if misses:
+        missFile = temp + "/cache_misses.fasta"
+        outfa = open(missFile, "w")
+        write_fasta(outfa, [(k, sequences[k]) for k in misses])
+        outfa.close()
+        execute("identify_chimeric_seqs.py -i %s -m usearch61 -o %s -r %s --suppress_usearch61_denovo"
+                % (missFile, temp + "/usearch", reference), shell=True)
+        good = set(line.split()[0] for line in open(temp + "/usearch/non_chimeras.txt") if line.strip())
+        new = dict((k, "0" if k in good else "1") for k in misses)
+        cache_put(cache, new, PR['cache_size'])
+        verdicts.update(new)
+    cache.close()
+
+    out = open(temp + "/non_chimeras.txt", "w")
+    for label, key in ids:
+        if verdicts[key] == "0":
+            out.write("%s\n" % label)
+    out.close()
+
+
+def dereplicate(inFolder, files, derepFolder):
+    """
+    Collapse the identical sequences of all samples.
+
+    Writes uniques.fasta, the unique sequences sorted by abundance with
+    usearch style ";size=N;" labels, and membership.tsv, the index of the
+    samples each unique sequence was found in: the first line lists the
+    samples and every other line is "Uniq1<TAB>0:12,3:1" (sample number:count).
 
-    def process(i):
+    :param inFolder: folder of the per-sample fasta files.
+    :param files: sample file names.
+    :param derepFolder: output folder.
+    :return: (uniques file name, membership index file name)
+    """
+    uniques = {}
+    membership = []
+    for n, i in enumerate(files):
+        infa = open(inFolder + i, "r")
+        for label, sequence in read_fasta(infa):
+            u = uniques.setdefault(sequence, len(uniques))
+            if u == len(membership):
+                membership.append({})
+            membership[u][n] = membership[u].get(n, 0) + 1
+        infa.close()
+
+    order = sorted(uniques.items(), key=lambda x: (-sum(membership[x[1]].values()), x[1]))
+    uniques_file = derepFolder + "uniques.fasta"
+    membership_file = derepFolder + "membership.tsv"
+    outfa = open(uniques_file, "w")
+    index = open(membership_file, "w")
+    index.write("#samples\t%s\n" % "\t".join(files))
+    for rank, (sequence, u) in enumerate(order):
+        samples = membership[u]
+        write_fasta(outfa, [("Uniq%d;size=%d;" % (rank + 1, sum(samples.values())), sequence)])
+        index.write("Uniq%d\t%s\n" % (rank + 1, ",".join("%d:%d" % x for x in sorted(samples.items()))))
+    outfa.close()
+    index.close()
+    loginfo("dereplication: %d unique sequences in %d samples" % (len(order), len(files)))
+    return uniques_file, membership_file
+
+
+def rebuild_samples(uniques_file, membership_file, keep, outFolder):
+    """
+    Write the per-sample fasta files from the dereplication index, keeping
+    only the unique sequences in keep. Reads are labelled SampleId_N.
 
-        in1 = inFolder + ins1[i]
-        in2 = inFolder + ins2[i]
+    :param uniques_file: uniques.fasta from dereplicate().
+    :param membership_file: membership.tsv from dereplicate().
+    :param keep: set of unique ids (Uniq1, Uniq2, ...) to keep.
+    :param outFolder: output folder.
+    :return: None
+    """
+    sequences = {}
+    infa = open(uniques_file, "r")
+    for label, sequence in read_fasta(infa):
+        u = label.split(";")[0]
+        if u in keep:
+            sequences[u] = sequence
+    infa.close()
+
+    index = open(membership_file, "r")
+    files = index.readline().rstrip("\n").split("\t")[1:]
+    samples = [[] for _ in files]
+    for line in index:
+        u, members = line.rstrip("\n").split("\t")
+        if u in sequences:
+            for member in members.split(","):
+                n, count = member.split(":")
+                samples[int(n)].append((u, int(count)))
+    index.close()
+
+    for i, members in zip(files, samples):
+        sampleId = i.replace(".fasta", "")
+        outfa = open(outFolder + i, "w")
+        n = 0
+        for u, count in members:
+            for _ in range(count):
+                write_fasta(outfa, [("%s_%d" % (sampleId, n), sequences[u])])
+                n += 1
+        outfa.close()
+
+
+def removechimeraderep(inFolder, outFolder, files, rdb="silva"):
+    """
+    Chimera removal on the unique sequences of all samples: identify
+    chimeras once on uniques.fasta, then rebuild the per-sample files.
 
-        print("%s and %s" % (ins1[i], ins2[i]))
-        out = outFolder + outs[i]
-        if maxloose:
-            execute("bbmerge.sh -in1=%s -in2=%s -out=%s -maxloose=t -ignorebadquality" % (in1, in2, out), shell=True)
+    Only the reference based usearch61 check is run. identify_chimeric_seqs.py
+    dereplicates its input again without reading the ";size=N;" abundances,
+    so the de novo check would see every unique sequence once and flag none,
+    and with the default union retention nothing would be removed. Unlike
+    the per-sample check, every sequence flagged by the reference check is
+    removed, also when the de novo check would not have flagged it.
 
+    """
+    inputs = [inFolder + i for i in files]
+    outputs = [outFolder + i for i in files]
+    key = step_key("chimera removal", inputs, outputs, {"rdb": rdb, "denovo": False},
+                   ["identify_chimeric_seqs.py"])
+    if completed(key, outputs):
+        return
+    step = start_step("chimera removal", inputs, "all")
+    derepFolder = asfolder(PR['others'] + "derep")
+    make_folder(derepFolder)
+    print("Dereplication ...")
+    uniques_file, membership_file = dereplicate(inFolder, files, derepFolder)
+
+    print("Chimera removal: %s" % uniques_file)
+    temp = derepFolder + "chimera/"
+    if rdb == "silva":
+        reference = PR['silva_chim_ref']
+    else:
+        reference = PR['gg_chim_ref']
+    chimera_check(uniques_file, temp, reference, denovo=False)
+    keep = set(line.split()[0].split(";")[0] for line in open(temp + "non_chimeras.txt") if line.strip())
+    loginfo("chimera removal: %d of the unique sequences are not chimeric" % len(keep))
+    rebuild_samples(uniques_file, membership_file, keep, outFolder)
+    call("rm -r %s" % temp, shell=True)
+    write_manifests(key, outputs)
+    finish_step(step, outputs)
 
 
-        else:
-            execute("bbmerge.sh -in1=%s -in2=%s -out=%s -ignorebadquality" % (in1, in2, out), shell=True)
+def removechimerasample(inFile, outFile, rdb="silva"):
+    """
+    Chimera removal of one sample.
 
-        if PR['remove_intermediate']:
-            os.remove(in1)
-            os.remove(in2)
+    """
+    i = os.path.basename(inFile)
+    print("Chimera removal: %s" % i)
+    key = step_key("chimera removal", [inFile], [outFile], {"rdb": rdb},
+                   ["identify_chimeric_seqs.py", "filter_fasta.py"])
+    if completed(key, [outFile]):
+        return
+    step = start_step("chimera removal", [inFile])
+    temp = os.path.join(os.path.dirname(outFile), "temp" + i) + "/"
+    if rdb == "silva":
+        chimera_check(inFile, temp + i, PR['silva_chim_ref'])
+    else:
+        chimera_check(inFile, temp + i, PR['gg_chim_ref'])
 
-    p = Pool(PR['number_of_cores'])
-    p.map(process, range(len(ins1)))
+    execute("filter_fasta.py -f %s -o %s -s %s/non_chimeras.txt" % (inFile, outFile, temp + i),
+            shell=True)
+    call("rm -r %s" % temp, shell=True)
+    write_manifests(key, [outFile])
     if PR['remove_intermediate']:
-        os.removedirs(inFolder)
-    print("Merging finished.")
+        os.remove(inFile)
+    finish_step(step, [outFile])
 
 
-def mergefolder(inFolder, outFolder, pp):
+def removechimera(inFolder, outFolder, rdb="silva"):
     """
 
+
     """
     global PR
+    import os
     inFolder = asfolder(inFolder)
     outFolder = asfolder(outFolder)
 
     files = os.listdir(inFolder)
-
     files.sort()
 
-    ins1 = [x for x in files if "_R1_" in x]
-    ins2 = [x.replace("_R1_", "_R2_") for x in ins1]
+    make_folder(outFolder)
 
-    outs = [x.replace("_L001_R1_001", "") for x in ins1]
-    os.mkdir(outFolder)
-
-    def process(i):
-        in1 = inFolder + ins1[i]
-        in2 = inFolder + ins2[i]
-        print("Merging: %s and %s " % (ins1[i], ins2[i]))
-        out = outFolder + "temp_" + outs[i]
-        out_final = outFolder + outs[i]
-        if out_final.endswith(".gz"):
-            out_final = sub(".gz", "", out_final)
-        execute("fastq-join -p %d %s %s -o %s" % (pp, in1, in2, out), shell=True)
-        os.remove("%sun1" % out)
-        os.remove("%sun2" % out)
-        os.rename("%sjoin" % out, out)
-        remove_short_reads(out, out_final, PR['minimum_length'])
-        os.remove(out)
+    # call("mkdir -p %s" % out_folder, shell=True)
+
+    if PR['dereplicate']:
+        removechimeraderep(inFolder, outFolder, files, rdb)
         if PR['remove_intermediate']:
-            os.remove(in1)
-            os.remove(in2)
+            for i in files:
+                if os.path.exists(inFolder + i):
+                    os.remove(inFolder + i)
+    else:
+        p = make_pool(PR['number_of_cores'], False)
+        run_pool(p, removechimerasample, [(inFolder + i, outFolder + i, rdb) for i in files],
+                 [estimate_cost([inFolder + i]) for i in files], "chimera removal")
+    if PR['remove_intermediate'] and os.path.isdir(inFolder):
+        os.removedirs(inFolder)
 
+def run_dag(tasks, workers):
+    """
+    Run a graph of tasks on a pool of threads, each task starts as soon as
+    the tasks it depends on are finished. When more tasks are ready than
+    free workers, the tasks with the highest priority start first, the
+    per-sample steps use (step, estimated cost of the sample). A task can
+    return a dict of new tasks, the tasks depending on it wait for the new
+    tasks too. The first failing task stops the run and kills the running
+    commands.
+
+    :param tasks: dict of task name: (function, args, dependencies, priority)
+    :param workers: number of tasks running at the same time.
+    :type workers: int
+    :return: None
+    """
+    done = queue.Queue()
+
+    def run(name):
+        function, args = tasks[name][:2]
+        try:
+            done.put((name, None, function(*args)))
+        except Exception:
+            done.put((name, traceback.format_exc(), None))
+
+    waiting = dict((name, set(task[2])) for name, task in tasks.items())
+    CANCELLED.clear()
+    p = Pool(workers)
+    running = 0
+    while waiting or running:
+        ready = sorted([n for n in waiting if not waiting[n]], key=lambda n: tasks[n][3], reverse=True)
+        for name in ready[:workers - running]:
+            del waiting[name]
+            p.apply_async(run, (name,))
+            running += 1
+        if running == 0:
+            raise ValueError("tasks depend on unknown tasks: %s" % ", ".join(map(str, waiting)))
+        name, error, new = done.get()
+        running -= 1
+        if error is not None:
+            cancel_commands()
+            p.terminate()
+            logwarning(error)
+            raise RuntimeError("%s failed:\n%s" % (str(name), error))
+        for dependencies in waiting.values():
+            if new and name in dependencies:
+                dependencies.update(new)
+            dependencies.discard(name)
+        if new:
+            tasks.update(new)
+            waiting.update((n, set(task[2])) for n, task in new.items())
+    p.close()
+    p.join()
+
+
+def pipelinefolder(inFolder, trimmed, merged, qc, chi, trimq, joining_method,
+                   fastq_p, maxloose, qcq, rdb, last):
+    """
+    Same steps as preprocess() but every sample moves to its next step as
+    soon as it is ready instead of waiting for all samples to finish the
+    current step, so the steps of different samples overlap.
 
+    """
+    inFolder = asfolder(inFolder)
+    files = os.listdir(inFolder)
+    files.sort()
+    ins1 = [x for x in files if "_R1_" in x]
+    ins2 = [x.replace("_R1_", "_R2_") for x in ins1]
+    outs = [intermediate(x.replace("_L001_R1_001", "")) for x in ins1]
 
-    p = Pool(PR['number_of_cores'])
-    p.map(process, range(len(ins1)))
+    steps = ["merging", "quality_control", "chimera_removal"]
+    steps = steps[:steps.index(last) + 1]
+    if PR['streaming']:
+        folders = [merged if last == "merging" else qc]
+    else:
+        folders = [trimmed, merged, qc][:len(steps) + 1]
+    if "chimera_removal" in steps:
+        folders.append(chi)
+    for folder in folders:
+        make_folder(folder)
+    if PR['trimmer'] != "bbduk" and PR['adapter_ref'] is not None:
+        logwarning("%s trimming does not remove adapters, bbduk.sh is used instead" % PR['trimmer'])
+    print("Trimming, merging, quality control and chimera removal of each sample ...")
+
+    # the steps for processes (see use_processes()) run on pp, the threads of run_dag wait for them,
+    # no process is started with --executor threads
+    pp = None
+    if PR['executor'] != "threads":
+        pp = ProcessPool(PR['number_of_cores'], init_worker)
+
+    def inprocess(function, args):
+        pp.apply(function, args)
+
+    # at most jvm_workers bbduk/bbmerge run at the same time, see allocate_resources()
+    jvm = threading.BoundedSemaphore(PR['jvm_workers'])
+
+    def limited(function, *args):
+        with jvm:
+            function(*args)
+
+    def step(function, args, python_step, jvm_step=False):
+        if use_processes(python_step):
+            function, args = inprocess, (function, args)
+        if jvm_step:
+            function, args = limited, (function,) + args
+        return function, args
+
+    def chunked(function, args, outputs, python_step, jvm_step, stage, n, priority):
+        # a large sample is split in chunk tasks and a task joining them, see chunk_step()
+        jobs, join = chunk_step(function, stage, args, outputs)
+        if join is None:
+            for job in jobs:
+                function, args = step(job[0], job[1], python_step, jvm_step)
+                function(*args)
+            return None
+        new = {}
+        for c, (function, args, chunk) in enumerate(jobs):
+            new[(stage, n, c)] = step(run_step, (function, args, chunk), python_step, jvm_step) + \
+                ([], (priority, float(sum(r[1] - r[0] for r in chunk[1]))))
+        new[(stage, n, "join")] = (join_chunks, join, list(new), (priority,))
+        return new
+
+    tasks = {}
+    for n, (in1, in2, out) in enumerate(zip(ins1, ins2, outs)):
+        in1 = inFolder + in1
+        in2 = inFolder + in2
+        cost = estimate_cost([in1, in2])
+        t1 = intermediate(trimmed + os.path.basename(in1))
+        t2 = intermediate(trimmed + os.path.basename(in2))
+        m = merged + out
+        sampleId = sample_name(out)
+        q = qc + sampleId + ".fasta"
+        if PR['streaming']:
+            if last == "merging":
+                tasks[("merging", n)] = step(streamsample, (in1, in2, m, None, sampleId,
+                                                            trimq, fastq_p, None), True) + ([], (1, cost))
+            else:
+                tasks[("quality_control", n)] = step(streamsample, (in1, in2, None, q, sampleId,
+                                                                    trimq, fastq_p, qcq), True) + ([], (2, cost))
+        else:
+            bbduk = PR['trimmer'] == "bbduk" or PR['adapter_ref'] is not None
+            tasks[("trimming", n)] = (chunked, (trimsample, (in1, in2, t1, t2, trimq), 2, True, bbduk,
+                                                "trimming", n, 0), [], (0, cost))
+            if joining_method == "fastq-join":
+                merge = (mergesample, (t1, t2, m, fastq_p), 1, True, False)
+            elif joining_method == "native":
+                merge = (nativemerge, (t1, t2, m, fastq_p), 1, True, False)
+            elif joining_method == "bbmerge":
+                merge = (mergesamplebb, (t1, t2, m, maxloose), 1, False, True)
+            else:
+                raise ValueError("%s: unknown merging method" % joining_method)
+            tasks[("merging", n)] = (chunked, merge + ("merging", n, 1), [("trimming", n)], (1, cost))
+            if "quality_control" in steps:
+                if PR['qc_method'] == "native":
+                    check = step(nativequalitycontrol, (m, q, sampleId, qcq), True)
+                else:
+                    check = step(qualitycontrolsample, (m, q, sampleId, qcq), False)
+                tasks[("quality_control", n)] = check + ([("merging", n)], (2, cost))
+        if "chimera_removal" in steps and not PR['dereplicate']:
+            tasks[("chimera_removal", n)] = step(removechimerasample, (q, chi + os.path.basename(q), rdb),
+                                                 False) + ([("quality_control", n)], (3, cost))
+
+    if "chimera_removal" in steps and PR['dereplicate']:
+        qcfiles = [sample_name(x) + ".fasta" for x in outs]
+
+        def derep():
+            removechimeraderep(qc, chi, qcfiles, rdb)
+            if PR['remove_intermediate']:
+                for i in qcfiles:
+                    if os.path.exists(qc + i):
+                        os.remove(qc + i)
+
+        tasks[("chimera_removal",)] = (derep, (), [("quality_control", n) for n in range(len(outs))], (3,))
+
+    start = time.time()
+    try:
+        run_dag(tasks, PR['number_of_cores'])
+    except Exception:
+        if pp is not None:
+            pp.terminate()
+        raise
+    if pp is not None:
+        pp.close()
+    loginfo("per-sample steps: makespan %.1f s" % (time.time() - start))
+    record_profile({"kind": "stage", "stage": "per-sample steps", "name": "per-sample steps",
+                    "wall": time.time() - start})
     if PR['remove_intermediate']:
-        os.removedirs(inFolder)
+        for folder in folders[:-1]:
+            if os.path.isdir(folder):
+                os.removedirs(folder)
+    print("Finished the steps of all samples.")
 
-def qualitycontrol(inFolder, outFolder, q):
-    """
+
+MIN_OTU_SIZE = 2  # --min_otu_size of pick_open_reference_otus.py, the mc2 of its tables
 
 
+def otu_reference(rdb, fungus):
     """
-    inFolder = asfolder(inFolder)
-    outFolder = asfolder(outFolder)
+    Reference sequences given to pick_open_reference_otus.py -r.
 
-    import os
-    files = os.listdir(inFolder)
-    files.sort()
-    os.mkdir(outFolder)
+    :return: fasta file name, None when the default reference of QIIME is
+    used (fungus).
+    """
+    if fungus:
+        return None
+    if PR['c_ref'] != "none":
+        return PR['c_ref']
+    if rdb == "silva":
+        return PR['silva_reference_seqs']
+    return PR['gg_reference_seqs']
 
-    # call("mkdir -p %s " % out_folder, shell=True)
 
-    def process(i):
-        temp = outFolder + "temp" + i + "/"
-        print("\nQuality control: %s" % i)
-        sampleId = i.replace(".fastq", "")
-        inFile = inFolder + i
-        outFile = outFolder + i.replace(".fastq", ".fasta")
-        execute("""split_libraries_fastq.py -i %s -o %s --barcode_type not-barcoded --sample_ids %s -q %s""" % (
-            inFile, temp, sampleId, q), shell=True)
-
-        tempFile = temp + "seqs.fna"
-        call("mv %s %s" % (tempFile, outFile), shell=True)
-        call("rm -r %s" % temp, shell=True)
-        if PR['remove_intermediate']:
-            os.remove(inFile)
+def reference_index(reference):
+    """
+    Index of the sequences of a reference fasta file, a SQLite file in the
+    cache folder built at the first use of the file, see file_fingerprint().
 
+    :param reference: fasta file name.
+    :return: sqlite3 connection, table reference (sequence, id) indexed by
+    sequence.
+    """
+    name = PR['cache_folder'] + "reference_%s.sqlite" % file_fingerprint(reference)
+    if not os.path.isfile(name):
+        print("Indexing %s ..." % os.path.basename(reference))
+        if not os.path.isdir(PR['cache_folder']):
+            os.makedirs(PR['cache_folder'])
+        temp = "%s.%d.tmp" % (name, os.getpid())
+        connection = sqlite3.connect(temp)
+        connection.execute("CREATE TABLE reference (sequence TEXT, id TEXT)")
+        f = open(reference, "rb")
+        connection.executemany("INSERT INTO reference VALUES (?, ?)",
+                               ((sequence.upper().decode("ascii"), label.split()[0])
+                                for label, sequence in read_fasta(f)))
+        f.close()
+        connection.execute("CREATE INDEX reference_sequence ON reference (sequence)")
+        connection.commit()
+        connection.close()
+        os.rename(temp, name)
+    return sqlite3.connect(name)
+
+
+def reference_hit(connection, sequence):
+    """
+    OTU of a read that is a reference sequence or the start of reference
+    sequences (amplicon reads against a reference cut to the amplicon) of
+    one OTU. Only these prefix hits are found: a read found inside a
+    reference or with a mismatch goes through pick_open_reference_otus.py.
+
+    :param connection: see reference_index().
+    :param sequence: read sequence.
+    :return: reference id, None when no reference or references of several
+    OTUs match.
+    """
+    sequence = sequence.upper().decode("ascii")
+    rows = connection.execute("SELECT DISTINCT id FROM reference WHERE sequence >= ? AND sequence < ? LIMIT 2",
+                              (sequence, sequence + "\x7f")).fetchall()
+    if len(rows) == 1:
+        return rows[0][0]
+    return None
 
-    p = Pool(PR['number_of_cores'])
-    p.map(process, files)
-    print("Quality control finished.")
-    if PR['remove_intermediate']:
-        os.removedirs(inFolder)
 
-def removechimera(inFolder, outFolder, rdb="silva"):
+def exact_prepass(inputs, reference, folder):
+    """
+    Assign the reads matching a reference with reference_hit() to its OTU,
+    the other reads are written to folder for pick_open_reference_otus.py.
+    The first MIN_OTU_SIZE reads of every assigned OTU are written too:
+    the OTU uclust gives them is the OTU of the assigned reads in the
+    tables, see merge_exact().
+
+    :param inputs: quality controlled fasta files, labels SampleId_N.
+    :param reference: reference fasta file, see otu_reference().
+    :param folder: output folder, same file names as the inputs.
+    :return: (counts, through): dict of (reference id, sample id): number
+    of assigned reads and dict of read id: reference id of the reads
+    written through.
+    """
+    connection = reference_index(reference)
+    found = {}
+    through = {}
+    written = {}
+    counts = {}
+    total = [0, 0]
+
+    def remainder(records):
+        for label, sequence in records:
+            total[0] += 1
+            if sequence not in found:
+                found[sequence] = reference_hit(connection, sequence)
+            otu = found[sequence]
+            if otu is not None:
+                if written.get(otu, 0) >= MIN_OTU_SIZE:
+                    sample = label.split()[0].rsplit("_", 1)[0]
+                    counts[(otu, sample)] = counts.get((otu, sample), 0) + 1
+                    total[1] += 1
+                    continue
+                written[otu] = written.get(otu, 0) + 1
+                through[label.split()[0]] = otu
+            yield label, sequence
+
+    for filename in inputs:
+        infa = open(filename, "rb")
+        outfa = open(folder + os.path.basename(filename), "wb")
+        write_fasta(outfa, remainder(read_fasta(infa)))
+        infa.close()
+        outfa.close()
+    connection.close()
+    loginfo("otu picking: %d of %d reads assigned to %d reference OTUs by exact match"
+            % (total[1], total[0], len(set(otu for otu, _ in counts))))
+    return counts, through
+
+
+def picked_otus(outFolder, through):
+    """
+    OTU given by pick_open_reference_otus.py to the reads written through
+    by exact_prepass() for each reference, read from final_otu_map.txt:
+    uclust does not always give them that reference. The OTU of most of
+    them is taken.
+
+    :param outFolder: output folder of pick_open_reference_otus.py.
+    :param through: see exact_prepass().
+    :return: dict of reference id: OTU id.
     """
+    votes = {}
+    if os.path.isfile(outFolder + "final_otu_map.txt"):
+        with io.open(outFolder + "final_otu_map.txt", encoding="utf-8") as f:
+            for line in f:
+                fields = line.split()
+                for read in fields[1:]:
+                    if read in through:
+                        key = (through[read], fields[0])
+                        votes[key] = votes.get(key, 0) + 1
+    picked = {}
+    for (reference, otu), n in sorted(votes.items()):
+        if reference not in picked or n > votes[(reference, picked[reference])]:
+            picked[reference] = otu
+    return picked
+
+
+def table_ids(filename):
+    """
+    OTU ids and sample ids of a biom table, read from its biom convert
+    --to-tsv text.
 
+    :return: (list of OTU ids, list of sample ids), empty when the table
+    can not be read.
+    """
+    temp = filename + ".ids.txt"
+    execute("biom convert -i %s -o %s --to-tsv" % (filename, temp), shell=True)
+    otus = []
+    samples = []
+    if not os.path.isfile(temp):
+        return otus, samples
+    with io.open(temp, encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if line.startswith("#OTU ID"):
+                samples = fields[1:]
+            elif not line.startswith("#"):
+                otus.append(fields[0])
+    os.remove(temp)
+    return otus, samples
+
+
+def write_otu_table(filename, counts):
+    """
+    Write an OTU table in the classic tab separated format of biom convert.
 
+    :param counts: dict of (OTU id, sample id): count.
+    :return: None
     """
-    global PR
-    import os
-    inFolder = asfolder(inFolder)
-    outFolder = asfolder(outFolder)
+    otus = sorted(set(otu for otu, _ in counts))
+    samples = sorted(set(sample for _, sample in counts))
+    f = io.open(filename, "w", encoding="utf-8")
+    f.write("#OTU ID\t%s\n" % "\t".join(samples))
+    for otu in otus:
+        f.write("%s\t%s\n" % (otu, "\t".join("%d" % counts.get((otu, sample), 0) for sample in samples)))
+    f.close()
 
-    files = os.listdir(inFolder)
-    files.sort()
 
-    os.mkdir(outFolder)
+def merge_exact(outFolder, folder, counts, through):
+    """
+    Add the reads assigned by exact_prepass() to the OTU tables of
+    pick_open_reference_otus.py, each to the OTU uclust gave to the reads
+    of its reference written through (see picked_otus()), so the tables
+    have no OTU without taxonomy or out of the tree. Like those reads, they
+    are left out of the tables that do not have that OTU (pynast failures,
+    OTUs under --min_otu_size).
+
+    :param outFolder: output folder of pick_open_reference_otus.py.
+    :param folder: folder of exact_prepass().
+    :param counts: see exact_prepass().
+    :param through: see exact_prepass().
+    :return: None
+    """
+    if not counts:
+        return
+    picked = picked_otus(outFolder, through)
+    for name in ("otu_table_mc2_w_tax_no_pynast_failures.biom", "otu_table_mc2_w_tax.biom"):
+        if not os.path.isfile(outFolder + name):
+            continue
+        otus = set(table_ids(outFolder + name)[0])
+        merged = {}
+        left = 0
+        for (reference, sample), n in counts.items():
+            if picked.get(reference) in otus:
+                key = (picked[reference], sample)
+                merged[key] = merged.get(key, 0) + n
+            else:
+                left += n
+        if left:
+            logwarning("otu picking: %d reads assigned by exact match left out of %s, the OTU of their "
+                       "reference is not in it" % (left, name))
+        if not merged:
+            continue
+        text = folder + "exact_" + name.replace(".biom", ".txt")
+        table = folder + "exact_" + name
+        write_otu_table(text, merged)
+        execute("biom convert -i %s -o %s --table-type=\"OTU table\" --to-json" % (text, table), shell=True)
+        temp = outFolder + "exact_" + name
+        execute("merge_otu_tables.py -i %s,%s -o %s" % (outFolder + name, table, temp), shell=True)
+        if os.path.isfile(temp):
+            os.rename(temp, outFolder + name)
+
+
+def taxonomy_settings(rdb, fungus):
+    """
+    Taxonomy assignment of the parameter file, see write_parameter_file().
+
+    :return: (method, id to taxonomy file, reference sequences, option of
+    the similarity or e-value).
+    """
+    if rdb == "silva":
+        return "uclust", PR['silva_taxonomy'], PR['silva_reference_seqs'], "--similarity %s" % PR['similarity']
+    if fungus:
+        return "blast", PR['unite_taxonomy'], PR['unite_reference_seqs'], "-e %s" % PR['blast_e_value']
+    return "uclust", PR['gg_taxonomy'], PR['gg_reference_seqs'], "--similarity %s" % PR['similarity']
 
-    # call("mkdir -p %s" % out_folder, shell=True)
 
-    def process(i):
-        print("Chimera removal: %s" % i)
-        temp = outFolder + "temp" + i + "/"
-        if rdb == "silva":
-            execute("identify_chimeric_seqs.py -i %s -m usearch61 -o %s -r %s"
-                    % (inFolder + i, temp + i, PR['silva_chim_ref']),
-                    shell=True)
-        else:
-            execute("identify_chimeric_seqs.py -i %s -m usearch61 -o %s -r %s" % (
-                inFolder + i, temp + i, PR['gg_chim_ref']),
-                    shell=True)
+def assign_taxonomy_cached(outFolder, rdb, fungus):
+    """
+    Taxonomy assignment of the representative sequences of
+    pick_open_reference_otus.py --suppress_taxonomy_assignment with a cache
+    kept between runs (--taxonomy_cache): only the sequences not found in
+    the cache are given to assign_taxonomy.py. The assignments are added to
+    the OTU tables as pick_open_reference_otus.py does, the _w_tax tables.
 
-        execute("filter_fasta.py -f %s -o %s -s %s/non_chimeras.txt" % (inFolder + i, outFolder + i, temp + i),
-                shell=True)
-        call("rm -r %s" % temp, shell=True)
-        if PR['remove_intermediate']:
-            os.remove(inFolder+i)
+    :param outFolder: output folder of pick_open_reference_otus.py.
+    :return: None
+    """
+    method, taxonomy, reference, option = taxonomy_settings(rdb, fungus)
+    settings = [method, file_fingerprint(taxonomy), file_fingerprint(reference), option]
+    f = open(outFolder + "rep_set.fna", "rb")
+    records = [(label.split()[0], sequence) for label, sequence in read_fasta(f)]
+    f.close()
+    keys = dict((otu, hashlib.sha1(json.dumps(settings + [sequence.upper().decode("ascii")]).encode("utf-8"))
+                 .hexdigest()) for otu, sequence in records)
+    cache = open_cache("taxonomy.sqlite")
+    found = cache_get(cache, list(keys.values()))
+    folder = outFolder + "%s_assigned_taxonomy/" % method
+    if not os.path.isdir(folder):
+        os.mkdir(folder)
+    misses = [(otu, sequence) for otu, sequence in records if keys[otu] not in found]
+    if misses:
+        f = open(folder + "rep_set_new.fna", "wb")
+        write_fasta(f, misses)
+        f.close()
+        execute("assign_taxonomy.py -i %s -o %s -t %s -r %s -m %s %s"
+                % (folder + "rep_set_new.fna", folder, taxonomy, reference, method, option), shell=True)
+        assignments = {}
+        if os.path.isfile(folder + "rep_set_new_tax_assignments.txt"):
+            with io.open(folder + "rep_set_new_tax_assignments.txt", encoding="utf-8") as f:
+                for line in f:
+                    otu, assignment = line.rstrip("\n").split("\t", 1)
+                    assignments[keys[otu]] = assignment
+        cache_put(cache, assignments, PR['cache_size'])
+        found.update(assignments)
+        for name in ("rep_set_new.fna", "rep_set_new_tax_assignments.txt", "rep_set_new_tax_assignments.log"):
+            if os.path.exists(folder + name):
+                os.remove(folder + name)
+    cache.close()
+    loginfo("otu picking: taxonomy of %d of %d representative sequences found in the cache"
+            % (len(records) - len(misses), len(records)))
+    with io.open(folder + "rep_set_tax_assignments.txt", "w", encoding="utf-8") as f:
+        for otu, _ in records:
+            if keys[otu] in found:
+                f.write("%s\t%s\n" % (otu, found[keys[otu]]))
+    for name in ("otu_table_mc2", "otu_table_mc2_no_pynast_failures"):
+        if os.path.isfile(outFolder + name + ".biom"):
+            execute("biom add-metadata -i %s -o %s --observation-metadata-fp %s --sc-separated taxonomy "
+                    "--observation-header OTUID,taxonomy"
+                    % (outFolder + name + ".biom", outFolder + name.replace("mc2", "mc2_w_tax") + ".biom",
+                       folder + "rep_set_tax_assignments.txt"), shell=True)
+    if os.path.isfile(outFolder + "otu_table_mc2_no_pynast_failures.biom"):
+        os.remove(outFolder + "otu_table_mc2_no_pynast_failures.biom")
+
+
+def pick_open_reference(command, outFolder, rdb, fungus, exact):
+    """
+    Run pick_open_reference_otus.py and the steps completing its tables:
+    taxonomy assignment with --taxonomy_cache and the reads of
+    --exact_match, see merge_exact().
+
+    :param command: pick_open_reference_otus.py command line, reading the
+    folder of exact_prepass() with --exact_match.
+    :param outFolder: output folder of pick_open_reference_otus.py.
+    :param exact: (folder, counts, through), see exact_prepass(), None
+    without --exact_match.
+    :return: None
+    """
+    execute(command, shell=True)
+    if PR['taxonomy_cache']:
+        assign_taxonomy_cached(outFolder, rdb, fungus)
+    if exact is not None:
+        merge_exact(outFolder, *exact)
 
-    p = Pool(PR['number_of_cores'])
-    p.map(process, files)
-    if PR['remove_intermediate']:
-        os.removedirs(inFolder)
 
 def pickotus(inFolder, outFolder, rdb="silva", fungus=False):
     """
@@ -511,32 +3732,62 @@ def pickotus(inFolder, outFolder, rdb="silva", fungus=False):
 
     inFolder_fasta = inFolder + "*.fasta"
     print("Otu picking...")
+    inputs = [inFolder + i for i in sorted(os.listdir(inFolder)) if i.endswith(".fasta")]
+    reference = None
+    if PR['exact_match']:
+        reference = otu_reference(rdb, fungus)
+    tools = ["pick_open_reference_otus.py", "filter_otus_from_otu_table.py"]
+    if reference is not None:
+        tools += ["biom", "merge_otu_tables.py"]
+    if PR['taxonomy_cache']:
+        tools += ["biom", "assign_taxonomy.py"]
+    key = step_key("otu picking", inputs, [outFolder], {"rdb": rdb, "fungus": fungus, "reference": reference}, tools)
+    if completed(key, [outFolder]):
+        return
+    if os.path.isdir(outFolder):
+        # left by a run that stopped during otu picking
+        shutil.rmtree(outFolder)
+    step = start_step("otu picking", inputs, "all")
     if PR['np']:
         parallel_string = ""
     else:
         parallel_string = "-a -O %d" % PR['number_of_cores']
-
+    if PR['taxonomy_cache']:
+        # the taxonomy is assigned by assign_taxonomy_cached(), see pick_open_reference()
+        parallel_string += " --suppress_taxonomy_assignment"
+
+    exact = None
+    if reference is not None:
+        # only the reads without an exact reference match go through the pipeline
+        prepass = PR['others'] + "exact/"
+        if os.path.isdir(prepass):
+            shutil.rmtree(prepass)
+        os.makedirs(prepass)
+        exact = (prepass,) + exact_prepass(inputs, reference, prepass)
+        inFolder_fasta = prepass + "*.fasta"
 
     if PR['c_ref'] != "none":
         if rdb == "silva":
-            execute("pick_open_reference_otus.py -i %s -o %s -p %s -r %s %s -n %s"
+            pick_open_reference("pick_open_reference_otus.py -i %s -o %s -p %s -r %s %s -n %s"
                     % (
                         inFolder_fasta, outFolder, PR['parameter_file_name'], PR['c_ref'], parallel_string, PR['c_otu_id']),
-                    shell=True)
+                    outFolder, rdb, fungus, exact)
             #execute("filter_otus_from_otu_table.py -i %s -o %s --negate_ids_to_exclude -e %s"
             #        % (out_folder + "otu_table_mc2_w_tax_no_pynast_failures.biom",
             #           out_folder + "otu_table_mc2_w_tax_no_pynast_failures_close_reference.biom",
             #           PR['silva_reference_seqs']), shell=True)
 
         elif fungus:
-            execute("pick_open_reference_otus.py -i %s -o %s -p %s %s -n %s --suppress_align_and_tree"
-                    % (inFolder_fasta, outFolder, PR['parameter_file_name'], parallel_string, PR['c_otu_id']), shell=True)
+            pick_open_reference("pick_open_reference_otus.py -i %s -o %s -p %s %s -n %s --suppress_align_and_tree"
+                    % (inFolder_fasta, outFolder, PR['parameter_file_name'], parallel_string, PR['c_otu_id']),
+                    outFolder, rdb, fungus, exact)
 
         else:
-            execute("pick_open_reference_otus.py -i %s -o %s -r %s -p %s %s -n %s"
+            pick_open_reference("pick_open_reference_otus.py -i %s -o %s -r %s -p %s %s -n %s"
                     % (inFolder_fasta, outFolder,
                        PR['c_ref'], PR['parameter_file_name'],
-                       parallel_string, PR['c_otu_id']), shell=True)
+                       parallel_string, PR['c_otu_id']),
+                    outFolder, rdb, fungus, exact)
 
             #execute("filter_otus_from_otu_table.py -i %s -o %s --negate_ids_to_exclude -e %s"
             #        % (out_folder + "otu_table_mc2_w_tax_no_pynast_failures.biom",
@@ -547,33 +3798,42 @@ def pickotus(inFolder, outFolder, rdb="silva", fungus=False):
 
     else:
         if rdb == "silva":
-            execute("pick_open_reference_otus.py -i %s -o %s -p %s -r %s %s -n %s"
+            pick_open_reference("pick_open_reference_otus.py -i %s -o %s -p %s -r %s %s -n %s"
                     % (inFolder_fasta, outFolder, PR['parameter_file_name'], PR['silva_reference_seqs'], parallel_string,
                        PR['c_otu_id']),
-                    shell=True)
+                    outFolder, rdb, fungus, exact)
             execute("filter_otus_from_otu_table.py -i %s -o %s --negate_ids_to_exclude -e %s"
                     % (outFolder + "otu_table_mc2_w_tax_no_pynast_failures.biom",
                        outFolder + "otu_table_mc2_w_tax_no_pynast_failures_close_reference.biom",
                        PR['silva_reference_seqs']), shell=True)
 
         elif fungus:
-            execute("pick_open_reference_otus.py -i %s -o %s -p %s %s -n %s--suppress_align_and_tree"
+            pick_open_reference("pick_open_reference_otus.py -i %s -o %s -p %s %s -n %s--suppress_align_and_tree"
                     % (inFolder_fasta, outFolder, PR['parameter_file_name'], parallel_string,
-                       PR['c_otu_id']), shell=True)
+                       PR['c_otu_id']),
+                    outFolder, rdb, fungus, exact)
 
         else:
-            execute("pick_open_reference_otus.py -i %s -o %s -r %s -p %s -n %s"
+            pick_open_reference("pick_open_reference_otus.py -i %s -o %s -r %s -p %s -n %s"
                     % (inFolder_fasta, outFolder,
                        PR['gg_reference_seqs'], PR['parameter_file_name'],
-                       parallel_string, PR['c_otu_id']), shell=True)
+                       parallel_string, PR['c_otu_id']),
+                    outFolder, rdb, fungus, exact)
 
             execute("filter_otus_from_otu_table.py -i %s -o %s --negate_ids_to_exclude -e %s"
                     % (outFolder + "otu_table_mc2_w_tax_no_pynast_failures.biom",
                        outFolder + "otu_table_mc2_w_tax_no_pynast_failures_close_reference.biom",
                        PR['gg_reference_seqs']), shell=True)
 
-    if PR['remove_intermediate']:
+    if reference is not None:
+        shutil.rmtree(prepass)
+    write_manifests(key, [outFolder])
+    if PR['remove_intermediate'] and os.path.isdir(inFolder):
         os.removedirs(inFolder)
+    if fungus:
+        finish_step(step, [outFolder + "otu_table_mc2_w_tax.biom"])
+    else:
+        finish_step(step, [outFolder + "otu_table_mc2_w_tax_no_pynast_failures.biom"])
 
 
 def writedf(outFile, ids, sampleIds):
@@ -612,6 +3872,13 @@ def corediv(inFolder, outFolder, mappingFile, depth):
     else:
         biom = inFolder + "otu_table_mc2_w_tax_no_pynast_failures.biom"
     tree = inFolder + "rep_set.tre"
+    key = step_key("diversity analyses", [biom, mappingFile], [outFolder], {"depth": depth},
+                   ["core_diversity_analyses.py"])
+    if completed(key, [outFolder]):
+        return
+    if os.path.isdir(outFolder):
+        shutil.rmtree(outFolder)
+    step = start_step("diversity analyses", [biom], "all")
     # get_ipython().system(
     #    u'core_diversity_analyses.py -i {biom}     -o {out_folder}     -m {mapping_file}     -t {tree}     -e {depth}')
     if PR['fungus']:
@@ -622,6 +3889,114 @@ def corediv(inFolder, outFolder, mappingFile, depth):
         execute(
             "core_diversity_analyses.py -i %s -o %s -m %s -t %s -e %d" % (biom, outFolder, mappingFile, tree, depth),
             shell=True)
+    write_manifests(key, [outFolder])
+    finish_step(step, [])
+
+
+def write_profile():
+    """
+    Collect others/profile.jsonl into others/profile.json (the records and
+    a summary of each step) and others/profile.csv (the records), and print
+    the summary. Elapsed is the makespan of the step over all samples, the
+    other columns add up the samples, except tool_MB, the peak RSS of the
+    external tools of the step.
+
+    :return: None
+    """
+    jsonl = PR['others'] + "profile.jsonl"
+    if not os.path.isfile(jsonl):
+        return
+    records = [json.loads(line) for line in open(jsonl) if line.strip()]
+
+    stages = []
+    for record in records:
+        if record["kind"] != "command" and record["stage"] not in stages:
+            stages.append(record["stage"])
+
+    def total(values):
+        values = [v for v in values if v is not None]
+        return sum(values) if values else None
+
+    summary = []
+    for stage in stages:
+        steps = [r for r in records if r["kind"] == "step" and r["stage"] == stage]
+        elapsed = [r["wall"] for r in records if r["kind"] == "stage" and r["stage"] == stage]
+        summary.append({"stage": stage, "samples": len(steps), "elapsed": total(elapsed),
+                        "wall": total(r["wall"] for r in steps),
+                        "user": total(r["user"] for r in steps),
+                        "sys": total(r["sys"] for r in steps),
+                        "maxrss_kb": max([r["maxrss_kb"] for r in steps if r["maxrss_kb"] is not None] or [None]),
+                        "bytes_in": total(r["bytes_in"] for r in steps),
+                        "bytes_out": total(r["bytes_out"] for r in steps),
+                        "reads_in": total(r["reads_in"] for r in steps),
+                        "reads_out": total(r["reads_out"] for r in steps)})
+
+    with open(PR['others'] + "profile.json", "w") as f:
+        json.dump({"records": records, "summary": summary}, f, indent=1, sort_keys=True)
+    with open(PR['others'] + "profile.csv", "wb") as f:
+        writer = csv.writer(f)
+        writer.writerow(PROFILE_FIELDS)
+        for record in records:
+            writer.writerow([record.get(field) for field in PROFILE_FIELDS])
+    os.remove(jsonl)
+
+    def show(value, scale=1.0, form="%.1f"):
+        return "-" if value is None else form % (value / scale)
+
+    lines = ["%-20s %7s %10s %10s %10s %8s %9s %9s %11s %11s" % (
+        "step", "samples", "elapsed_s", "wall_s", "cpu_s", "tool_MB", "in_MB", "out_MB", "reads_in", "reads_out")]
+    for row in summary:
+        cpu = None if row["user"] is None else row["user"] + row["sys"]
+        lines.append("%-20s %7d %10s %10s %10s %8s %9s %9s %11s %11s" % (
+            row["stage"], row["samples"], show(row["elapsed"]), show(row["wall"]), show(cpu),
+            show(row["maxrss_kb"], 1024.0, "%.0f"), show(row["bytes_in"], 1e6), show(row["bytes_out"], 1e6),
+            show(row["reads_in"], form="%d"), show(row["reads_out"], form="%d")))
+    print("\nProfile (%s):" % (PR['others'] + "profile.csv"))
+    print("\n".join(lines))
+    loginfo("\n".join(lines))
+
+
+def preprocess(inFolder, outFolder, trimq, joining_method, fastq_p, maxloose,
+               qcq=None, rdb=None, last="chimera_removal"):
+    """
+    Run the per-sample steps: trimming, merging, quality control and
+    chimera removal.
+
+    :param last: the last step to run: (merging), (quality_control) or
+    (chimera_removal).
+    :return: None
+    """
+    trimmed = asfolder(outFolder + PR['Ftrimmed'])
+    merged = asfolder(outFolder + PR['Fmerged'])
+    qc = asfolder(outFolder + PR['Fqc'])
+    chi = asfolder(outFolder + PR['Fchi'])
+
+    # the samples of a removed folder are known from the input files, pipelinefolder() checks each of their steps
+    if PR['scheduler'] == "sample" or removed_intermediates([trimmed, merged, qc]):
+        pipelinefolder(inFolder, trimmed, merged, qc, chi, trimq, joining_method,
+                       fastq_p, maxloose, qcq, rdb, last)
+        return
+
+    if PR['streaming']:
+        if last == "merging":
+            streamfolder(inFolder, merged, None, trimq, fastq_p, None)
+            return
+        streamfolder(inFolder, None, qc, trimq, fastq_p, qcq)
+    else:
+        trimfolder(inFolder, trimmed, trimq)
+        if joining_method == "fastq-join":
+            mergefolder(trimmed, merged, fastq_p)
+        elif joining_method == "native":
+            mergefoldernative(trimmed, merged, fastq_p)
+        elif joining_method == "bbmerge":
+            mergefolderbb(trimmed, merged, maxloose=maxloose)
+        else:
+            raise ValueError("%s: unknown merging method" % joining_method)
+        if last == "merging":
+            return
+        qualitycontrol(merged, qc, qcq)
+    if last == "chimera_removal":
+        removechimera(qc, chi, rdb)
 
 
 def full_analysis(inFolder, outFolder, depth, rdb, trimq, joining_method,
@@ -630,22 +4005,12 @@ def full_analysis(inFolder, outFolder, depth, rdb, trimq, joining_method,
     """
 
     """
-    trimmed = asfolder(outFolder + PR['Ftrimmed'])
-    merged = asfolder(outFolder + PR['Fmerged'])
     qc = asfolder(outFolder + PR['Fqc'])
     chi = asfolder(outFolder + PR['Fchi'])
     otus = asfolder(outFolder + PR['Fotus'])
     div = asfolder(outFolder + PR['Fdiv'])
 
-    trimfolder(inFolder, trimmed, trimq)
-    if joining_method == "fastq-join":
-        mergefolderfastq(trimmed, merged, fastq_p)
-    elif joining_method == "bbmerge":
-        mergefolderbb(trimmed, merged, maxloose=maxloose)
-    else:
-        raise ("Wrong method")
-    qualitycontrol(merged, qc, qcq)
-    removechimera(qc, chi, rdb)
+    preprocess(inFolder, outFolder, trimq, joining_method, fastq_p, maxloose, qcq, rdb)
     pickotus(chi, otus, rdb)
     # here
     if create_mapping_file:
@@ -655,15 +4020,8 @@ def full_analysis(inFolder, outFolder, depth, rdb, trimq, joining_method,
 
 def stop_at_merging(inFolder, outFolder, trimq, joining_method, maxloose, fastq_p):
     global PR
-    trimmed = asfolder(outFolder + PR['Ftrimmed'])
-    merged = asfolder(outFolder) + PR['Fmerged']
-    trimfolder(inFolder, trimmed, trimq)
-    if joining_method == "fastq-join":
-        mergefolderfastq(trimmed, merged, fastq_p)
-    elif joining_method == "bbmerge":
-        mergefolderbb(trimmed, merged, maxloose=maxloose)
-    else:
-        raise ("%s: unknown merging metod method" % joining_method)
+    preprocess(inFolder, outFolder, trimq, joining_method, fastq_p, maxloose,
+               last="merging")
 
 
 def stop_at_quality_control(inFolder, outFolder, joining_method, trimq,
@@ -672,18 +4030,8 @@ def stop_at_quality_control(inFolder, outFolder, joining_method, trimq,
     """
     """
 
-    trimmed = asfolder(outFolder + PR['Ftrimmed'])
-    merged = asfolder(outFolder + PR['Fmerged'])
-    qc = asfolder(outFolder + PR['Fqc'])
-
-    trimfolder(inFolder, trimmed, trimq)
-    if joining_method == "fastq-join":
-        mergefolderfastq(trimmed, merged, fastq_p)
-    elif joining_method == "bbmerge":
-        mergefolderbb(trimmed, merged, maxloose=maxloose)
-    else:
-        raise ("%s: unknown merging metod method" % joining_method)
-    qualitycontrol(merged, qc, qcq)
+    preprocess(inFolder, outFolder, trimq, joining_method, fastq_p, maxloose, qcq,
+               last="quality_control")
 
 
 def stop_at_chimera_removal(inFolder, outFolder, rdb, trimq, joining_method,
@@ -694,20 +4042,7 @@ def stop_at_chimera_removal(inFolder, outFolder, rdb, trimq, joining_method,
 
     global PR
 
-    trimmed = asfolder(outFolder + PR['Ftrimmed'])
-    merged = asfolder(outFolder + PR['Fmerged'])
-    qc = asfolder(outFolder + PR['Fqc'])
-    chi = asfolder(outFolder + PR['Fchi'])
-
-    trimfolder(inFolder, trimmed, trimq)
-    if joining_method == "fastq-join":
-        mergefolderfastq(trimmed, merged, fastq_p)
-    elif joining_method == "bbmerge":
-        mergefolderbb(trimmed, merged, maxloose=maxloose)
-    else:
-        raise ("%s: unknown merging metod method" % joining_method)
-    qualitycontrol(merged, qc, qcq)
-    removechimera(qc, chi, rdb)
+    preprocess(inFolder, outFolder, trimq, joining_method, fastq_p, maxloose, qcq, rdb)
 
 
 def start_at_chimera_removal(inFolder, outFolder, rdb, depth):
@@ -748,6 +4083,190 @@ def start_diversity_analysis(inFolder, outFolder, mapping_file, depth):
     corediv(inFolder=otus, outFolder=div, mappingFile=mapping_file, depth=depth)
 
 
+def input_samples(inFolder):
+    """
+    Names of the fasta files the fastq files of an input folder become after
+    quality control, "A_S1.fasta" for A_S1_L001_R1_001.fastq.gz.
+
+    :rtype: list
+    """
+    files = sorted(x for x in os.listdir(inFolder) if "_R1_" in x)
+    return [sample_name(x) + ".fasta" for x in files]
+
+
+def study_samples(mappingFile):
+    """
+    Sample ids of a mapping file.
+
+    :rtype: list
+    """
+    return [line.split("\t")[0].strip() for line in open(mappingFile)
+            if line.strip() and not line.startswith("#")]
+
+
+def keep_before(filename):
+    """
+    Move a file or folder of the existing study out of the way before it is
+    replaced, A.biom becomes A_before_<run id>.biom.
+
+    :return: the new name.
+    """
+    base, extension = os.path.splitext(filename.rstrip("/"))
+    kept = "%s_before_%s%s" % (base, PR['id'], extension)
+    os.rename(filename, kept)
+    return kept
+
+
+def extend_study(otus, existing, rdb, fungus):
+    """
+    Add the otus picked for the new samples to the otus folder of the
+    existing study: the otu tables are merged, the new representative
+    sequences are added to rep_set.fna and its tree is built again, and
+    new_refseqs.fna is replaced by the one of the new samples, which holds
+    the existing one. The new files are made in the adding/ folder of the
+    study and moved in place when all of them are there, the replaced files
+    are kept, see keep_before(). A run that stops before leaves the study
+    as it was.
+
+    :param otus: otus folder of the new samples.
+    :param existing: otus folder of the existing study.
+    :return: None
+    """
+    print("Adding the new samples to %s" % existing)
+    staging = asfolder(existing + "adding")
+    if os.path.isdir(staging):
+        # left by a run that stopped before the study was changed
+        shutil.rmtree(staging)
+    os.mkdir(staging)
+    names = ["otu_table_mc2_w_tax.biom"]
+    if not fungus:
+        names.append("otu_table_mc2_w_tax_no_pynast_failures.biom")
+    for name in names:
+        execute("merge_otu_tables.py -i %s,%s -o %s" % (existing + name, otus + name, staging + name), shell=True)
+    shutil.copy(otus + "new_refseqs.fna", staging + "new_refseqs.fna")
+    names.append("new_refseqs.fna")
+
+    if not fungus:
+        with open(existing + "rep_set.fna", "rb") as old:
+            records = list(read_fasta(old))
+        ids = set(label.split()[0] for label, sequence in records)
+        with open(otus + "rep_set.fna", "rb") as new:
+            added = [(label, sequence) for label, sequence in read_fasta(new) if label.split()[0] not in ids]
+        with open(staging + "rep_set.fna", "wb") as out:
+            write_fasta(out, records + added)
+        loginfo("%d new representative sequences added to %s" % (len(added), existing + "rep_set.fna"))
+
+        if rdb == "silva":
+            template = PR['silva_core_alignment']
+        else:
+            template = PR['gg_core_alignment']
+        aligned = asfolder(staging + "pynast_aligned_seqs")
+        execute("align_seqs.py -i %s -o %s -t %s" % (staging + "rep_set.fna", aligned, template), shell=True)
+        execute("filter_alignment.py -i %s -o %s" % (aligned + "rep_set_aligned.fasta", aligned), shell=True)
+        execute("make_phylogeny.py -i %s -o %s" % (aligned + "rep_set_aligned_pfiltered.fasta",
+                                                   staging + "rep_set.tre"), shell=True)
+        names += ["rep_set.fna", "pynast_aligned_seqs", "rep_set.tre"]
+
+    missing = [name for name in names if not os.path.exists(staging + name)]
+    if missing:
+        shutil.rmtree(staging)
+        raise IOError("adding the samples to %s failed, %s not made, the study is not changed"
+                      % (existing, ", ".join(missing)))
+    for name in names:
+        if os.path.exists(existing + name):
+            kept = keep_before(existing + name)
+            loginfo("%s of %s kept as %s" % (name, existing, kept))
+        os.rename(staging + name, existing + name)
+    os.rmdir(staging)
+
+
+def check_new_samples(samples, table):
+    """
+    Stop when samples to add are already in the otu table of the study.
+
+    :param samples: sample ids.
+    :param table: otu_table_mc2_w_tax.biom of the study.
+    :return: None
+    """
+    duplicates = sorted(set(samples) & set(table_ids(table)[1]))
+    if duplicates:
+        raise ValueError("samples already in %s: %s" % (table, ", ".join(duplicates)))
+
+
+def add_samples(inFolder, outFolder, existing, depth, rdb, trimq, joining_method,
+                qcq, maxloose, fastq_p):
+    """
+    Add the samples of inFolder to the study of an existing output folder.
+    The new samples are processed in outFolder up to otu picking against the
+    new_refseqs.fna of the existing study (--continuation_reference), their
+    otus are added to the existing otus folder (extend_study()) and the
+    diversity analyses of the existing study are run again with all samples.
+    The samples are added once: a resumed run does not add them again (see
+    completed()) and samples already in the otu table of the study are
+    refused.
+
+    :param existing: output folder of the existing study.
+    :return: None
+    """
+    global PR
+    existing = asfolder(existing)
+    chi = asfolder(outFolder + PR['Fchi'])
+    otus = asfolder(outFolder + PR['Fotus'])
+    study_otus = asfolder(existing + PR['Fotus'])
+    study_div = asfolder(existing + PR['Fdiv'])
+    study_map = existing + PR['Fothers'] + "map.tsv"
+
+    study_table = study_otus + "otu_table_mc2_w_tax.biom"
+    added = PR['others'] + "added_samples.txt"
+
+    if create_mapping_file and not os.path.isfile(study_map):
+        raise ValueError("%s was analysed with a mapping file, give a mapping file of all the samples with -a"
+                         % existing)
+    files = input_samples(inFolder)
+    new = [sample_name(x) for x in files]
+    if read_manifest(added) is None:
+        check_new_samples(new, study_table)
+    if not os.path.isfile(PR['c_ref']):
+        # the otus of the new samples are picked against the study as it was
+        shutil.copy(study_otus + "new_refseqs.fna", PR['c_ref'] + ".tmp")
+        os.rename(PR['c_ref'] + ".tmp", PR['c_ref'])
+
+    preprocess(inFolder, outFolder, trimq, joining_method, fastq_p, maxloose, qcq, rdb)
+    pickotus(chi, otus, rdb, PR['fungus'])
+
+    inputs = [otus + name for name in ("otu_table_mc2_w_tax.biom", "new_refseqs.fna")]
+    if not PR['fungus']:
+        inputs += [otus + name for name in ("otu_table_mc2_w_tax_no_pynast_failures.biom", "rep_set.fna")]
+    key = step_key("adding samples", inputs, [added], {"existing": study_otus, "fungus": PR['fungus']},
+                   ["merge_otu_tables.py", "align_seqs.py", "filter_alignment.py", "make_phylogeny.py"])
+    if not completed(key, [added]):
+        check_new_samples(new, study_table)
+        step = start_step("adding samples", inputs, "all")
+        extend_study(otus, study_otus, rdb, PR['fungus'])
+        with io.open(added, "w", encoding="utf-8") as f:
+            f.write("".join("%s\n" % sample for sample in new))
+        write_manifests(key, [added])
+        finish_step(step, [added])
+
+    if create_mapping_file:
+        writedf(PR['mapping_file'], new, files)
+        known = set(study_samples(study_map))
+        lines = [line for line in open(PR['mapping_file']).readlines()[1:] if line.split("\t")[0] not in known]
+        if lines:
+            kept = keep_before(study_map)
+            with open(study_map, "w") as out:
+                out.writelines(open(kept).readlines())
+                out.writelines(lines)
+            loginfo("mapping file of %s kept as %s" % (existing, kept))
+        mapping = study_map
+    else:
+        # a mapping file of all the samples of the study
+        mapping = PR['mapping_file']
+    if os.path.isdir(study_div):
+        keep_before(study_div)
+    corediv(study_otus, study_div, mapping, depth)
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="""Microbiome analysis using multiple methods
@@ -783,6 +4302,24 @@ if __name__ == "__main__":
                         help="fastq-join's percentage of mismatch [default: 16]",
                         default=16)
 
+    parser.add_argument("--trimmer",
+                        dest="trimmer",
+                        help="trimming method: (bbduk), (fused) in-process primer, quality and length trimming "
+                             "in one pass without temporary files or (numpy) the same with vectorized quality "
+                             "trimming, bbduk is used when --adapter is given [default: bbduk]",
+                        type=str,
+                        metavar="trimming method",
+                        choices=['bbduk', 'fused', 'numpy'],
+                        default="bbduk")
+
+    parser.add_argument("--min_read_length",
+                        dest="min_read_length",
+                        metavar="Minimum read length",
+                        type=int,
+                        help="read pairs are removed if either read is shorter than this after fused or numpy "
+                             "trimming [default: 10]",
+                        default=10)
+
     parser.add_argument("--adapter",
                         metavar=None,
                         dest="adapter_reference",
@@ -807,10 +4344,11 @@ if __name__ == "__main__":
 
     parser.add_argument("-j",
                         dest='joining_method',
-                        help="choose the merging method (fastq-join) or (bbmerge) [default: fastq-join]",
+                        help="choose the merging method (fastq-join), (bbmerge) or (native) built-in merger using "
+                             "fastq-join's -p rule [default: fastq-join]",
                         type=str,
                         metavar="joining method",
-                        choices = ['fastq-join', "bbmerge"],
+                        choices = ['fastq-join', "bbmerge", "native"],
                         default="fastq-join")
 
     parser.add_argument("-m",
@@ -825,6 +4363,99 @@ if __name__ == "__main__":
                         help="quality control phred threshold [default: 19]",
                         default=19)
 
+    parser.add_argument("--qc_method",
+                        dest="qc_method",
+                        help="quality control method: (split_libraries) QIIME's split_libraries_fastq.py or (native) "
+                             "the same filter in-process [default: split_libraries]",
+                        type=str,
+                        metavar="quality control method",
+                        choices=['split_libraries', 'native'],
+                        default="split_libraries")
+
+    parser.add_argument("--streaming",
+                        dest="streaming",
+                        help="trim, merge and quality control each sample in one pass without writing the "
+                             "trimmed and merged files (merged files are written with -s merging), needs "
+                             "--trimmer fused or numpy, -j native and --qc_method native",
+                        action="store_true")
+
+    parser.add_argument("--compress_level",
+                        dest="compress_level",
+                        metavar="Compression level",
+                        type=int,
+                        choices=range(10),
+                        help="gzip level of the trimmed and merged fastq files, 0 writes them uncompressed: "
+                             "faster when the CPU is the bottleneck, 1-9 use less disk and I/O [default: 0]",
+                        default=0)
+
+    parser.add_argument("--chunk_size",
+                        dest="chunk_size",
+                        metavar="Chunk size",
+                        type=float,
+                        help="size in MB above which the uncompressed fastq files of a sample are split in chunks "
+                             "trimmed and merged in parallel, 0 never splits them [default: 1024]",
+                        default=1024)
+
+    parser.add_argument("--bb_batch",
+                        dest="bb_batch",
+                        metavar="Batch size",
+                        type=int,
+                        help="number of samples trimmed by one bbduk.sh or merged by one bbmerge.sh, the reads "
+                             "are tagged with their sample and written back to the sample files while the tool "
+                             "runs, saves the JVM start-up of many small samples (--scheduler stage) [default: 1]",
+                        default=1)
+
+    parser.add_argument("--scheduler",
+                        dest="scheduler",
+                        help="(stage) every step waits for all samples to finish the previous step, (sample) each "
+                             "sample moves to its next step as soon as it is ready [default: stage]",
+                        type=str,
+                        metavar="scheduler",
+                        choices=['stage', 'sample'],
+                        default="stage")
+
+    parser.add_argument("--dereplicate",
+                        dest="dereplicate",
+                        help="collapse identical sequences of all samples and run chimera removal once on the "
+                             "unique sequences, only the reference based usearch61 check is used (the de novo "
+                             "check needs the reads of each sample)",
+                        action="store_true")
+
+    parser.add_argument("--chimera_cache",
+                        dest="chimera_cache",
+                        help="keep the chimera verdicts of the sequences in a cache so they are not checked again "
+                             "in the next runs, only the reference based usearch61 check is used",
+                        action="store_true")
+
+    parser.add_argument("--cache_folder",
+                        dest="cache_folder",
+                        metavar="Cache folder",
+                        type=str,
+                        help="folder of the caches kept between runs [default: ~/.auto-q/]",
+                        default="~/.auto-q/")
+
+    parser.add_argument("--cache_size",
+                        dest="cache_size",
+                        metavar="Cache size",
+                        type=int,
+                        help="maximum number of entries of each cache, the least recently used are removed "
+                             "[default: 5000000]",
+                        default=5000000)
+
+    parser.add_argument("--exact_match",
+                        dest="exact_match",
+                        help="assign the reads identical to a reference sequence, or to the start of the reference "
+                             "sequences of one OTU (reference cut to the amplicon), to that OTU before otu picking, "
+                             "only the other reads go through pick_open_reference_otus.py; the reference is "
+                             "indexed once in the cache folder",
+                        action="store_true")
+
+    parser.add_argument("--taxonomy_cache",
+                        dest="taxonomy_cache",
+                        help="keep the taxonomy of the representative sequences in a cache so only new sequences "
+                             "are classified by assign_taxonomy.py in the next runs",
+                        action="store_true")
+
     parser.add_argument("--continuation_reference",
                         dest="c_ref",
                         type=str,
@@ -840,6 +4471,17 @@ if __name__ == "__main__":
                         help="continuation reference new otus ids",
                         default="New")
 
+    parser.add_argument("--add_to",
+                        dest="add_to",
+                        metavar="Existing output folder",
+                        help="add the samples of -i to the study of an existing output folder: they are processed "
+                             "in -o, their otus are picked against the otus/new_refseqs.fna of the existing folder, "
+                             "added to its otu tables and tree, and its diversity analyses are run again; the "
+                             "replaced files are kept with a _before_<run id> suffix. The ids of the new otus are "
+                             "--continuation_otu_id followed by a hash of the added samples. Can not be used with "
+                             "--continuation_reference",
+                        default=None)
+
     parser.add_argument("-r",
                         dest="rdb",
                         metavar="Reference database",
@@ -876,6 +4518,49 @@ if __name__ == "__main__":
                         dest="number_of_cores",
                         default=2)
 
+    parser.add_argument("--executor",
+                        dest="executor",
+                        help="run the per-sample steps on threads or processes, auto uses processes for the "
+                             "steps running python code and threads for the external tools [default: auto]",
+                        choices=['auto', 'threads', 'processes'],
+                        default="auto")
+
+    parser.add_argument("--fail_fast",
+                        dest="fail_fast",
+                        help="stop when an external tool of the steps run on all samples (pooled chimera removal, "
+                             "otu picking, diversity analyses) exits with an error instead of logging a warning, "
+                             "a failed tool of a per-sample step always stops the step",
+                        action="store_true")
+
+    parser.add_argument("--log_size",
+                        dest="log_size",
+                        metavar="Log size",
+                        type=float,
+                        help="size in MB at which log.txt is rotated, %d old logs are kept [default: 100]"
+                             % LOG_BACKUPS,
+                        default=100)
+
+    parser.add_argument("--command_log_size",
+                        dest="command_log_size",
+                        metavar="Command log size",
+                        type=int,
+                        help="maximum output in KB of each external command written to the log [default: 1024]",
+                        default=1024)
+
+    parser.add_argument("--count_reads",
+                        dest="count_reads",
+                        help="count the reads of the inputs and outputs of every step for the profile, the files "
+                             "of the steps run by external tools are read once more [default: only the steps "
+                             "running in python count their reads]",
+                        action="store_true")
+
+    parser.add_argument("--memory",
+                        dest="memory",
+                        metavar="Memory",
+                        type=float,
+                        help="memory in GB shared by the tools running at the same time "
+                             "[default: 80%% of the available memory]")
+
     parser.add_argument("-e",
                         dest="depth",
                         type=int,
@@ -883,6 +4568,29 @@ if __name__ == "__main__":
                         help="sampling depth for diversity analyses [default: 10000]",
                         default=10000)
 
+    parser.add_argument("--subsample",
+                        dest="subsample",
+                        metavar="subsampling point",
+                        choices=['qc', 'input'],
+                        help="keep a random subset of the reads of each sample, --subsample_factor times the "
+                             "sampling depth: (qc) of the quality controlled reads or (input) of the read pairs "
+                             "before trimming, the later steps handle fewer reads")
+
+    parser.add_argument("--subsample_factor",
+                        dest="subsample_factor",
+                        metavar="Subsampling factor",
+                        type=float,
+                        help="reads kept by --subsample as a multiple of the sampling depth, use a larger factor "
+                             "with --subsample input as merging and quality control remove reads [default: 2]",
+                        default=2.0)
+
+    parser.add_argument("--seed",
+                        dest="seed",
+                        metavar="Random seed",
+                        type=int,
+                        help="random seed of --subsample [default: 1]",
+                        default=1)
+
     parser.add_argument("--remove_intermediate_files",
                         help="To remove intermediate files, to reduce the disk space",
                         dest="remove_intermediate",
@@ -926,25 +4634,52 @@ if __name__ == "__main__":
         # ress,
         'rdb': arg.rdb,
         'qcq': arg.qc_threshold,
+        'qc_method': arg.qc_method,
+        'streaming': arg.streaming,
+        'compress_level': arg.compress_level,
+        'chunk_size': arg.chunk_size,
+        'bb_batch': arg.bb_batch,
+        'scheduler': arg.scheduler,
+        'executor': arg.executor,
+        'fail_fast': arg.fail_fast,
+        'log_size': arg.log_size,
+        'command_log_size': arg.command_log_size,
+        'count_reads': arg.count_reads,
+        'dereplicate': arg.dereplicate,
+        'chimera_cache': arg.chimera_cache,
+        'cache_folder': asfolder(os.path.expanduser(arg.cache_folder)),
+        'cache_size': arg.cache_size,
         'maxloose': arg.maxloose,
         'trimq': arg.trim_threshold,
         'joining_method': arg.joining_method,
         'fastq_p': arg.fastq_p,
         'depth': arg.depth,
+        'subsample': arg.subsample,
+        'subsample_factor': arg.subsample_factor,
+        'seed': arg.seed,
         'ConfigFile': arg.ConfigFile,
         'parameter_file_name': arg.parameter_file_name,
         'remove_intermediate': arg.remove_intermediate,
         'beginwith': arg.beginwith,
+        'stop_at': arg.stop_at,
         'mapping_file': arg.mapping_file,
         'adapter_ref': arg.adapter_reference,
+        'trimmer': arg.trimmer,
+        'min_read_length': arg.min_read_length,
         'minimum_length': arg.minimum_length,
         'c_ref': arg.c_ref,
+        'exact_match': arg.exact_match,
+        'taxonomy_cache': arg.taxonomy_cache,
         'c_otu_id': arg.c_otu_id,
+        'add_to': arg.add_to,
         'primertrim_forward': arg.primertrim_forward,
-        'primertrim_reverse': arg.primertrim_reverse})
+        'primertrim_reverse': arg.primertrim_reverse,
+        'memory': arg.memory})
 
     ## parameter_file
     get_configuration()
+    # an output folder with manifests is from an earlier run, the steps done in it are skipped
+    PR['resume'] = os.path.isdir(asfolder(PR['out_folder'] + PR['Fothers']) + "manifests")
     check_before_start()
 
 
@@ -956,6 +4691,18 @@ if __name__ == "__main__":
         PR['fungus'] = True
     else:
         PR['fungus'] = False
+    if PR['add_to'] is not None:
+        if PR['c_ref'] != "none":
+            raise ValueError("--add_to picks the otus against the new_refseqs.fna of %s, "
+                             "it can not be used with --continuation_reference" % PR['add_to'])
+        # the new otus continue the otus of the existing study, their ids are
+        # prefixed with a hash of the added samples so they do not collide;
+        # new_refseqs.fna of the study is copied there by add_samples(), a
+        # resumed run picks against the study as it was before the samples
+        # were added
+        PR['c_ref'] = asfolder(PR['out_folder'] + PR['Fothers']) + "study_refseqs.fna"
+        added = ",".join(input_samples(PR['in_folder'])).encode("utf-8")
+        PR['c_otu_id'] = "%s%s." % (PR['c_otu_id'], hashlib.sha1(added).hexdigest()[:8])
     PR['others'] = asfolder(PR['out_folder'] + PR['Fothers'])
     PR['number_of_cores'] = arg.number_of_cores
     if PR['number_of_cores'] == 1:
@@ -963,18 +4710,19 @@ if __name__ == "__main__":
     else:
         PR['np'] = False
 
-    if (os.path.isdir(PR['out_folder'])):
+    if PR['resume']:
+        print("Resuming the run in %s" % PR['out_folder'])
+    elif (os.path.isdir(PR['out_folder'])):
         sys.exit()
     else:
         os.mkdir(PR['out_folder'])
     if not os.path.isdir(PR['others']):
         os.mkdir(PR['others'])
 
-    logging.basicConfig(filename=PR['others'] + "log.txt",
-                        format='%(levelname)s \n %(message)s',
-                        level=logging.DEBUG)
+    start_logging(PR['others'] + "log.txt")
     loginfo('started')
     [loginfo(str(P) + ": " + str(PR[P])) for P in PR]
+    allocate_resources()
 
 #    if PR['decompress']:
 #        copyfilesanddecompress(PR['in_folder'], asfolder(PR['out_folder']+"fastq"))
@@ -988,6 +4736,7 @@ if __name__ == "__main__":
         create_mapping_file = True
         PR['mapping_file'] = PR['others'] + "map.tsv"
     else:
+        create_mapping_file = False
         PR['mapping_file'] = arg.mapping_file
 
     if (arg.beginwith == "diversity_analysis") and (arg.mapping_file == None):
@@ -996,7 +4745,19 @@ if __name__ == "__main__":
     number_of_cores = PR['number_of_cores']
 
 
-    if arg.beginwith == "otu_picking":
+    if PR['add_to'] is not None:
+        add_samples(inFolder=PR['in_folder'],
+                    outFolder=PR['out_folder'],
+                    existing=PR['add_to'],
+                    depth=PR['depth'],
+                    rdb=PR['rdb'],
+                    trimq=PR['trimq'],
+                    joining_method=PR['joining_method'],
+                    qcq=PR['qcq'],
+                    maxloose=PR['maxloose'],
+                    fastq_p=PR['fastq_p'])
+
+    elif arg.beginwith == "otu_picking":
         start_otu_pickng(inFolder=PR['in_folder'],
                          outFolder=PR['out_folder'],
                          rdb=PR['rdb'],
@@ -1054,5 +4815,6 @@ if __name__ == "__main__":
                       depth=PR['depth'],
                       trimq=PR['trimq'])
 
+    write_profile()
     loginfo("Finished")
 
@@ -0,0 +1,154 @@
+# coding: utf-8
+"""
+Helpers shared by the benchmark scripts.
+"""
+from __future__ import print_function
+
+import bisect
+import imp
+import math
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+AUTOQ = os.path.join(HERE, os.pardir, "auto-q.py")
+STUBS = os.path.join(HERE, "stubs")
+GZIP_LEVEL = 6  # compression level of the generated .gz files, the gzip default
+
+
+def load_autoq():
+    """
+    auto-q.py can not be imported by name because of the dash, it is
+    loaded once so changes to its PR dict are kept.
+    """
+    if "autoq" not in sys.modules:
+        imp.load_source("autoq", AUTOQ)
+    return sys.modules["autoq"]
+
+
+def write_reads(filename, n, length=300, seed=1):
+    autoq = load_autoq()
+    rnd = random.Random(seed)
+    f = autoq.open_fastq(filename, "w", GZIP_LEVEL)
+    for i in range(n):
+        seq = "".join(rnd.choice("ACGT") for _ in range(length))
+        qual = "".join(chr(33 + rnd.randint(2, 40)) for _ in range(length))
+        f.write(("@read%d\n%s\n+\n%s\n" % (i, seq, qual)).encode("ascii"))
+    f.close()
+
+
+def write_pairs(filename1, filename2, n, length=300, seed=1):
+    """
+    Read pairs with Illumina-like quality: high at the start of the
+    read and dropping towards the 3' end.
+    """
+    autoq = load_autoq()
+    rnd = random.Random(seed)
+    files = [autoq.open_fastq(filename1, "w", GZIP_LEVEL), autoq.open_fastq(filename2, "w", GZIP_LEVEL)]
+    for i in range(n):
+        for f in files:
+            seq = "".join(rnd.choice("ACGT") for _ in range(length))
+            qual = "".join(chr(33 + max(2, min(40, int(rnd.gauss(38 - 25.0 * j / length, 4)))))
+                           for j in range(length))
+            f.write(("@read%d\n%s\n+\n%s\n" % (i, seq, qual)).encode("ascii"))
+    for f in files:
+        f.close()
+
+
+def quality_profiles(n, length, q_start, q_end, rnd):
+    """
+    n quality strings dropping linearly from q_start to q_end along the
+    read with some noise, and the error probability of each position.
+    """
+    profiles = []
+    for _ in range(n):
+        qs = [max(2, min(40, int(round(rnd.gauss(q_start + (q_end - q_start) * float(j) / length, 3)))))
+              for j in range(length)]
+        profiles.append(("".join(chr(33 + q) for q in qs), [10 ** (-q / 10.0) for q in qs]))
+    return profiles
+
+
+def add_errors(seq, probabilities, rnd):
+    """
+    Substitute the bases of seq, position j with probability
+    probabilities[j]. The candidate positions are drawn with geometric
+    gaps at the highest probability and kept with probability p / top, so
+    the cost depends on the number of errors and not on the read length.
+    """
+    top = max(probabilities)
+    if top >= 1:
+        top = 0.999
+    seq = list(seq)
+    j = -1
+    while True:
+        j += 1 + int(math.log(1.0 - rnd.random()) / math.log(1.0 - top))
+        if j >= len(seq):
+            break
+        if rnd.random() * top < probabilities[j]:
+            seq[j] = rnd.choice([b for b in "ACGT" if b != seq[j]])
+    return "".join(seq)
+
+
+def write_amplicons(folder, samples=4, pairs=20000, length=250, overlap=80, q_start=38, q_end=15,
+                    templates=200, gz=False, seed=1):
+    """
+    Synthetic paired-end amplicon data: every pair is read from both ends
+    of an amplicon of 2 * length - overlap bases, drawn from a pool of
+    templates with skewed abundances, and carries substitution errors at
+    the rate of its quality scores. The files are named like MiSeq output,
+    S01_L001_R1_001.fastq(.gz), and are the same for the same seed.
+
+    :return: list of (R1 file, R2 file) of the samples.
+    """
+    autoq = load_autoq()
+    rnd = random.Random(seed)
+    amplicon = 2 * length - overlap
+    if overlap < 0 or amplicon <= length:
+        raise ValueError("overlap must be between 0 and the read length")
+    pool = ["".join(rnd.choice("ACGT") for _ in range(amplicon)) for _ in range(templates)]
+    pool = [(t[:length], t[-length:].translate(autoq.COMPLEMENT)[::-1]) for t in pool]
+    cumulative = []
+    for rank in range(templates):
+        cumulative.append((cumulative[-1] if cumulative else 0) + 1.0 / (rank + 1))
+    profiles = quality_profiles(64, length, q_start, q_end, rnd)
+    ext = ".fastq.gz" if gz else ".fastq"
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    files = []
+    for s in range(samples):
+        names = [os.path.join(folder, "S%02d_L001_R%d_001%s" % (s + 1, r, ext)) for r in (1, 2)]
+        out = [autoq.open_fastq(name, "w", GZIP_LEVEL) for name in names]
+        for i in range(pairs):
+            t = pool[bisect.bisect(cumulative, rnd.random() * cumulative[-1])]
+            for r in (0, 1):
+                qual, probabilities = rnd.choice(profiles)
+                seq = add_errors(t[r], probabilities, rnd)
+                out[r].write(("@SIM:1:FC:1:1:%d:%d %d:N:0:1\n%s\n+\n%s\n" % (s + 1, i, r + 1, seq, qual))
+                             .encode("ascii"))
+        for f in out:
+            f.close()
+        files.append(tuple(names))
+    return files
+
+
+def measure(function, *args):
+    """
+    Run function(*args) in a child process.
+
+    :return: (seconds, peak rss of the child and its subprocesses in kB)
+    """
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            function(*args)
+        except Exception as e:
+            print(e)
+            os._exit(1)
+        os._exit(0)
+    _, status, usage = os.wait4(pid, 0)
+    if status != 0:
+        raise RuntimeError("%s failed" % function.__name__)
+    return time.time() - start, usage.ru_maxrss
@@ -0,0 +1,53 @@
+#! /usr/bin/env python
+# coding: utf-8
+"""
+Peak memory of the streaming fastq functions of auto-q.
+
+Every measurement runs in its own child process, its peak resident set
+size is read back with os.wait4, so the numbers are not mixed between runs.
+
+usage: fastq_memory.py [-r reads,reads,...] [--gz]
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+from common import load_autoq, measure, write_reads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-r", dest="reads", default="20000,80000,320000",
+                        help="comma separated numbers of reads per file")
+    parser.add_argument("--gz", dest="gz", action="store_true",
+                        help="use gzip compressed input and output")
+    arg = parser.parse_args()
+
+    autoq = load_autoq()
+    autoq.PR.update({'compress_level': 6, 'tool_threads': 1})
+    ext = ".fastq.gz" if arg.gz else ".fastq"
+    temp = tempfile.mkdtemp()
+    autoq.PR['others'] = temp + "/"
+    try:
+        print("%-20s %10s %10s %10s %12s" % ("function", "reads", "MB",
+                                           "seconds", "peak_rss_kB"))
+        for n in [int(x) for x in arg.reads.split(",")]:
+            infile = os.path.join(temp, "in%d%s" % (n, ext))
+            outfile = os.path.join(temp, "out%s" % ext)
+            write_reads(infile, n)
+            size = os.path.getsize(infile) / 1e6
+            for function, length in [(autoq.primertrim, 17),
+                                     (autoq.remove_short_reads, 250)]:
+                seconds, rss = measure(function, infile, outfile, length)
+                print("%-20s %10d %10.1f %10.2f %12d" % (function.__name__, n, size,
+                                                       seconds, rss))
+    finally:
+        shutil.rmtree(temp)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,51 @@
+#! /usr/bin/env python
+# coding: utf-8
+"""
+Write a synthetic paired-end amplicon data set, see
+common.write_amplicons(). The same seed gives the same files, the folder
+can be used as the input folder of auto-q.
+
+usage: generate.py -o folder [-s samples] [-p pairs] [-l length] [-v overlap]
+                   [--q_start q] [--q_end q] [--templates n] [--gz] [--seed n]
+"""
+from __future__ import print_function
+
+import argparse
+import sys
+
+from common import write_amplicons
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-o", dest="folder", required=True,
+                        help="output folder")
+    parser.add_argument("-s", dest="samples", type=int, default=4,
+                        help="number of samples [default: 4]")
+    parser.add_argument("-p", dest="pairs", type=int, default=20000,
+                        help="read pairs per sample [default: 20000]")
+    parser.add_argument("-l", dest="length", type=int, default=250,
+                        help="read length [default: 250]")
+    parser.add_argument("-v", dest="overlap", type=int, default=80,
+                        help="overlap of the two reads of a pair [default: 80]")
+    parser.add_argument("--q_start", dest="q_start", type=int, default=38,
+                        help="mean phred quality at the start of the reads [default: 38]")
+    parser.add_argument("--q_end", dest="q_end", type=int, default=15,
+                        help="mean phred quality at the end of the reads [default: 15]")
+    parser.add_argument("--templates", dest="templates", type=int, default=200,
+                        help="number of distinct amplicons [default: 200]")
+    parser.add_argument("--gz", dest="gz", action="store_true",
+                        help="write gzip compressed files")
+    parser.add_argument("--seed", dest="seed", type=int, default=1,
+                        help="random seed [default: 1]")
+    arg = parser.parse_args()
+
+    files = write_amplicons(arg.folder, arg.samples, arg.pairs, arg.length, arg.overlap,
+                            arg.q_start, arg.q_end, arg.templates, arg.gz, arg.seed)
+    for r1, r2 in files:
+        print(r1)
+        print(r2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,253 @@
+#! /usr/bin/env python
+# coding: utf-8
+"""
+Benchmark suite of auto-q: throughput and peak memory of the in-process
+functions and of the per-folder steps on synthetic amplicon data.
+
+The per-folder steps run the stand-ins of the external tools in stubs/,
+so only the work done by auto-q itself is measured. Every benchmark runs
+in its own child process (see common.measure), the best of the repeats is
+kept. The results are written as JSON, --compare reads the results of an
+earlier version and reports the benchmarks that became slower or larger
+than the tolerance, the exit status is 1 when there is one.
+
+usage: run.py [-o results.json] [--compare old.json] [--tolerance percent]
+              [-b name,name,...] [-n repeats] [-c cores] [-s samples] [-p pairs]
+              [-l length] [-v overlap] [--gz] [--seed n]
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from common import HERE, STUBS, load_autoq, measure, write_amplicons
+
+
+def configure(autoq, temp, cores):
+    """
+    The parameters normally set by the command line of auto-q.
+    """
+    autoq.PR.update({
+        'out_folder': temp + "/", 'others': temp + "/others/", 'cache_folder': temp + "/cache/",
+        'cache_size': 5000000, 'resume': False, 'compress_level': 0, 'chunk_size': 1024, 'bb_batch': 1,
+        'number_of_cores': cores, 'jvm_workers': cores,
+        'tool_threads': 1, 'tool_memory': 1000, 'executor': "auto", 'fail_fast': True,
+        'command_log_size': 1024, 'count_reads': False, 'remove_intermediate': False, 'trimmer': "fused",
+        'adapter_ref': None, 'primertrim_forward': 17, 'primertrim_reverse': 21,
+        'min_read_length': 10, 'minimum_length': 380, 'joining_method': "native", 'qc_method': "native",
+        'dereplicate': False, 'chimera_cache': False, 'silva_chim_ref': os.devnull,
+        'gg_chim_ref': os.devnull, 'streaming': False, 'subsample': None, 'subsample_factor': 2.0,
+        'seed': 1, 'depth': 10000})
+    os.mkdir(autoq.PR['others'])
+
+
+def benchmarks(autoq, data, arg):
+    """
+    The benchmarks: (name, function, args, number of reads of the input,
+    output file or folder removed before each run, parameters changed for
+    the benchmark).
+    """
+    s1 = data['raw'][0]
+    t1 = [autoq.intermediate(os.path.join(data['trimmed'], os.path.basename(x))) for x in s1]
+    m1 = os.path.join(data['merged'], "S01.fastq")
+    out = os.path.join(data['temp'], "out")
+    out1 = out + "_R1.fastq"
+    out2 = out + "_R2.fastq"
+    reads = arg.pairs * 2
+    all_reads = reads * arg.samples
+    merged = data['merged_reads']
+    qc = data['qc_reads']
+    tests = [
+        ("primertrim", autoq.primertrim, (s1[0], out1, 17), arg.pairs, out1, {}),
+        ("remove_short_reads", autoq.remove_short_reads, (m1, out1, 380), merged[0], out1, {}),
+        ("fused_trim", autoq.fusedtrim, (s1[0], s1[1], out1, out2, 12), reads, out1, {'trimmer': "fused"}),
+        ("numpy_trim", autoq.fusedtrim, (s1[0], s1[1], out1, out2, 12), reads, out1, {'trimmer': "numpy"}),
+        ("native_merge", autoq.nativemerge, (t1[0], t1[1], out1, 16), reads, out1, {}),
+        ("quality_filter", autoq.nativequalitycontrol, (m1, out1, "S01", 19), merged[0], out1, {}),
+        ("streaming", autoq.streamsample, (s1[0], s1[1], None, out1, "S01", 12, 16, 19), reads, out1, {}),
+        ("dereplicate", dereplicate, (autoq, data['qc'], out), sum(qc), out, {}),
+        ("trimfolder_bbduk", autoq.trimfolder, (data['rawFolder'], out, 12), all_reads, out,
+         {'trimmer': "bbduk"}),
+        ("trimfolder_bbduk_batched", autoq.trimfolder, (data['rawFolder'], out, 12), all_reads, out,
+         {'trimmer': "bbduk", 'bb_batch': arg.samples}),
+        ("trimfolder_fused", autoq.trimfolder, (data['rawFolder'], out, 12), all_reads, out,
+         {'trimmer': "fused"}),
+        ("trimfolder_fused_compressed", autoq.trimfolder, (data['rawFolder'], out, 12), all_reads, out,
+         {'trimmer': "fused", 'compress_level': 1}),
+        ("trimfolder_fused_chunked", autoq.trimfolder, (data['rawFolder'], out, 12), all_reads, out,
+         {'trimmer': "fused", 'chunk_size': arg.pairs * arg.length / 4e6}),
+        ("mergefolder_fastq_join", autoq.mergefolder, (data['trimmed'], out, 16), all_reads, out, {}),
+        ("mergefolder_bbmerge", autoq.mergefolderbb, (data['trimmed'], out, False), all_reads, out, {}),
+        ("mergefolder_bbmerge_batched", autoq.mergefolderbb, (data['trimmed'], out, False), all_reads, out,
+         {'bb_batch': arg.samples}),
+        ("mergefolder_native", autoq.mergefoldernative, (data['trimmed'], out, 16), all_reads, out, {}),
+        ("qualitycontrol_split_libraries", autoq.qualitycontrol, (data['merged'], out, 19), sum(merged), out,
+         {'qc_method': "split_libraries"}),
+        ("qualitycontrol_native", autoq.qualitycontrol, (data['merged'], out, 19), sum(merged), out,
+         {'qc_method': "native"}),
+        ("streaming_subsampled", autoq.streamsample, (s1[0], s1[1], None, out1, "S01", 12, 16, 19), reads, out1,
+         {'subsample': "input", 'depth': arg.pairs // 20}),
+        ("removechimera", autoq.removechimera, (data['qc'], out), sum(qc), out, {}),
+    ]
+    needs_numpy = ["numpy_trim", "trimfolder_fused_chunked", "native_merge", "streaming", "streaming_subsampled",
+                   "mergefolder_native"]
+    for test in tests:
+        if autoq.numpy is None and test[0] in needs_numpy:
+            continue
+        yield test
+
+
+def dereplicate(autoq, inFolder, out):
+    os.mkdir(out)
+    autoq.dereplicate(autoq.asfolder(inFolder), sorted(os.listdir(inFolder)), autoq.asfolder(out))
+
+
+def prepare(autoq, temp, arg):
+    """
+    Write the synthetic data and the inputs of the later steps: trimmed,
+    merged and quality controlled files of every sample.
+    """
+    data = {'temp': temp, 'rawFolder': os.path.join(temp, "raw") + "/"}
+    data['raw'] = write_amplicons(data['rawFolder'], arg.samples, arg.pairs, arg.length, arg.overlap,
+                                  gz=arg.gz, seed=arg.seed)
+    for name in ("trimmed", "merged", "qc"):
+        data[name] = os.path.join(temp, name) + "/"
+    autoq.trimfolder(data['rawFolder'], data['trimmed'], 12)
+    if autoq.numpy is not None:
+        autoq.mergefoldernative(data['trimmed'], data['merged'], 16)
+    else:
+        # the reads merged by the fastq-join stub are the R1 reads, shorter than --ml
+        autoq.PR['minimum_length'] = 0
+        autoq.mergefolder(data['trimmed'], data['merged'], 16)
+        autoq.PR['minimum_length'] = 380
+    autoq.qualitycontrol(data['merged'], data['qc'], 19)
+    data['merged_reads'] = [autoq.count_reads(data['merged'] + x) for x in sorted(os.listdir(data['merged']))]
+    data['qc_reads'] = [autoq.count_reads(data['qc'] + x) for x in sorted(os.listdir(data['qc']))]
+    return data
+
+
+def remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=HERE,
+                                       stderr=open(os.devnull, "w")).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, old, tolerance):
+    """
+    Print the change of throughput and peak memory of every benchmark
+    found in both results.
+
+    :return: number of regressions.
+    """
+    regressions = 0
+    if old['data'] != results['data']:
+        print("\nwarning: the data of the two runs differ, %s and %s" % (old['data'], results['data']))
+    print("\n%-32s %12s %12s %8s %12s %12s %8s" % ("benchmark", "old reads/s", "reads/s", "change",
+                                                  "old rss_kB", "rss_kB", "change"))
+    for name, new in sorted(results['results'].items()):
+        if name not in old['results']:
+            continue
+        before = old['results'][name]
+        speed = 100.0 * (new['reads_per_sec'] / before['reads_per_sec'] - 1)
+        memory = 100.0 * (float(new['peak_rss_kb']) / before['peak_rss_kb'] - 1)
+        flag = ""
+        if speed < -tolerance or memory > tolerance:
+            flag = "REGRESSION"
+            regressions += 1
+        print("%-32s %12.0f %12.0f %7.1f%% %12d %12d %7.1f%% %s" % (
+            name, before['reads_per_sec'], new['reads_per_sec'], speed,
+            before['peak_rss_kb'], new['peak_rss_kb'], memory, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", dest="output", default="results.json",
+                        help="output JSON file [default: results.json]")
+    parser.add_argument("--compare", dest="compare",
+                        help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", dest="tolerance", type=float, default=10.0,
+                        help="percent of lower throughput or higher memory reported as a regression "
+                             "[default: 10]")
+    parser.add_argument("-b", dest="only",
+                        help="comma separated names of the benchmarks to run [default: all]")
+    parser.add_argument("-n", dest="repeats", type=int, default=3,
+                        help="runs of each benchmark, the fastest is kept [default: 3]")
+    parser.add_argument("-c", dest="cores", type=int, default=2,
+                        help="workers of the per-folder steps [default: 2]")
+    parser.add_argument("-s", dest="samples", type=int, default=4,
+                        help="number of samples [default: 4]")
+    parser.add_argument("-p", dest="pairs", type=int, default=20000,
+                        help="read pairs per sample [default: 20000]")
+    parser.add_argument("-l", dest="length", type=int, default=250,
+                        help="read length [default: 250]")
+    parser.add_argument("-v", dest="overlap", type=int, default=80,
+                        help="overlap of the two reads of a pair [default: 80]")
+    parser.add_argument("--gz", dest="gz", action="store_true",
+                        help="gzip compressed input files")
+    parser.add_argument("--seed", dest="seed", type=int, default=1,
+                        help="random seed of the data [default: 1]")
+    arg = parser.parse_args()
+
+    os.environ["PATH"] = STUBS + os.pathsep + os.environ.get("PATH", "")
+    autoq = load_autoq()
+    temp = tempfile.mkdtemp()
+    try:
+        configure(autoq, temp, arg.cores)
+        data = prepare(autoq, temp, arg)
+        results = {'auto-q': autoq.__version__, 'commit': git_commit(),
+                   'python': sys.version.split()[0],
+                   'numpy': None if autoq.numpy is None else autoq.numpy.__version__,
+                   'date': datetime.datetime.now().isoformat(),
+                   'data': {'samples': arg.samples, 'pairs': arg.pairs, 'length': arg.length,
+                            'overlap': arg.overlap, 'gz': arg.gz, 'seed': arg.seed, 'cores': arg.cores},
+                   'results': {}}
+        only = None if arg.only is None else arg.only.split(",")
+        print("%-32s %10s %12s %12s" % ("benchmark", "seconds", "reads/sec", "peak_rss_kB"))
+        for test in benchmarks(autoq, data, arg):
+            name, function, args, reads, output, changes = test
+            if only is not None and name not in only:
+                continue
+            parameters = dict(autoq.PR)
+            autoq.PR.update(changes)
+            runs = []
+            for _ in range(arg.repeats):
+                remove(output)
+                runs.append(measure(function, *args))
+            remove(output)
+            autoq.PR.clear()
+            autoq.PR.update(parameters)
+            seconds, rss = min(runs)
+            results['results'][name] = {'reads': reads, 'seconds': seconds,
+                                        'reads_per_sec': reads / seconds, 'peak_rss_kb': rss}
+            print("%-32s %10.2f %12.0f %12d" % (name, seconds, reads / seconds, rss))
+    finally:
+        shutil.rmtree(temp)
+
+    with open(arg.output, "w") as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    if arg.compare:
+        with open(arg.compare) as f:
+            old = json.load(f)
+        if compare(results, old, arg.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,6 @@
+#!/bin/bash
+# benchmark stand-in for bbduk.sh: copies the reads without trimming
+# the reads are copied (decompressed, and compressed again for a .gz output)
+copy() { case $2 in *.gz) gzip -cdf "$1" | gzip -1 > "$2";; *) gzip -cdf "$1" > "$2";; esac; }
+for a in "$@"; do case $a in -in1=*) I1=${a#*=};; -in2=*) I2=${a#*=};; -out1=*) O1=${a#*=};; -out2=*) O2=${a#*=};; esac; done
+copy "$I1" "$O1" && copy "$I2" "$O2"
@@ -0,0 +1,6 @@
+#!/bin/bash
+# benchmark stand-in for bbmerge.sh: the R1 reads are written as the merged reads
+# the reads are copied (decompressed, and compressed again for a .gz output)
+copy() { case $2 in *.gz) gzip -cdf "$1" | gzip -1 > "$2";; *) gzip -cdf "$1" > "$2";; esac; }
+for a in "$@"; do case $a in -in1=*) I1=${a#*=};; -out=*) O=${a#*=};; esac; done
+copy "$I1" "$O"
@@ -0,0 +1,11 @@
+#!/bin/bash
+# benchmark stand-in for filter_fasta.py -s: keeps the sequences listed in the file
+while [ $# -gt 0 ]; do
+    case $1 in
+        -f) I=$2; shift;;
+        -o) O=$2; shift;;
+        -s) L=$2; shift;;
+    esac
+    shift
+done
+awk 'NR==FNR{k[$1]=1; next} /^>/{id=substr($1,2); p=(id in k)} p' "$L" "$I" > "$O"
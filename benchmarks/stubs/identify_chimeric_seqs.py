@@ -0,0 +1,12 @@
+#!/bin/bash
+# benchmark stand-in for identify_chimeric_seqs.py: a sequence is chimeric
+# when its length is a multiple of 3, so the verdict depends on the sequence only
+while [ $# -gt 0 ]; do
+    case $1 in
+        -i) I=$2; shift;;
+        -o) O=$2; shift;;
+    esac
+    shift
+done
+mkdir -p "$O"
+awk '/^>/{id=substr($1,2); next} length($0)%3!=0{print id}' "$I" > "$O/non_chimeras.txt"
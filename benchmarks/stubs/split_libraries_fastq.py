@@ -0,0 +1,12 @@
+#!/bin/bash
+# benchmark stand-in for split_libraries_fastq.py: fastq to fasta without quality filtering
+while [ $# -gt 0 ]; do
+    case $1 in
+        -i) I=$2; shift;;
+        -o) O=$2; shift;;
+        --sample_ids) S=$2; shift;;
+    esac
+    shift
+done
+mkdir -p "$O"
+gzip -cdf "$I" | awk -v s="$S" 'NR%4==1{printf(">%s_%d %s\n", s, (NR-1)/4, substr($0,2))} NR%4==2{print}' > "$O/seqs.fna"
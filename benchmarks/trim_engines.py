@@ -0,0 +1,75 @@
+#! /usr/bin/env python
+# coding: utf-8
+"""
+Compare the trimming engines of auto-q (--trimmer bbduk, fused, numpy)
+on the same read pairs: reads per second and peak memory.
+
+The bbduk engine is measured only when bbduk.sh is on the PATH.
+
+usage: trim_engines.py [-r reads] [-t trimq]
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+from common import load_autoq, measure, write_pairs
+
+
+def which(program):
+    for folder in os.environ.get("PATH", "").split(os.pathsep):
+        if os.access(os.path.join(folder, program), os.X_OK):
+            return True
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-r", dest="reads", type=int, default=100000,
+                        help="number of read pairs")
+    parser.add_argument("-t", dest="trimq", type=int, default=12,
+                        help="phred quality threshold")
+    arg = parser.parse_args()
+
+    autoq = load_autoq()
+    autoq.PR.update({'primertrim_forward': 17, 'primertrim_reverse': 21,
+                     'min_read_length': 10, 'adapter_ref': None, 'fail_fast': False,
+                     'command_log_size': 1024, 'minimum_length': 0, 'joining_method': "native",
+                     'subsample': None})
+    engines = ["fused"]
+    if autoq.numpy is not None:
+        engines.append("numpy")
+    if which("bbduk.sh"):
+        engines.append("bbduk")
+
+    temp = tempfile.mkdtemp()
+    autoq.PR['others'] = temp + "/"
+    try:
+        in1 = os.path.join(temp, "S_L001_R1_001.fastq")
+        in2 = os.path.join(temp, "S_L001_R2_001.fastq")
+        write_pairs(in1, in2, arg.reads)
+        print("%-8s %12s %12s %12s" % ("engine", "seconds", "reads/sec", "peak_rss_kB"))
+        for engine in engines:
+            autoq.PR['trimmer'] = engine
+            out1 = os.path.join(temp, engine + "_R1.fastq")
+            out2 = os.path.join(temp, engine + "_R2.fastq")
+            if engine == "bbduk":
+                def run():
+                    autoq.primertrim(in1, out1 + ".tmp", 17)
+                    autoq.primertrim(in2, out2 + ".tmp", 21)
+                    autoq.execute("bbduk.sh -Xmx1000m -in1=%s -in2=%s -out1=%s -out2=%s -qtrim=r -trimq=%d" %
+                                  (out1 + ".tmp", out2 + ".tmp", out1, out2, arg.trimq))
+            else:
+                def run():
+                    autoq.fusedtrim(in1, in2, out1, out2, arg.trimq)
+            seconds, rss = measure(run)
+            print("%-8s %12.2f %12.0f %12d" % (engine, seconds, arg.reads / seconds, rss))
+    finally:
+        shutil.rmtree(temp)
+
+
+if __name__ == "__main__":
+    sys.exit(main())